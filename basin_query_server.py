@@ -0,0 +1,25 @@
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    Starts the local basin query server (see utils/basin_query.py).  Basin table and attribution tables are loaded once,
+    then basin, upstream, downstream and pfaf prefix queries are answered from memory until the server is stopped (ctrl+c).
+
+    Usage
+    ---------
+    python basin_query_server.py output/tif_hb12_att.csv output/hb12_grand_local.csv
+    attribution csv files to load are listed as arguments, the port is set with GFF_QUERY_PORT (default 8765).
+    Query from python with utils.basin_query.QueryClient, or from a browser, e.g. http://127.0.0.1:8765/upstream?id=1120020010
+'''
+
+import os
+import sys
+from utils import basin_query
+
+
+if __name__ == '__main__':
+    port = int(os.environ.get('GFF_QUERY_PORT', 8765))
+    basin_query.serve(tables=sys.argv[1:], port=port)
@@ -0,0 +1,74 @@
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    Benchmark of the time taken to import the utils package (and optionally submodules) in a fresh interpreter.
+    Each worker process pays this cost, so importing utils should stay well under a second and should not read data.
+
+    Usage
+    ---------
+    python benchmark_import_time.py                       -> times 'import utils'
+    python benchmark_import_time.py utils.file_management -> times import of a submodule
+    exits with status 1 if the median time exceeds the limit (default 1 second, set with GFF_IMPORT_LIMIT)
+'''
+
+import os
+import sys
+import subprocess
+from statistics import median
+
+
+def time_import(module='utils', repeat=5):
+    '''
+    Description
+    ---------
+    Times import of a module in a fresh python process, returns list of seconds (one per repeat)
+    '''
+    code = ('import time; start = time.perf_counter(); '
+            f'import {module}; '
+            'print(time.perf_counter() - start)')
+    times = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        if out.returncode != 0:
+            raise RuntimeError(f'import {module} failed: {out.stderr}')
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return times
+
+
+def data_files_opened(module='utils'):
+    '''
+    Description
+    ---------
+    Returns list of files under data/ that are opened while importing a module (should be empty)
+    '''
+    code = ('import builtins, io; opened = []; _open = io.open\n'
+            'def tracking_open(file, *args, **kwargs):\n'
+            '    opened.append(str(file)); return _open(file, *args, **kwargs)\n'
+            'builtins.open = tracking_open; io.open = tracking_open\n'
+            f'import {module}\n'
+            "print('\\n'.join([f for f in opened if 'data/' in f]))")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    return [line for line in out.stdout.splitlines() if line]
+
+
+if __name__ == '__main__':
+    modules = sys.argv[1:] or ['utils']
+    limit = float(os.environ.get('GFF_IMPORT_LIMIT', 1.0))
+    failed = False
+    for module in modules:
+        times = time_import(module)
+        opened = data_files_opened(module)
+        print(f'import {module}: median {median(times):.3f} s, min {min(times):.3f} s, max {max(times):.3f} s')
+        if opened:
+            print(f'import {module} opened data files: {opened}')
+            failed = True
+        if median(times) > limit:
+            print(f'import {module} is slower than the limit of {limit} s')
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,29 @@
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    Exports attribution results joined to basin geometry as a GeoPackage or FlatGeobuf layer (see utils/spatial_export.py).
+    Geometry is streamed from the basin store in chunks, so memory depends on chunk size rather than the number of basins.
+
+    Usage
+    ---------
+    python export_layers.py output/hb12.gpkg output/tif_hb12_att.csv output/tif_pfaf_06.csv
+    the output file (.gpkg or .fgb) is followed by attribution csv files to join.  Settings:
+        GFF_EXPORT_LEVELS -> comma separated pfaf levels to dissolve and write, e.g. 04,06 (default none)
+        GFF_EXPORT_CHUNK  -> number of basins decoded and written at once (default 50000)
+'''
+
+import os
+import sys
+from utils import spatial_export
+
+
+if __name__ == '__main__':
+    levels = [level for level in os.environ.get('GFF_EXPORT_LEVELS', '').split(',') if level.strip()]
+    chunk_size = int(os.environ.get('GFF_EXPORT_CHUNK', 50000))
+    layers = spatial_export.export_layers(sys.argv[2:], sys.argv[1], pfaf_levels=levels, chunk_size=chunk_size)
+    for name, (path, layer, count) in layers.items():
+        print(f'{name}: {count} features written to {path} (layer {layer})')
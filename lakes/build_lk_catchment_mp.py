@@ -1,8 +1,9 @@
 
 from utils import build_lk_catchment as build_lk
+from utils import progress
+from utils import memory
+from utils import executor
 import geopandas as gpd
-from multiprocessing import Pool
-from functools import partial
 import os
 
 def run_lake(lake):
@@ -46,10 +47,16 @@ if __name__ == '__main__':
             print (f"processing: {lake}" )
             build_lk.watershed(flow_dir_file,lake,55)
 
-    p = Pool(6)
-    list_of_results = p.map(run_lake, ((lake for lake in lakes_info)))
-    p.close()
-    p.join()
+    # use up to 6 processers, each worker reads a full flow direction grid, default assumes 4GB per worker until measured
+    budget = memory.MemoryBudget()
+    workers, chunksize = budget.plan_pool(len(lakes_info), budget.bytes_per_basin('lake_worker', 4 * 1024**3), max_workers=6)
+    monitor = progress.ProgressMonitor(len(lakes_info), label='lake watersheds', status_file='output/lkshed_status.json')
+    with executor.Executor(workers=workers, chunksize=chunksize) as ex:
+        list_of_results = ex.map(run_lake, lakes_info, task_ids=[lake.id for lake in lakes_info], monitor=monitor)
+    #store measured worker memory so later runs choose worker count from it
+    worker_peaks = [w['peak_rss_mb'] for w in monitor.workers.values()]
+    if worker_peaks:
+        budget.record('lake_worker', 1, max(worker_peaks) * 1048576)
 
 
         
\ No newline at end of file
@@ -1,62 +1,59 @@
 
 from utils import file_management as f_mng
 from utils import attribution as attr
+from utils import instrumentation as instr
+from utils import progress
+from utils import memory
+from utils import executor
 import geopandas as gpd
+import pandas as pd
+import os
 from timeit import default_timer as timer
-from functools import partial
-from multiprocessing import Pool
-import json
 
 import warnings
 warnings.filterwarnings("ignore")
 
 
 
-def run_the_stats(gdf, json_file_info, basin_id):
-    #Select row from geodataframe with basin information, including bounding box info
-    basin_info_gdf = gdf.loc[gdf['HYBAS_ID']==basin_id]
-    pfaf_12 = basin_info_gdf.iloc[0]['PFAF_ID']
-    sub_area = float((basin_info_gdf.iloc[0])['SUB_AREA'])
-    
-    bbox_gdf = basin_info_gdf.bounds
-
-    #Initiate basin stat object, this will help manage stats as created for the basin
-    basin_info = attr.Stats(basin_id, pfaf_12, sub_area)
-
-    #Add bounding box of basin to object
-    basin_info.bounds((bbox_gdf['minx']),(bbox_gdf['maxx']),(bbox_gdf['miny']), (bbox_gdf['maxy']))
-    # loop through each record (representing a file in the folder containing variable data) in json_file_info 
-    for file in json_file_info:
-        #bounds of tif file
-        var_bounds = file['bounds']
-
-        #evaluate if tif file bounds spatialy overlap basin, process if overlap/intersection occurs
-        basin_info.evaluate_intersection(var_bounds)
-        basin_info.run_zonal_stats(basin_info_gdf, file)
-    
-    final_basin_stats = basin_info.basin_stats
-    final_basin_stats['id'] = int(basin_info.id)
-    final_basin_stats['pfaf_12'] = int(basin_info.pfaf_12)
-    final_basin_stats['sub_area'] = basin_info.sub_area
-
-    return final_basin_stats
+def run_the_stats(gdf, json_file_info, approximate, basin_ids):
+    #Attribute a chunk of basins, raster windows for upcoming basins are prefetched while stats are computed
+    #queue depth and reader threads are set with GFF_PREFETCH_DEPTH and GFF_IO_THREADS (see utils/raster_io.py)
+    return attr.attribute_chunk(gdf, json_file_info, basin_ids, approximate=approximate)
 
 
 if __name__ == '__main__':
 
     start_all= timer()
 
+    #Timings and counters are written as json lines, one record per stage, region and worker
+    log = instr.JsonlLog('output/step2_metrics.jsonl')
+    #Set to a directory (e.g. 'output/step2_profiles') to capture cProfile per worker, merged at end of run
+    profile_dir = None
+    #Set to True to time and size pickling of each worker result (results are pickled twice), written with worker metrics
+    measure_pickle = False
+    if profile_dir:
+        #captures of earlier runs would otherwise be merged with this run
+        instr.clear_profiles(profile_dir)
+    #Memory budget, set using GFF_MEMORY_BUDGET (e.g. 24GB) or defaults to 80% of available memory
+    budget = memory.MemoryBudget()
+    #Approximate mode for exploratory runs, set GFF_APPROXIMATE to a resolution factor (e.g. 8) to read rasters at 1/8 resolution
+    #error is estimated on a random sample of basins in each region and written to output/tif_hb12_approx{factor}_error.csv
+    approximate = int(os.environ.get('GFF_APPROXIMATE', 0)) or None
+    error_reports = []
+
     all_results = []
     regions = ['af','ar','as','au','eu','gr','na','sa','si']
     for region in regions:
         start_load= timer()
 
-        #Import file processing information
-        with open("data/var/tif_vars_file_info.json", "r") as all_file_info:
-            json_file_info = json.load(all_file_info)
+        #Import file processing information, tiled variables are read as one mosaic per label when built (see file_management.build_mosaics)
+        with instr.Timer('load_file_info', log):
+            json_file_info = f_mng.read_file_info('data/var', 'tif_vars')
 
-        #Read in pickled level 12 HydroBASINS (see step1_data_management.ipynb)
-        gdf = f_mng.read_pkl_gdf(f'data/basins_{region}_lvl12_gdf.pkl')
+        #Read level 12 HydroBASINS for the region from the basin store (see step1_data_management.ipynb)
+        with instr.Timer('load_basins', log, track_memory=True) as load_timer:
+            gdf = f_mng.read_pkl_gdf(region=region)
+        budget.record('load_basins', len(gdf), load_timer.sampler.end_bytes - load_timer.sampler.start_bytes)
 
         #Read in list of HYBAS_IDs (see step1_data_management.ipynb).  Provides list of IDs to process.
         basin_list = gdf['HYBAS_ID'].tolist()
@@ -70,24 +67,64 @@ if __name__ == '__main__':
 
         start_proc= timer()
         
-        # use 7 processers, leave () empty to use all available, noticed that sometimes causes issues on local machine
-        p = Pool(7)
-        values = partial(run_the_stats, gdf, json_file_info)
-        result = p.map(values, basin_list)
-        p.close()
-        p.join()
-
-        all_results += result
+        # use up to 7 processers, noticed that all available sometimes causes issues on local machine
+        # each worker holds a copy of the basin data, worker count and chunksize are chosen to fit the memory budget
+        # backend, workers and chunksize can be changed per run with GFF_EXECUTOR, GFF_WORKERS and GFF_CHUNKSIZE (see utils/executor.py)
+        worker_bytes = budget.bytes_per_basin('worker', budget.bytes_per_basin('load_basins', 0)) * len(gdf)
+        workers, chunksize = budget.plan_pool(len(basin_list), worker_bytes, result_bytes=4096, max_workers=7)
+        #basin data and file info are handed to each worker once, not pickled with every chunk of basins
+        shared = {'gdf': gdf, 'json_file_info': json_file_info, 'approximate': approximate}
+        values = instr.InstrumentedTask(executor.SharedTask(run_the_stats, 'gdf', 'json_file_info', 'approximate'), profile_dir=profile_dir,
+                                     measure_pickle=measure_pickle)
+        with executor.Executor(workers=workers, chunksize=chunksize, shared=shared) as ex:
+            print(f'Using {ex} for region {region}')
+            #each task is a chunk of basins so a worker can read ahead windows of the basins it will process next
+            basins_per_chunk = ex.chunksize or progress.default_chunksize(len(basin_list), ex.workers)
+            basin_chunks = [basin_list[i:i + basins_per_chunk] for i in range(0, len(basin_list), basins_per_chunk)]
+            with instr.Timer('pool_map', log):
+                result = ex.map(values, basin_chunks, task_ids=[chunk[0] for chunk in basin_chunks], chunksize=1,
+                                label=f'basin chunks in region {region}', status_file='output/step2_status.json')
+
+        with instr.Timer('result_assembly_parent', log):
+            result, per_worker = instr.unpack_results(result)
+            #results stay as compact ResultBatch arrays until written
+            all_results += result
+
+        for pid, worker_metrics in per_worker.items():
+            log.write_metrics(worker_metrics, label='worker', region=region)
+        #measured worker memory is used to plan the pool for the next region (and next run)
+        worker_peaks = [m.peaks.get('worker_peak_rss', 0) for m in per_worker.values()]
+        if worker_peaks:
+            budget.record('worker', len(gdf), max(worker_peaks))
+
+        if approximate:
+            with instr.Timer('approximation_error', log):
+                report = attr.approximation_error(gdf, json_file_info, basin_list, approximate)
+                report['region'] = region
+                error_reports.append(report)
+                print(report.to_string(index=False))
 
         end_proc = timer() 
         print(f'Seconds taken to process region {region}: {end_proc-start_proc}') 
     
 
-    all_results_clean = [x for x in all_results if x]
     outfile_name = f'output/tif_hb12_att.json'
-   
-    with open(outfile_name, 'w') as outfile:
-        json.dump(all_results_clean, outfile)
+    if approximate:
+        outfile_name = f'output/tif_hb12_att_approx{approximate}.json'
+        pd.concat(error_reports).to_csv(f'output/tif_hb12_approx{approximate}_error.csv', sep=',', index=False)
+
+    with instr.Timer('write_output', log):
+        attr.write_json(all_results, outfile_name)
+        #histograms for upstream and pfaf percentiles, only for files with sketch_bins in file_processing_info.csv
+        attr.write_sketches(all_results, json_file_info, outfile_name.replace('_att', '_sketch').replace('.json', '.npz'))
+        #long format table of temporal stacks, set GFF_EPOCH_CHANGE to previous or first to add change between epochs
+        attr.write_stack_table(all_results, json_file_info, outfile_name.replace('_att', '_stack').replace('.json', '.csv'),
+                               change=os.environ.get('GFF_EPOCH_CHANGE'))
+
+    log.write_metrics(instr.METRICS, label='run')
+    print(instr.summary())
+    if profile_dir:
+        print(instr.merge_profiles(profile_dir, f'{profile_dir}/merged.prof'))
 
     end_all = timer() 
     print(f'Seconds taken to process all: {end_all-start_all}') 
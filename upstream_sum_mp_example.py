@@ -1,48 +1,21 @@
 from utils import network_calc as calc
-from multiprocessing import Pool
+from utils import memory
+from utils import executor
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-from functools import partial
 from timeit import default_timer as timer
-import h5py
-import sys
 
-class StreamSegment(object):
-    """ Define a river segment """
-    def __init__(self):
-      """ Initialize the river segment """
-      self.id=None
-      self.area=None
-      self.tot_area=None
-      self.pfaf_12=None
-      self.order=None
-      self.up_seg_ids=None
-    
-  
-def get(hdf_name,seg_id):
-    """ Given a hdf5 file name, obtain the record for the specified idNumber """
-    item=StreamSegment() # Init a river segment
-    with h5py.File(hdf_name,'r') as h5: # Open the hdf5 database and grab the entry
-      tmp=h5.get(str(seg_id))
-      item.id=seg_id
-      try:
-        item.area=np.array(tmp.get('area'),dtype=np.float32)
-        item.tot_area=np.array(tmp.get('tot_area'),dtype=np.float32)
-        item.pfaf_12=np.array(tmp.get('pfaf_12'),dtype=np.int)
-        item.order=np.array(tmp.get('order'),dtype=np.int8)
-        item.up_seg_ids=np.sort(np.array(tmp.get('up_seg_ids'),dtype=np.int))
-      except:
-        print('The hdf database does not contain data for id number',seg_id)
-        sys.exit()
-    return item
 
 def upstream_sum(np_basin_data, basin_id):
-    hdf_name = 'data/hb12_netowrk.h5'
-    seg_data = get(hdf_name, str(basin_id))
+    hdf_name = 'output/hb12_network.h5'
+    #one reader per worker process keeps the file open and caches records between tasks
+    seg_data = calc.network_reader(hdf_name).get(basin_id)
+    if seg_data is None:
+        return {'seg_id':int(basin_id), 'tot_area_sqkm': None, 'missing': True}
     np_subset = np_basin_data[np.where(np.isin(np_basin_data[:,0], seg_data.up_seg_ids))]
     stat = ((np_subset[:,1].sum()) + seg_data.area)
-    basin_stat = {'seg_id':int(basin_id), 'tot_area_sqkm': stat}
+    basin_stat = {'seg_id':int(basin_id), 'tot_area_sqkm': float(stat)}
     return basin_stat
 
 
@@ -70,12 +43,17 @@ if __name__ == '__main__':
     
     start= timer()
     
-    # use 7 processers, leave () empty to use all available
-    p = Pool(7)
-    list_agg_values = partial(upstream_sum, np_basin_data)
-    result = p.map(list_agg_values, list_of_hybas_ids_sub)
-    p.close()
-    p.join()
+    # use up to 7 processers, np_basin_data is handed to workers in shared memory so workers do not each hold a copy
+    budget = memory.MemoryBudget()
+    #workers attach to one shared copy, each worker only needs room for the np.isin mask and subset
+    workers, chunksize = budget.plan_pool(len(list_of_hybas_ids_sub), np_basin_data.nbytes // 2, result_bytes=256, max_workers=7)
+    #shared memory requires a numeric array (HYBAS_ID and SUB_AREA are both exact as float64)
+    np_basin_data = np_basin_data.astype(np.float64)
+    list_agg_values = executor.SharedTask(upstream_sum, 'np_basin_data')
+    with executor.Executor(workers=workers, chunksize=chunksize, shared={'np_basin_data': np_basin_data}) as ex:
+        #one short task per basin, task starts are not recorded (see progress.run_pool track_running)
+        result = ex.map(list_agg_values, list_of_hybas_ids_sub, label='upstream sums', status_file='output/upstream_sum_status.json',
+                        track_running=False)
     
 
     end = timer() 
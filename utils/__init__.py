@@ -3,10 +3,24 @@
 #import pkg_resources  # part of setuptools
 
 
-# Import 
-from . import build_lk_catchment
-from . import file_management
-from . import attribution
+# Import
+# Submodules are imported when first used (e.g. from utils import attribution or utils.attribution) so importing
+# the package does not pull in gdal, rasterio, geopandas or read any data.  Worker processes only pay for what they use.
+import importlib
+
+_submodules = ['attribution', 'basin_query', 'basin_store', 'build_lk_catchment', 'build_network', 'executor',
+               'file_management', 'flow_graph', 'instrumentation', 'memory', 'network_calc', 'overlay_attribution',
+               'pfaf_summarize', 'point_attribution', 'progress', 'raster_io', 'spatial_export']
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module(f'{__name__}.{name}')
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(list(globals()) + _submodules)
 
 # provide version, PEP - three components ("major.minor.micro")
 #__version__ = pkg_resources.require("package_nm")[0].version
@@ -1,8 +1,8 @@
 #Import packages
+import numpy as np
 import pandas as pd
-import rasterio
-from rasterstats import zonal_stats
 import json
+from utils import instrumentation as instr
 #import csv
 
 
@@ -17,6 +17,14 @@ import json
     ---------
     module that builds objects for attributing information from landscape variables to spatial units such as watersheds
 
+    Files with sketch_bins, sketch_min and sketch_max in file_processing_info.csv also get a fixed bin histogram of pixel
+    values per basin (stat f'{label}_hist').  Histograms of a variable share bin edges, so they merge by adding counts along
+    the network or pfaf hierarchy and give approximate percentiles (see sketch_quantiles and network_calc.upstream_quantiles).
+
+    Files with a stack in file_processing_info.csv are epochs of one variable (e.g. LC100 2015 to 2019).  Epoch windows of a
+    basin are read together and attributed with one pixel mask (see file_stacks and Stats.stack_stats), and stats are
+    also written in long format (hybas_id, variable, epoch, stat) with optional change between epochs (see write_stack_table).
+
     Note: need to unravel so it isn't as specific to pfaf_12
 '''
 class Stats:
@@ -81,13 +89,124 @@ class Stats:
             self.bounds_eval =  0
 
     
-    def run_zonal_stats(self, object_gdf, file):
+    def zonal_stats(self, object_gdf, file, window=None):
+        '''
+        Description
+        ---------
+        If object is contained within or intersects with bounds of extent of variable information then run zonal stats
+
+        Parameters
+        ---------
+        object_gdf : geodataframe with spatial unit to process
+        file: dictionary describing data being attributed (see run_zonal_stats)
+        window: optional raster_io.RasterWindow already read for the object bounds (see attribute_chunk), if None the file is read
+
+        Output
+        ---------
+        dictionary of zonal statistics with keys f'{label}_{stat}', None if object does not intersect the file
+        '''
+        if self.bounds_eval == 0:
+            instr.count('skipped_bounds_eval_0')
+            return None
+        #imported here, rasterstats pulls in rasterio and shapely which are slow to import
+        from rasterstats import zonal_stats
+        label = file['label']
+        nodata_val = file['no_data_val']
+        #tiled copy from file_management.prepare_rasters is read when available
+        var_file_path = file.get('prepared_path') or file['file_path']
+        #stats = "nodata count mean"
+        stats = file['summary_type']
+        cat = False
+        if "categorical" in file and file['categorical'] == 'yes':
+            cat = True
+        all_touching = False
+        if "pixel_inclusion" in file and file['pixel_inclusion'] == 'all_touching':
+            all_touching = True
+        prefix = f'{label}_'
+        edges = sketch_edges(file)
+        add_stats = {'hist': histogram_stat(edges)} if edges is not None else None
+
+        #nodata overrides, valid ranges and scale/offset from file_processing_info.csv are applied as windows are read
+        if window is None:
+            from utils import raster_io
+            rules = raster_io.ValueRules.from_file_info(file)
+            if rules is not None:
+                window = raster_io.read_window(var_file_path, self.xmin, self.xmax, self.ymin, self.ymax, rules=rules)
+        with instr.Timer('zonal_stats'):
+            if window is not None:
+                if nodata_val is None or window.remapped:
+                    nodata_val = window.nodata
+                result = zonal_stats(object_gdf, window.array, affine=window.affine, stats=stats, nodata=nodata_val, geojson_out=False, prefix=prefix, categorical=cat, all_touched=all_touching, add_stats=add_stats)
+            else:
+                result = zonal_stats(object_gdf, var_file_path, stats=stats, nodata=nodata_val, geojson_out=False, prefix=prefix, band=1, categorical=cat, all_touched=all_touching, add_stats=add_stats)
+        instr.count('zonal_stats_calls')
+        if window is None and 'pixel_size' in file:
+            instr.count('bytes_read', instr.estimate_window_bytes(self.xmin, self.xmax, self.ymin, self.ymax, file['pixel_size'], file.get('dtype')))
+        if len(result)>1:
+            print (f'HydroID {self.id} has {len(result)} results from zonal stats.. better check that!')
+        result = result[0]
+        #windows converted to float by value rules (see raster_io.ValueRules.apply) keep integer category names
+        if cat and window is not None and window.array.dtype.kind == 'f' and _integer_dtype(file) and \
+                file.get('scale') is None and file.get('offset') is None:
+            result = integer_category_keys(result, prefix)
+        #approximate mode, each pixel read represents pixel_factor full resolution pixels
+        if window is not None and window.pixel_factor != 1:
+            instr.count('approximate_windows')
+            scale_result(result, prefix, window.pixel_factor)
+        return result
+
+    def stack_stats(self, object_gdf, files, windows):
+        '''
+        Description
+        ---------
+        Zonal stats of all epochs of a temporal stack (see file_stacks).  Epoch windows are co-registered, so the basin is
+        rasterized once and the same pixel mask is used for every epoch.  Results match zonal_stats of each file.
+
+        Parameters
+        ---------
+        object_gdf : geodataframe with spatial unit to process
+        files: list of file dictionaries of the stack, in epoch order
+        windows: list of raster_io.RasterWindow read for the object bounds, one per file (read with value rules)
+
+        Output
+        ---------
+        list of dictionaries of zonal statistics (one per file, keys f'{label}_{stat}'), None if object does not intersect files
+        '''
+        if self.bounds_eval == 0 or any([window is None for window in windows]):
+            instr.count('skipped_bounds_eval_0')
+            return None
+        from rasterstats.io import Raster
+        from rasterstats.utils import rasterize_geom
+        file = files[0]
+        geom = object_gdf.geometry.iloc[0]
+        with instr.Timer('zonal_stats'):
+            #same pixels rasterstats reads for the geometry, from each epoch window
+            fsrcs = [Raster(window.array, window.affine, window.nodata).read(bounds=tuple(geom.bounds)) for window in windows]
+            mask = rasterize_geom(geom, like=fsrcs[0], all_touched=file.get('pixel_inclusion') == 'all_touching')
+            values = np.stack([fsrc.array for fsrc in fsrcs])
+            nodata = np.array([fsrc.nodata for fsrc in fsrcs], dtype=np.float64)
+            integer_values = _integer_dtype(file)
+            results = masked_stats(values, mask, nodata, file['summary_type'].split(), file.get('categorical') == 'yes',
+                                   sketch_edges(file), integer_values)
+        instr.count('zonal_stats_calls')
+        instr.count('stack_epochs', len(files))
+        out = []
+        for stack_file, window, result in zip(files, windows, results):
+            prefix = f"{stack_file['label']}_"
+            result = {f'{prefix}{key}': value for key, value in result.items()}
+            if window.pixel_factor != 1:
+                instr.count('approximate_windows')
+                scale_result(result, prefix, window.pixel_factor)
+            out.append(result)
+        return out
+
+    def run_zonal_stats(self, object_gdf, file, window=None):
         '''
         Description
         ---------
         If object is contained within or intersects with bounds of extent of variable information then process zonal stats
         During zonal stats build out object
-        If 2 or more scr files have data on same variable for the object then combine results 
+        If 2 or more scr files have data on same variable for the object then combine results (see merge_stat)
 
         Parameters
         ---------
@@ -100,68 +219,35 @@ class Stats:
              'file_name': 'name and type but no directory, e.g. land_use.tif'}
 
              Note: nodata stat counts pixels with nodata
+        window: optional raster_io.RasterWindow already read for the object bounds (see attribute_chunk), if None the file is read
 
         Output
         ---------
         self.basin_stats : dictionary of zonal statistics
         '''
-        #This function should be broke into a few functions
-        if self.bounds_eval >0:
-            label = file['label']
-            nodata_val = file['no_data_val']
-            var_file_path = file['file_path']
-            #stats = "nodata count mean"
-            stats = file['summary_type']
-            file_name = file['file_name']
-            cat = False
-            if "categorical" in file and file['categorical'] == 'yes':
-                cat = True
-            all_touching = False
-            if "pixel_inclusion" in file and file['pixel_inclusion'] == 'all_touching':
-                all_touching = True
-            prefix = f'{label}_'
-
-            src_info = {'file_name': file_name, 'bounds_eval': self.bounds_eval}
-            result = zonal_stats(object_gdf, var_file_path, stats=stats, nodata=nodata_val, geojson_out=False, prefix=prefix, band=1, categorical=cat, all_touched=all_touching)
-            if len(result)>1:
-                print (f'HydroID {self.id} has {len(result)} results from zonal stats.. better check that!')
-            result[0]['src_file']= [src_info]
-            file_stats = {}
-            file_stats[label]= result[0]
-
-            #If a summary already exists for that label (from a different source file of same variable), combine stats
-            if label in self.basin_stats:
-                self.basin_stats[label]['src_file'].append(src_info)
-                for stat in stats.split():
-                    stat_key_name = f'{label}_{stat}'
-                    new_val = result[0][stat_key_name]
-                    current_val = self.basin_stats[label][stat_key_name]
-                    if stat in ['count','nodata','sum']:
-                        current_val += new_val
-                    elif stat == 'mean':
-                        count_key = f'{label}_count'
-                        current_count = self.basin_stats[label][count_key]
-                        additional_count = result[0][count_key]
-                        if current_val is None:
-                            current_val = float(0)
-                        additional_mean = new_val
-                        if additional_mean is None:
-                            additional_mean = float(0)
-                        if current_count+additional_count > 0:
-                            area_weighted = ((float(current_count)*float(current_val))+(float(additional_count)*float(additional_mean))/(float(current_count)+float(additional_count)))
-                        else:
-                            area_weighted = float(0)
-                        current_val = area_weighted
-                    elif stat == 'min':
-                        if current_val > new_val:
-                            current_val = new_val
-                    elif stat == 'max':
-                        if current_val < new_val:
-                            current_val = new_val
-
-                    
-            else:
-                self.basin_stats.update(file_stats)
+        result = self.zonal_stats(object_gdf, file, window)
+        if result is None:
+            return
+        label = file['label']
+        src_info = {'file_name': file['file_name'], 'bounds_eval': self.bounds_eval}
+
+        #If a summary already exists for that label (from a different source file of same variable), combine stats
+        if label in self.basin_stats:
+            current = self.basin_stats[label]
+            current['src_file'].append(src_info)
+            count_key = f'{label}_count'
+            current_count = current.get(count_key)
+            additional_count = result.get(count_key)
+            for key, new_val in result.items():
+                stat = key[len(label) + 1:]
+                current[key] = merge_stat(stat, current.get(key), new_val, current_count, additional_count)
+        else:
+            result['src_file'] = [src_info]
+            self.basin_stats[label] = result
+        #histograms are kept as lists so basin stats can be written to json
+        for key, value in self.basin_stats[label].items():
+            if isinstance(value, np.ndarray):
+                self.basin_stats[label][key] = value.tolist()
 
     #def to_csv(self, out_file_name):
     #    with open(out_file_name, 'a') as outfile:
@@ -184,6 +270,735 @@ class Stats:
             collection.append(final_basin_stats)
             return collection
 
+#zonal stats that are not combined by adding, any other key is a categorical pixel count
+NON_ADDITIVE_STATS = ['mean', 'min', 'max', 'std', 'median', 'majority', 'minority', 'unique', 'range']
+
+
+def is_additive(stat):
+    return stat not in NON_ADDITIVE_STATS and not stat.startswith('percentile_')
+
+
+def merge_stat(stat, current_val, new_val, current_count=None, additional_count=None):
+    '''
+    Description
+    ---------
+    Combines a statistic of a spatial unit from two source files of the same variable (e.g. tiles of one dataset)
+    count, nodata, sum and categorical pixel counts are added, mean is weighted by count, min and max are combined.
+    Other stats (e.g. median, std) can not be combined from summaries, the value from the first file is kept.
+
+    Parameters
+    ---------
+    stat : str, statistic (e.g. 'mean'), categorical pixel counts use the category value
+    current_val, new_val : values from files already combined and from the additional file (None if no valid pixels)
+    current_count, additional_count : pixel counts used to weight mean
+
+    Output
+    ---------
+    combined value
+    '''
+    if new_val is None:
+        return current_val
+    if current_val is None:
+        return new_val
+    if is_additive(stat):
+        if isinstance(current_val, list):
+            current_val = np.asarray(current_val)
+        return current_val + new_val
+    if stat == 'mean':
+        if current_count is None or additional_count is None:
+            return current_val
+        if current_count + additional_count > 0:
+            return ((float(current_count) * float(current_val)) + (float(additional_count) * float(new_val))) / (float(current_count) + float(additional_count))
+        return current_val
+    if stat == 'min':
+        return min(current_val, new_val)
+    if stat == 'max':
+        return max(current_val, new_val)
+    return current_val
+
+
+def scale_result(result, prefix, pixel_factor):
+    '''
+    Description
+    ---------
+    scales additive stats (count, sum, nodata, categorical counts, histograms) of a zonal stats result in place,
+    used in approximate mode where each pixel read represents pixel_factor full resolution pixels
+    '''
+    for key, value in result.items():
+        if isinstance(value, np.ndarray):
+            result[key] = np.rint(value * pixel_factor).astype(np.int64)
+        elif value is not None and is_additive(key[len(prefix):]):
+            result[key] = int(round(value * pixel_factor)) if isinstance(value, int) else value * pixel_factor
+    return result
+
+
+def _integer_dtype(file):
+    return file.get('dtype') is not None and np.issubdtype(np.dtype(file['dtype']), np.integer)
+
+
+def integer_category_keys(result, prefix):
+    '''
+    Description
+    ---------
+    renames categorical pixel counts of float values back to integer names (e.g. lu_10.0 -> lu_10)
+    '''
+    renamed = {}
+    for key, value in result.items():
+        category = key[len(prefix):]
+        try:
+            number = float(category)
+        except ValueError:
+            renamed[key] = value
+            continue
+        renamed[f'{prefix}{int(number)}' if number.is_integer() else key] = value
+    return renamed
+
+
+def masked_stats(values, mask, nodata, stats, categorical=False, edges=None, integer_values=False):
+    '''
+    Description
+    ---------
+    zonal stats of co-registered epochs from one pixel mask, same values as rasterstats zonal_stats of each epoch.
+    count, sum, mean, min, max, nodata and nan are computed for all epochs at once, other stats epoch by epoch.
+
+    Parameters
+    ---------
+    values : array of pixel values, epochs x rows x columns
+    mask : boolean array of pixels in the spatial unit, rows x columns (see rasterstats.utils.rasterize_geom)
+    nodata : array of nodata value of each epoch
+    stats : list of stats (e.g. ['count', 'mean', 'nodata'])
+    categorical : bool, add pixel count of each value
+    edges : optional histogram bin edges (see sketch_edges), adds 'hist'
+    integer_values : bool, categories are named as integers (values are float after value rules, source raster is integer)
+
+    Output
+    ---------
+    list of dictionaries of stats, one per epoch (keys without label prefix)
+    '''
+    in_unit = np.broadcast_to(mask, values.shape)
+    isnan = np.isnan(values)
+    is_nodata = values == nodata[:, None, None]
+    valid = in_unit & ~is_nodata & ~isnan
+    count = valid.sum(axis=(1, 2))
+    total = np.where(valid, values, 0).sum(axis=(1, 2))
+    minimum = np.where(valid, values, np.inf).min(axis=(1, 2))
+    maximum = np.where(valid, values, -np.inf).max(axis=(1, 2))
+    hist = histogram_stat(edges) if edges is not None else None
+    results = []
+    for epoch in range(values.shape[0]):
+        if count[epoch] == 0:
+            result = {stat: None for stat in stats}
+            if 'count' in stats:
+                result['count'] = 0
+        else:
+            epoch_values = values[epoch][valid[epoch]]
+            result = {}
+            if categorical:
+                keys, counts = np.unique(epoch_values, return_counts=True)
+                keys = [int(k) if integer_values and float(k).is_integer() else k.item() for k in keys]
+                result = dict(zip(keys, [c.item() for c in counts]))
+            for stat in stats:
+                if stat == 'min':
+                    result['min'] = float(minimum[epoch])
+                elif stat == 'max':
+                    result['max'] = float(maximum[epoch])
+                elif stat == 'mean':
+                    result['mean'] = float(total[epoch] / count[epoch])
+                elif stat == 'count':
+                    result['count'] = int(count[epoch])
+                elif stat == 'sum':
+                    result['sum'] = float(total[epoch])
+                elif stat == 'std':
+                    result['std'] = float(epoch_values.std())
+                elif stat == 'median':
+                    result['median'] = float(np.median(epoch_values))
+                elif stat == 'range':
+                    result['range'] = float(maximum[epoch]) - float(minimum[epoch])
+                elif stat.startswith('percentile_'):
+                    result[stat] = float(np.percentile(epoch_values, float(stat[len('percentile_'):])))
+                elif stat not in ['nodata', 'nan']:
+                    print(f'Warning, {stat} is not available for temporal stacks and is skipped')
+        if 'nodata' in stats:
+            result['nodata'] = float((in_unit[epoch] & is_nodata[epoch]).sum())
+        if 'nan' in stats:
+            result['nan'] = float((in_unit[epoch] & isnan[epoch]).sum())
+        if hist is not None:
+            result['hist'] = hist(np.ma.MaskedArray(values[epoch], mask=~valid[epoch]))
+        results.append(result)
+    return results
+
+
+def _epoch_key(epoch):
+    return (0, int(epoch), '') if str(epoch).isdigit() else (1, 0, str(epoch))
+
+
+def file_stacks(json_file_info):
+    '''
+    Description
+    ---------
+    groups files with a stack (see file_management.STACK_COLUMNS) into temporal stacks of co-registered files.
+    Files of a stack on different grids (e.g. LC100 tiles that are not combined into a mosaic) form one stack per grid.
+
+    Parameters
+    ---------
+    json_file_info : list of file info dictionaries
+
+    Output
+    ---------
+    stacks: list of dictionaries with stack, epochs and file_nums (positions in json_file_info, in epoch order)
+    '''
+    groups = {}
+    for file_num, file in enumerate(json_file_info):
+        if file.get('stack') is None:
+            continue
+        bounds = file.get('bounds', {})
+        grid = (file['stack'], file.get('crs'), file.get('pixel_size'), file.get('width'), file.get('height'),
+                tuple(round(float(bounds.get(key, np.nan)), 9) for key in ['xmin', 'xmax', 'ymin', 'ymax']))
+        groups.setdefault(grid, []).append(file_num)
+    stacks = []
+    for grid, file_nums in groups.items():
+        file_nums = sorted(file_nums, key=lambda file_num: _epoch_key(json_file_info[file_num]['epoch']))
+        epochs = [str(json_file_info[file_num]['epoch']) for file_num in file_nums]
+        if len(set(epochs)) < len(epochs):
+            raise ValueError(f'Stack {grid[0]} has more than one file for an epoch on the same grid: {epochs}')
+        first = json_file_info[file_nums[0]]
+        for file_num in file_nums[1:]:
+            for field in ['summary_type', 'categorical', 'pixel_inclusion']:
+                if json_file_info[file_num].get(field) != first.get(field):
+                    raise ValueError(f"Files of stack {grid[0]} need the same {field}, check {json_file_info[file_num]['file_name']}")
+        stacks.append({'stack': grid[0], 'epochs': epochs, 'file_nums': file_nums})
+    return stacks
+
+
+#zonal stats stored as int32 (pixel counts), categorical pixel counts are also stored as int32
+INT_STATS = ['count', 'nodata', 'nan', 'unique']
+
+
+def sketch_edges(file):
+    '''
+    Description
+    ---------
+    returns histogram bin edges for a file info dictionary (sketch_bins, sketch_min, sketch_max and optional sketch_log
+    from file_processing_info.csv), None if no histogram is requested.  Values are in units after ValueRules are applied.
+    '''
+    bins = file.get('sketch_bins')
+    if bins is None or (isinstance(bins, float) and np.isnan(bins)):
+        return None
+    low, high = float(file['sketch_min']), float(file['sketch_max'])
+    if file.get('sketch_log') == 1:
+        if low <= 0:
+            raise ValueError(f"sketch_min must be greater than 0 for log spaced bins of {file['label']}")
+        return np.geomspace(low, high, int(bins) + 1)
+    return np.linspace(low, high, int(bins) + 1)
+
+
+def histogram_stat(edges):
+    '''
+    Description
+    ---------
+    returns a rasterstats add_stats function counting valid pixels in bins, the first and last counts are pixels
+    below the first edge and above the last edge (len(edges) + 1 counts)
+    '''
+    def hist(masked):
+        values = masked.compressed() if np.ma.isMaskedArray(masked) else np.ravel(masked)
+        values = values[~np.isnan(values)] if values.dtype.kind == 'f' else values
+        return np.bincount(np.searchsorted(edges, values, side='right'), minlength=len(edges) + 1).astype(np.int64)
+    return hist
+
+
+def sketch_quantiles(counts, edges, quantiles):
+    '''
+    Description
+    ---------
+    approximate quantiles from histograms (vectorized over basins), values are interpolated linearly within a bin.
+    Pixels below the first edge or above the last edge are placed at that edge.
+
+    Parameters
+    ---------
+    counts : array of histograms, basins x (len(edges) + 1)
+    edges : bin edges shared by the histograms
+    quantiles : list of quantiles (e.g. [0.5, 0.9])
+
+    Output
+    ---------
+    array basins x quantiles, nan for basins with no pixels
+    '''
+    counts = np.asarray(counts, dtype=np.float64).reshape(-1, len(edges) + 1)
+    #under and overflow bins have zero width at the first and last edge
+    lower = np.r_[edges[0], edges]
+    upper = np.r_[edges, edges[-1]]
+    cumulative = np.cumsum(counts, axis=1)
+    total = cumulative[:, -1]
+    out = np.full((len(counts), len(quantiles)), np.nan)
+    rows = np.arange(len(counts))
+    for i, q in enumerate(quantiles):
+        target = q * total
+        bin_num = np.minimum((cumulative < target[:, None]).sum(axis=1), counts.shape[1] - 1)
+        before = np.where(bin_num > 0, cumulative[rows, np.maximum(bin_num - 1, 0)], 0.0)
+        in_bin = counts[rows, bin_num]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(in_bin > 0, (target - before) / in_bin, 0.0)
+        values = lower[bin_num] + np.clip(fraction, 0, 1) * (upper[bin_num] - lower[bin_num])
+        out[:, i] = np.where(total > 0, values, np.nan)
+    return out
+
+
+class ResultBatch:
+    __slots__ = ['ids', 'pfaf_12', 'sub_area', 'columns', 'values', 'counts', 'provenance', 'sketches']
+
+    def __init__(self, ids, pfaf_12, sub_area, n_columns=8, float_dtype=np.float32):
+        '''
+        Description
+        ---------
+        Zonal stats of a chunk of basins held in arrays instead of a dictionary per basin.  Float stats are stored
+        in values (basins x float columns, NaN if missing), pixel counts in counts (basins x int columns, -1 if missing).
+        Source files are recorded once per file for the chunk with the bounds evaluation of each basin
+        (0 if the file was not used for the basin) instead of a src_file list per basin.
+        The per basin dictionary used by json output is built on demand (see basin_stats and to_records).
+
+        Parameters
+        ---------
+        ids : HYBAS_IDs of basins in chunk (int64, HYBAS_IDs do not fit in int32)
+        pfaf_12 : pfafstetter ids of basins
+        sub_area : area of basins
+        n_columns : initial number of float and int columns, arrays grow as new stats are added
+        float_dtype : dtype of float stats, float32 keeps about 7 significant digits
+        '''
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.pfaf_12 = np.asarray(pfaf_12, dtype=np.int64)
+        self.sub_area = np.asarray(sub_area, dtype=np.float32)
+        #key (e.g. 'lu_mean') -> (label, is int, column number), in order keys were first added
+        self.columns = {}
+        self.values = np.full((len(self.ids), n_columns), np.nan, dtype=float_dtype)
+        self.counts = np.full((len(self.ids), n_columns), -1, dtype=np.int32)
+        #list of (label, file name, int8 array of bounds evaluation per basin)
+        self.provenance = []
+        #label -> histogram counts, basins x bins (see sketch_edges), kept out of json records
+        self.sketches = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.pfaf_12.nbytes + self.sub_area.nbytes + self.values.nbytes + self.counts.nbytes + \
+            sum([evals.nbytes for label, file_name, evals in self.provenance]) + sum([c.nbytes for c in self.sketches.values()])
+
+    def add_file(self, label, file_name):
+        '''
+        Description
+        ---------
+        records a source file for the chunk, returns its provenance number used by add
+        '''
+        self.provenance.append((label, file_name, np.zeros(len(self.ids), dtype=np.int8)))
+        return len(self.provenance) - 1
+
+    def _column(self, label, key):
+        if key not in self.columns:
+            stat = key[len(label) + 1:]
+            is_int = stat in INT_STATS or (is_additive(stat) and stat != 'sum')
+            array = self.counts if is_int else self.values
+            n_used = len([c for c in self.columns.values() if c[1] == is_int])
+            if n_used == array.shape[1]:
+                fill = -1 if is_int else np.nan
+                array = np.concatenate([array, np.full(array.shape, fill, dtype=array.dtype)], axis=1)
+                if is_int:
+                    self.counts = array
+                else:
+                    self.values = array
+            self.columns[key] = (label, is_int, n_used)
+        return self.columns[key]
+
+    def get(self, row, key):
+        if key not in self.columns:
+            return None
+        label, is_int, column = self.columns[key]
+        if is_int:
+            value = self.counts[row, column]
+            return None if value < 0 else int(value)
+        value = self.values[row, column]
+        return None if np.isnan(value) else float(value)
+
+    def _set(self, row, key, value):
+        label, is_int, column = self.columns[key]
+        if is_int:
+            self.counts[row, column] = -1 if value is None else value
+        else:
+            self.values[row, column] = np.nan if value is None else value
+
+    def add(self, row, label, result, provenance, bounds_eval):
+        '''
+        Description
+        ---------
+        adds zonal stats result (dictionary from Stats.zonal_stats) of a basin, combining with stats of the same label
+        from other files (see merge_stat)
+
+        Parameters
+        ---------
+        row : row of basin in batch
+        label : label of variable
+        result : dictionary of zonal stats keyed by f'{label}_{stat}'
+        provenance : number returned by add_file for the source file
+        bounds_eval : bounds evaluation of basin and source file (see Stats.evaluate_intersection)
+        '''
+        self.provenance[provenance][2][row] = bounds_eval
+        count_key = f'{label}_count'
+        current_count = self.get(row, count_key)
+        additional_count = result.get(count_key)
+        for key, new_val in result.items():
+            if isinstance(new_val, np.ndarray):
+                #histograms of files of the same label share edges and are added
+                if label not in self.sketches:
+                    self.sketches[label] = np.zeros((len(self.ids), len(new_val)), dtype=np.int64)
+                self.sketches[label][row] += new_val
+                continue
+            self._column(label, key)
+            stat = key[len(label) + 1:]
+            self._set(row, key, merge_stat(stat, self.get(row, key), new_val, current_count, additional_count))
+
+    def basin_stats(self, row):
+        '''
+        Description
+        ---------
+        returns dictionary of stats for a basin in the same format as Stats.basin_stats with id, pfaf_12 and sub_area
+        '''
+        final_basin_stats = {}
+        for label, file_name, evals in self.provenance:
+            if evals[row] > 0:
+                if label not in final_basin_stats:
+                    final_basin_stats[label] = {}
+                    for key, (key_label, is_int, column) in self.columns.items():
+                        if key_label == label:
+                            value = self.get(row, key)
+                            if value is not None or not is_int:
+                                final_basin_stats[label][key] = value
+                    final_basin_stats[label]['src_file'] = []
+                final_basin_stats[label]['src_file'].append({'file_name': file_name, 'bounds_eval': int(evals[row])})
+        final_basin_stats['id'] = int(self.ids[row])
+        final_basin_stats['pfaf_12'] = int(self.pfaf_12[row])
+        final_basin_stats['sub_area'] = float(self.sub_area[row])
+        return final_basin_stats
+
+    def to_records(self):
+        '''
+        Description
+        ---------
+        yields basin stats dictionaries one basin at a time (see basin_stats)
+        '''
+        for row in range(len(self.ids)):
+            yield self.basin_stats(row)
+
+    def to_frame(self):
+        '''
+        Description
+        ---------
+        returns dataframe with one row per basin and one column per stat, same columns as json_stats_to_csv
+        '''
+        df = pd.DataFrame({'hybas_id': self.ids, 'pfaf_12': self.pfaf_12, 'sub_area': self.sub_area})
+        for key, (label, is_int, column) in self.columns.items():
+            if is_int:
+                df[key] = pd.Series(self.counts[:, column]).where(self.counts[:, column] >= 0)
+            else:
+                df[key] = self.values[:, column]
+        return df
+
+
+def write_json(batches, outfile_name):
+    '''
+    Description
+    ---------
+    writes basin stats of result batches to a json file (list of basin dictionaries, see step2_mp_attribution.py)
+    one basin at a time, so dictionaries for all basins are never held in memory at once
+    '''
+    with open(outfile_name, 'w') as outfile:
+        outfile.write('[')
+        first = True
+        for batch in batches:
+            for record in batch.to_records():
+                if not first:
+                    outfile.write(', ')
+                json.dump(record, outfile)
+                first = False
+        outfile.write(']')
+
+
+def write_sketches(batches, json_file_info, outfile_name):
+    '''
+    Description
+    ---------
+    writes basin histograms of result batches to a numpy npz file, for each label f'{label}_ids' (HYBAS_ID),
+    f'{label}_counts' (basins x bins) and f'{label}_edges'.  Nothing is written if no file requests a histogram.
+
+    Parameters
+    ---------
+    batches : list of ResultBatch
+    json_file_info : list of file info dictionaries used for attribution (for bin edges)
+    outfile_name : str, e.g. 'output/tif_hb12_sketch.npz'
+    '''
+    edges = {file['label']: sketch_edges(file) for file in json_file_info if sketch_edges(file) is not None}
+    if not edges:
+        return None
+    arrays = {}
+    for label, label_edges in edges.items():
+        ids = [batch.ids for batch in batches if label in batch.sketches]
+        counts = [batch.sketches[label] for batch in batches if label in batch.sketches]
+        arrays[f'{label}_ids'] = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        arrays[f'{label}_counts'] = np.concatenate(counts) if counts else np.zeros((0, len(label_edges) + 1), dtype=np.int64)
+        arrays[f'{label}_edges'] = label_edges
+    np.savez_compressed(outfile_name, **arrays)
+    return outfile_name
+
+
+def read_sketches(sketch_file, label):
+    '''
+    Description
+    ---------
+    returns ids, counts and edges of basin histograms of a label from write_sketches
+    '''
+    with np.load(sketch_file) as sketches:
+        if f'{label}_counts' not in sketches:
+            raise KeyError(f'{sketch_file} has no histograms for {label}')
+        return sketches[f'{label}_ids'], sketches[f'{label}_counts'], sketches[f'{label}_edges']
+
+
+class StackWindows:
+    def __init__(self, windows):
+        '''
+        Description
+        ---------
+        raster_io.RasterWindow of each epoch of a temporal stack read for one basin (see attribute_chunk)
+        '''
+        self.windows = windows
+
+    @property
+    def nbytes(self):
+        return sum([window.nbytes for window in self.windows if window is not None])
+
+
+def stack_frame(batch, json_file_info):
+    '''
+    Description
+    ---------
+    returns long format stats of temporal stacks for a result batch, one row per basin, stack, epoch and stat
+    with columns hybas_id, variable (stack), epoch, stat and value
+    '''
+    frames = []
+    for stack in file_stacks(json_file_info):
+        for epoch, file_num in zip(stack['epochs'], stack['file_nums']):
+            label = json_file_info[file_num]['label']
+            for key, (key_label, is_int, column) in batch.columns.items():
+                if key_label != label:
+                    continue
+                value = batch.counts[:, column].astype(np.float64) if is_int else batch.values[:, column].astype(np.float64)
+                if is_int:
+                    value[batch.counts[:, column] < 0] = np.nan
+                frames.append(pd.DataFrame({'hybas_id': batch.ids, 'variable': stack['stack'], 'epoch': epoch,
+                                            'stat': key[len(label) + 1:], 'value': value}))
+    if not frames:
+        return pd.DataFrame(columns=['hybas_id', 'variable', 'epoch', 'stat', 'value'])
+    #tiles of a stack on separate grids give rows for the same label, stats are already combined in the batch
+    return pd.concat(frames, ignore_index=True).drop_duplicates(['hybas_id', 'variable', 'epoch', 'stat'])
+
+
+def epoch_changes(df, change='previous'):
+    '''
+    Description
+    ---------
+    adds change columns to long format stack stats (see stack_frame)
+
+    Parameters
+    ---------
+    df : dataframe with hybas_id, variable, epoch, stat and value
+    change : 'previous' compares each epoch to the epoch before it, 'first' compares each epoch to the first epoch
+
+    Output
+    ---------
+    df with change (value - reference value) and change_pct (percent of reference value, NaN when reference is 0)
+    '''
+    if change not in ['previous', 'first']:
+        raise ValueError(f"Unknown change {change}, use 'previous' or 'first'")
+    df = df.assign(_order=[_epoch_key(epoch) for epoch in df['epoch']]).sort_values(['hybas_id', 'variable', 'stat', '_order'])
+    groups = df.groupby(['hybas_id', 'variable', 'stat'], sort=False)['value']
+    reference = groups.shift(1) if change == 'previous' else groups.transform('first')
+    df['change'] = df['value'] - reference
+    df['change_pct'] = (df['change'] / reference.where(reference != 0)) * 100
+    if change == 'first':
+        first = groups.cumcount() == 0
+        df.loc[first, ['change', 'change_pct']] = np.nan
+    return df.drop(columns=['_order']).reset_index(drop=True)
+
+
+def write_stack_table(batches, json_file_info, outfile_name, change=None):
+    '''
+    Description
+    ---------
+    writes long format stats of temporal stacks (see stack_frame) to csv one batch at a time, all epochs of a basin are
+    in the same batch so change columns are computed per batch.  Nothing is written if no file has a stack.
+
+    Parameters
+    ---------
+    batches : list of ResultBatch
+    json_file_info : list of file info dictionaries used for attribution
+    outfile_name : str, e.g. 'output/tif_hb12_stack.csv'
+    change : optional 'previous' or 'first', adds change columns (see epoch_changes)
+    '''
+    if not file_stacks(json_file_info):
+        return None
+    first = True
+    for batch in batches:
+        df = stack_frame(batch, json_file_info)
+        if change:
+            df = epoch_changes(df, change)
+        df.to_csv(outfile_name, sep=',', index=False, mode='w' if first else 'a', header=first)
+        first = False
+    return outfile_name
+
+
+def attribute_chunk(gdf, json_file_info, basin_ids, prefetch_depth=None, io_threads=None, approximate=None, min_pixels=10000):
+    '''
+    Description
+    ---------
+    Attributes a chunk of basins with all files in json_file_info.  Raster windows of upcoming basins are read on
+    background threads while zonal stats run for the current basin (see utils/raster_io.py).
+    Windows of all epochs of a temporal stack (see file_stacks) are read in one request and attributed with one pixel mask.
+
+    Parameters
+    ---------
+    gdf : geodataframe of basins with HYBAS_ID, PFAF_ID, SUB_AREA and geometry
+    json_file_info : list of dictionaries describing files (see run_zonal_stats)
+    basin_ids : list of HYBAS_IDs to process
+    prefetch_depth, io_threads : windows read ahead and reader threads, default to GFF_PREFETCH_DEPTH and GFF_IO_THREADS
+    approximate : optional resolution factor (e.g. 8), rasters are read at 1/approximate resolution from overviews and
+                  count, sum and nodata are scaled to full resolution.  Basins with fewer than min_pixels full resolution
+                  pixels (estimated from polygon area) are read at full resolution.  See approximation_error to estimate the error.
+
+    Output
+    ---------
+    ResultBatch of stats for basins in order of basin_ids (basin dictionaries are available with to_records)
+    '''
+    from utils import raster_io
+    with instr.Timer('select_basin'):
+        chunk_gdf = gdf.loc[gdf['HYBAS_ID'].isin(basin_ids)]
+        positions = pd.Index(chunk_gdf['HYBAS_ID']).get_indexer(basin_ids)
+        #ids not in gdf would get position -1 (geometry of another basin), they are skipped
+        if (positions < 0).any():
+            missing = [basin_id for basin_id, position in zip(basin_ids, positions) if position < 0]
+            print(f'Warning, {len(missing)} HYBAS_IDs are not in basin data and are skipped: {missing[:10]}')
+            basin_ids = [basin_id for basin_id, position in zip(basin_ids, positions) if position >= 0]
+            positions = positions[positions >= 0]
+        basins = []
+        for basin_id, position in zip(basin_ids, positions):
+            basin_info_gdf = chunk_gdf.iloc[[position]]
+            bbox_gdf = basin_info_gdf.bounds
+            basin_info = Stats(basin_id, basin_info_gdf.iloc[0]['PFAF_ID'], float(basin_info_gdf.iloc[0]['SUB_AREA']))
+            basin_info.bounds(bbox_gdf['minx'].iloc[0], bbox_gdf['maxx'].iloc[0], bbox_gdf['miny'].iloc[0], bbox_gdf['maxy'].iloc[0])
+            basins.append((basin_info, basin_info_gdf))
+
+    #files of a temporal stack are one unit, epoch windows of a basin are read together and share one pixel mask
+    stacks = file_stacks(json_file_info)
+    stacked = set([file_num for stack in stacks for file_num in stack['file_nums']])
+    units = [[file_num] for file_num in range(len(json_file_info)) if file_num not in stacked] + [stack['file_nums'] for stack in stacks]
+
+    #bounds are evaluated up front so reader threads do not change basin objects used by computation
+    requests = []
+    for basin_num, (basin_info, basin_info_gdf) in enumerate(basins):
+        for unit_num, unit in enumerate(units):
+            basin_info.evaluate_intersection(json_file_info[unit[0]]['bounds'])
+            requests.append((basin_num, unit_num, basin_info.bounds_eval))
+
+    #stack windows are always read with value rules so windows extending past the raster edge are read too
+    file_rules = [raster_io.ValueRules.from_file_info(file) for file in json_file_info]
+    for file_num in stacked:
+        file_rules[file_num] = file_rules[file_num] or raster_io.ValueRules()
+
+    #basin pixel counts for the min_pixels threshold of approximate mode come from polygon area, not the bounding box
+    areas = [float(basin_info_gdf.geometry.iloc[0].area) if approximate else None for basin_info, basin_info_gdf in basins]
+
+    def read_file(basin_num, file_num):
+        basin_info = basins[basin_num][0]
+        return raster_io.read_window(raster_io.source_path(json_file_info[file_num]), basin_info.xmin, basin_info.xmax, basin_info.ymin, basin_info.ymax,
+                                     rules=file_rules[file_num], factor=approximate or 1, min_pixels=min_pixels, area=areas[basin_num])
+
+    def read(request):
+        basin_num, unit_num, bounds_eval = request
+        if bounds_eval == 0:
+            return None
+        if len(units[unit_num]) == 1 and units[unit_num][0] not in stacked:
+            return read_file(basin_num, units[unit_num][0])
+        return StackWindows([read_file(basin_num, file_num) for file_num in units[unit_num]])
+
+    batch = ResultBatch([b.id for b, g in basins], [b.pfaf_12 for b, g in basins], [b.sub_area for b, g in basins])
+    file_provenance = [batch.add_file(file['label'], file['file_name']) for file in json_file_info]
+    for (basin_num, unit_num, bounds_eval), window in raster_io.WindowPrefetcher(requests, read, prefetch_depth, io_threads):
+        basin_info, basin_info_gdf = basins[basin_num]
+        with instr.Timer('compute'):
+            basin_info.bounds_eval = bounds_eval
+            if isinstance(window, StackWindows):
+                files = [json_file_info[file_num] for file_num in units[unit_num]]
+                results = basin_info.stack_stats(basin_info_gdf, files, window.windows)
+                for file_num, file, result in zip(units[unit_num], files, results or []):
+                    batch.add(basin_num, file['label'], result, file_provenance[file_num], bounds_eval)
+                continue
+            file_num = units[unit_num][0]
+            file = json_file_info[file_num]
+            result = basin_info.zonal_stats(basin_info_gdf, file, window)
+            if result is not None:
+                batch.add(basin_num, file['label'], result, file_provenance[file_num], bounds_eval)
+
+    processed = np.zeros(len(batch), dtype=bool)
+    for label, file_name, evals in batch.provenance:
+        processed |= evals > 0
+    processed = int(processed.sum())
+    instr.count('basins_processed', processed)
+    instr.count('basins_skipped', len(batch) - processed)
+    return batch
+
+
+def approximation_error(gdf, json_file_info, basin_ids, approximate, n_sample=200, seed=0, min_pixels=10000, outfile_name=None):
+    '''
+    Description
+    ---------
+    estimates error of approximate mode (see attribute_chunk) by attributing a random sample of basins at full
+    resolution and at the approximate resolution
+
+    Parameters
+    ---------
+    gdf : geodataframe of basins with HYBAS_ID, PFAF_ID, SUB_AREA and geometry
+    json_file_info : list of dictionaries describing files
+    basin_ids : list of HYBAS_IDs to sample from
+    approximate : resolution factor used in approximate mode
+    n_sample : number of basins sampled
+    seed : random seed, so reports can be repeated
+    min_pixels : see attribute_chunk
+    outfile_name : optional csv path for the report
+
+    Output
+    ---------
+    report : dataframe with one row per stat column, n basins compared, mean absolute error, mean and 95th percentile
+             of relative error (absolute error / abs(full resolution value), basins with value 0 are excluded)
+    '''
+    rng = np.random.default_rng(seed)
+    sample = list(rng.choice(np.asarray(basin_ids), size=min(n_sample, len(basin_ids)), replace=False))
+    full = attribute_chunk(gdf, json_file_info, sample).to_frame().set_index('hybas_id')
+    approx = attribute_chunk(gdf, json_file_info, sample, approximate=approximate, min_pixels=min_pixels).to_frame().set_index('hybas_id')
+    rows = []
+    for column in full.columns:
+        if column in ['pfaf_12', 'sub_area'] or column not in approx.columns:
+            continue
+        compare = pd.DataFrame({'full': full[column], 'approx': approx[column]}).dropna()
+        abs_error = (compare['approx'] - compare['full']).abs()
+        nonzero = compare['full'] != 0
+        rel_error = abs_error[nonzero] / compare['full'][nonzero].abs()
+        rows.append({'stat': column, 'n_basins': len(compare), 'mean_abs_error': abs_error.mean(),
+                     'mean_rel_error': rel_error.mean() if len(rel_error) else np.nan,
+                     'p95_rel_error': rel_error.quantile(0.95) if len(rel_error) else np.nan})
+    report = pd.DataFrame(rows, columns=['stat', 'n_basins', 'mean_abs_error', 'mean_rel_error', 'p95_rel_error'])
+    report['approximate'] = approximate
+    if outfile_name:
+        report.to_csv(outfile_name, sep=',', index=False)
+    return report
+
+
 def json_stats_to_csv(json_data, outfile_name, pfaf_field_nm = 'pfaf_12'):
     list_info = []
     for record in json_data:
@@ -199,7 +1014,7 @@ def json_stats_to_csv(json_data, outfile_name, pfaf_field_nm = 'pfaf_12'):
             if stat != 'id' and stat != pfaf_field_nm and stat != 'sub_area':
                 # for each stat grab column name = key and value = value
                 for key, value in record[stat].items():
-                    if stat in key.lower() and value is not None:
+                    if stat in key.lower() and value is not None and not isinstance(value, list):
                         info[key] = value
         list_info.append(info) 
     df = pd.DataFrame(list_info)
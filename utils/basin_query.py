@@ -0,0 +1,401 @@
+#Import packages
+import os
+import json
+import time
+import threading
+import urllib.parse
+import urllib.request
+import numpy as np
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from utils import file_management as f_mng
+from utils import flow_graph
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    local query server for basin, upstream, downstream and pfaf prefix lookups.  The basin table, network index and
+    attribution tables (csv outputs, e.g. from attribution.json_stats_to_csv or point_attribution) are loaded once and
+    held in memory, so lookups like "stats for HYBAS_ID X and everything upstream" take milliseconds instead of
+    reopening the network hdf file and unpickling the basin table for every call.
+
+    Upstream basins of every basin are one contiguous range of an Euler tour of the network (FlowGraph.upstream_ranges),
+    upstream sums and means come from running sums over the tour, so their cost does not depend on the number of
+    upstream basins.
+
+    The server listens on localhost only (HTTP, JSON responses), start it with basin_query_server.py.
+        GET  /basin?ids=1,2&columns=a,b
+        GET  /upstream?id=1&columns=a,b&stat=sum&ids=1       (stat: sum, mean (area weighted), min, max; ids=1 lists ids)
+        GET  /downstream?id=1&columns=a,b&stat=sum&ids=1
+        GET  /pfaf?prefix=1234&columns=a,b&stat=sum&ids=1
+        GET  /health
+        POST /batch   body: list of queries, e.g. [{"query": "upstream", "id": 1, "columns": ["a"]}]
+        POST /reload  reloads basin and attribution tables, queries keep being answered from old data until done
+
+    Example
+    ---------
+    client = basin_query.QueryClient()
+    client.upstream(1120020010, columns=['crop_mean'], stat='mean')
+'''
+
+QUERIES = ['basin', 'upstream', 'downstream', 'pfaf']
+STATS = ['sum', 'mean', 'min', 'max']
+ID_COLUMNS = ['HYBAS_ID', 'hybas_id', 'id']
+
+
+def _clean(value):
+    #json has no nan, numpy values are converted to python values
+    if isinstance(value, dict):
+        return {key: _clean(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_clean(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def read_table(csv_file):
+    '''
+    Description
+    ---------
+    reads an attribution csv indexed by HYBAS_ID (id column HYBAS_ID, hybas_id or id), only numeric columns are kept
+    '''
+    df = pd.read_csv(csv_file)
+    id_col = next((col for col in ID_COLUMNS if col in df.columns), None)
+    if id_col is None:
+        raise ValueError(f'{csv_file} has no id column, expected one of {ID_COLUMNS}')
+    df = df.drop(columns=[col for col in df.columns if col.startswith('Unnamed')])
+    df = df.set_index(df[id_col].astype(np.int64)).drop(columns=[id_col])
+    return df.select_dtypes(include='number')
+
+
+class BasinQueryData:
+    def __init__(self, basin_df, tables=None):
+        '''
+        Description
+        ---------
+        In memory basin table, network index and attribution columns answering queries
+
+        Parameters
+        ---------
+        basin_df: HydroBASINS level 12 attributes (e.g. f_mng.load_basin_df())
+        tables: list of attribution csv files joined to basins by HYBAS_ID
+        '''
+        start = time.perf_counter()
+        self.graph = flow_graph.FlowGraph.from_basin_df(basin_df, dist_col=None)
+        self.order, self.start, self.size = self.graph.upstream_ranges()
+        table = basin_df.set_index('HYBAS_ID').reindex(self.graph.hybas_ids)
+        self.tables = list(tables or [])
+        for csv_file in self.tables:
+            extra = read_table(csv_file)
+            duplicates = [col for col in extra.columns if col in table.columns]
+            if duplicates:
+                print(f'Warning, columns {duplicates} of {csv_file} are already loaded and are skipped')
+            table = table.join(extra.drop(columns=duplicates))
+        self.table = table.select_dtypes(include='number')
+        self.pfaf_order = np.argsort(self.table['PFAF_ID'].to_numpy(dtype=np.int64), kind='stable')
+        self.pfaf_sorted = self.table['PFAF_ID'].to_numpy(dtype=np.int64)[self.pfaf_order]
+        self.pfaf_digits = len(str(int(self.pfaf_sorted.max()))) if len(self.pfaf_sorted) else 12
+        self.area = self.table['SUB_AREA'].to_numpy(dtype=np.float64) if 'SUB_AREA' in self.table.columns else None
+        #running sums over the Euler tour per column, built when a column is first queried
+        self._tour_sums = {}
+        self._lock = threading.Lock()
+        self.loaded = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.load_seconds = time.perf_counter() - start
+
+    def _columns(self, columns):
+        if columns is None:
+            return []
+        if isinstance(columns, str):
+            columns = [col for col in columns.split(',') if col]
+        missing = [col for col in columns if col not in self.table.columns]
+        if missing:
+            raise KeyError(f'Unknown columns {missing}')
+        return list(columns)
+
+    def _position(self, basin_id):
+        position = int(self.graph.positions([int(basin_id)])[0])
+        if position < 0:
+            raise KeyError(f'Unknown HYBAS_ID {basin_id}')
+        return position
+
+    def _tour_sum(self, column, weighted):
+        key = (column, weighted)
+        if key not in self._tour_sums:
+            values = self.table[column].to_numpy(dtype=np.float64)
+            valid = ~np.isnan(values)
+            weight = self.area if weighted and self.area is not None else np.ones(self.graph.n)
+            values = np.where(valid, values * weight, 0.0)[self.order]
+            weight = np.where(valid, weight, 0.0)[self.order]
+            sums = (np.r_[0.0, np.cumsum(values)], np.r_[0.0, np.cumsum(weight)])
+            with self._lock:
+                self._tour_sums[key] = sums
+        return self._tour_sums[key]
+
+    def _summarize(self, positions, columns, stat):
+        if stat not in STATS:
+            raise ValueError(f'Unknown stat {stat}, use one of {STATS}')
+        stats = {}
+        for column in columns:
+            values = self.table[column].to_numpy(dtype=np.float64)[positions]
+            valid = ~np.isnan(values)
+            if not valid.any():
+                stats[column] = None
+            elif stat == 'sum':
+                stats[column] = float(values[valid].sum())
+            elif stat == 'mean':
+                weight = self.area[positions][valid] if self.area is not None else np.ones(valid.sum())
+                stats[column] = float((values[valid] * weight).sum() / weight.sum()) if weight.sum() > 0 else None
+            else:
+                stats[column] = float(values[valid].min() if stat == 'min' else values[valid].max())
+        return stats
+
+    def basin(self, ids, columns=None):
+        '''
+        Description
+        ---------
+        returns rows of basin and attribution tables for ids (all columns if columns is None), unknown ids are listed as missing
+        '''
+        if isinstance(ids, (str, int, np.integer)):
+            ids = [int(i) for i in str(ids).split(',') if i]
+        positions = self.graph.positions([int(i) for i in ids])
+        columns = self._columns(columns) or list(self.table.columns)
+        rows = self.table.iloc[positions[positions >= 0]][columns]
+        records = [dict(HYBAS_ID=int(basin_id), **row) for basin_id, row in zip(rows.index, rows.to_dict('records'))]
+        return {'basins': records, 'missing': [int(i) for i, p in zip(ids, positions) if p < 0]}
+
+    def upstream(self, basin_id, columns=None, stat='sum', ids=False):
+        '''
+        Description
+        ---------
+        summarizes columns over a basin and all basins upstream of it, sums and means use running sums over the tour
+        '''
+        position = self._position(basin_id)
+        first, stop = int(self.start[position]), int(self.start[position] + self.size[position])
+        result = {'HYBAS_ID': int(basin_id), 'n_basins': stop - first, 'stat': stat, 'stats': {}}
+        columns = self._columns(columns)
+        if stat in ['sum', 'mean']:
+            for column in columns:
+                values, weight = self._tour_sum(column, stat == 'mean')
+                total, total_weight = values[stop] - values[first], weight[stop] - weight[first]
+                if total_weight <= 0:
+                    result['stats'][column] = None
+                else:
+                    result['stats'][column] = float(total) if stat == 'sum' else float(total / total_weight)
+        else:
+            result['stats'] = self._summarize(self.order[first:stop], columns, stat)
+        if ids:
+            result['ids'] = self.graph.hybas_ids[self.order[first:stop]].tolist()
+        return result
+
+    def downstream(self, basin_id, columns=None, stat='sum', ids=False):
+        '''
+        Description
+        ---------
+        summarizes columns over a basin and all basins between it and its ocean outlet or sink
+        '''
+        path = [self._position(basin_id)]
+        while self.graph.down[path[-1]] >= 0:
+            path.append(int(self.graph.down[path[-1]]))
+        result = {'HYBAS_ID': int(basin_id), 'n_basins': len(path), 'stat': stat,
+                  'stats': self._summarize(np.array(path), self._columns(columns), stat)}
+        if ids:
+            result['ids'] = self.graph.hybas_ids[path].tolist()
+        return result
+
+    def pfaf(self, prefix, columns=None, stat='sum', ids=False):
+        '''
+        Description
+        ---------
+        summarizes columns over level 12 basins with PFAF_ID starting with prefix (e.g. 1234 for a level 4 basin)
+        '''
+        prefix = str(prefix)
+        scale = 10 ** (self.pfaf_digits - len(prefix))
+        first, stop = np.searchsorted(self.pfaf_sorted, [int(prefix) * scale, (int(prefix) + 1) * scale])
+        positions = self.pfaf_order[first:stop]
+        result = {'pfaf_prefix': prefix, 'n_basins': int(len(positions)), 'stat': stat,
+                  'stats': self._summarize(positions, self._columns(columns), stat)}
+        if ids:
+            result['ids'] = self.graph.hybas_ids[positions].tolist()
+        return result
+
+    def query(self, request):
+        '''
+        Description
+        ---------
+        answers one query dictionary, e.g. {'query': 'upstream', 'id': 1, 'columns': ['a'], 'stat': 'sum'}.
+        Errors (e.g. unknown ids) are returned as {'error': message} so one bad query does not fail a batch.
+        '''
+        request = dict(request)
+        name = request.pop('query', None)
+        try:
+            if name == 'basin':
+                return _clean(self.basin(request.get('ids', request.get('id', [])), request.get('columns')))
+            if name in ['upstream', 'downstream', 'pfaf']:
+                key = 'prefix' if name == 'pfaf' else 'id'
+                ids = str(request.get('ids', False)).lower() in ['1', 'true']
+                return _clean(getattr(self, name)(request[key], request.get('columns'), request.get('stat', 'sum'), ids))
+            return {'error': f'Unknown query {name}, use one of {QUERIES}'}
+        except (KeyError, ValueError) as error:
+            return {'error': str(error).strip('"\'')}
+
+
+def load_query_data(tables=None, basin_file=None):
+    '''
+    Description
+    ---------
+    loads basin table (file_management.load_basin_df) and attribution csv files into BasinQueryData
+    '''
+    return BasinQueryData(f_mng.load_basin_df(basin_file), tables)
+
+
+class QueryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, loader, host='127.0.0.1', port=8765):
+        '''
+        Description
+        ---------
+        threaded HTTP server answering queries from data returned by loader
+
+        Parameters
+        ---------
+        loader: function returning BasinQueryData, called at start and on /reload
+        host: str, keep 127.0.0.1 so the server is only reachable from this machine
+        port: int
+        '''
+        self.loader = loader
+        self.data = loader()
+        self._reload_lock = threading.Lock()
+        super().__init__((host, port), QueryHandler)
+
+    def reload(self):
+        #new data is loaded while queries are answered from the old data, then swapped in one assignment
+        with self._reload_lock:
+            self.data = self.loader()
+        return {'reloaded': self.data.loaded, 'load_seconds': round(self.data.load_seconds, 3)}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, body, status=200):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        name = url.path.strip('/')
+        request = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        if name == 'health':
+            data = self.server.data
+            return self._send({'n_basins': data.graph.n, 'columns': list(data.table.columns), 'tables': data.tables,
+                               'loaded': data.loaded})
+        result = self.server.data.query(dict(request, query=name))
+        self._send(result, 400 if 'error' in result else 200)
+
+    def do_POST(self):
+        name = urllib.parse.urlparse(self.path).path.strip('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null') if length else None
+        if name == 'reload':
+            return self._send(self.server.reload())
+        if name == 'batch':
+            if not isinstance(body, list):
+                return self._send({'error': 'batch body must be a list of queries'}, 400)
+            data = self.server.data
+            return self._send([data.query(request) for request in body])
+        self._send({'error': f'Unknown request {name}'}, 404)
+
+    def log_message(self, format, *args):
+        #one line per request is too much for batch runs of many lookups
+        if os.environ.get('GFF_QUERY_LOG'):
+            super().log_message(format, *args)
+
+
+def serve(tables=None, basin_file=None, host='127.0.0.1', port=8765):
+    '''
+    Description
+    ---------
+    loads data and answers queries until interrupted (see basin_query_server.py)
+    '''
+    server = QueryServer(lambda: load_query_data(tables, basin_file), host, port)
+    print(f'Basin query server loaded {server.data.graph.n} basins in {server.data.load_seconds:.1f} s, '
+          f'listening on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class QueryClient:
+    def __init__(self, url='http://127.0.0.1:8765', timeout=60):
+        '''
+        Description
+        ---------
+        Python client of the basin query server, returns decoded json responses
+
+        Parameters
+        ---------
+        url: str, server address
+        timeout: seconds to wait for a response
+        '''
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, params=None, body=None):
+        params = {key: ','.join(map(str, value)) if isinstance(value, (list, tuple)) else value
+                  for key, value in (params or {}).items() if value is not None}
+        url = f'{self.url}/{path}' + (f'?{urllib.parse.urlencode(params)}' if params else '')
+        data = json.dumps(body).encode() if body is not None else (b'' if path in ['batch', 'reload'] else None)
+        request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            return json.loads(error.read())
+
+    def health(self):
+        return self._request('health')
+
+    def basin(self, ids, columns=None):
+        return self._request('basin', {'ids': ids if isinstance(ids, (list, tuple)) else [ids], 'columns': columns})
+
+    def upstream(self, basin_id, columns=None, stat='sum', ids=False):
+        return self._request('upstream', {'id': basin_id, 'columns': columns, 'stat': stat, 'ids': int(ids)})
+
+    def downstream(self, basin_id, columns=None, stat='sum', ids=False):
+        return self._request('downstream', {'id': basin_id, 'columns': columns, 'stat': stat, 'ids': int(ids)})
+
+    def pfaf(self, prefix, columns=None, stat='sum', ids=False):
+        return self._request('pfaf', {'prefix': prefix, 'columns': columns, 'stat': stat, 'ids': int(ids)})
+
+    def batch(self, requests):
+        '''
+        Description
+        ---------
+        answers a list of query dictionaries in one request, e.g. [{'query': 'upstream', 'id': 1, 'columns': ['a']}]
+        '''
+        return self._request('batch', body=list(requests))
+
+    def reload(self):
+        return self._request('reload')
+
+
+############################################################################################
+############################################################################################
@@ -0,0 +1,291 @@
+#Import packages
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    partitioned basin store replacing whole-file pickles of HydroBASINS data.  Basins are written once from the
+    HydroBASINS shapefiles, partitioned by region and pfaf prefix (default first 2 digits of PFAF_ID).
+    For each partition attribute columns and geometry (WKB) are stored in separate files so attribute only reads never
+    touch geometry, and geometry is only decoded for the rows that are requested.  A global index sorted by HYBAS_ID
+    gives O(log n) lookup of the partition and row of any basin.
+
+    Layout (store_dir/lvl{level}):
+        partitions.json                 -> list of partitions with region, pfaf prefix, file names and number of basins
+        index.npz                       -> sorted HYBAS_IDs with partition number and row of each basin
+        {region}_{prefix}_attrs.pkl     -> dataframe of attributes sorted by HYBAS_ID
+        {region}_{prefix}_geom.pkl      -> numpy object array of WKB geometry in the same row order as attributes
+'''
+
+
+def write_partitions(regional_gdf, region, level_dir, partition_level=2):
+    '''
+    Description
+    ---------
+    writes attribute and geometry partitions for one region
+
+    Parameters
+    ---------
+    regional_gdf: geodataframe of HydroBASINS for one region (e.g. hybas_af_lev12_v1c.shp)
+    region: str, region code (e.g. 'af')
+    level_dir: str, directory of store for the basin level
+    partition_level: int, number of leading PFAF_ID digits used to partition
+
+    Output
+    ---------
+    partitions: list of dictionaries describing partitions written
+    '''
+    pfaf_str = regional_gdf['PFAF_ID'].astype('int64').astype(str)
+    partitions = []
+    for prefix, rows in regional_gdf.groupby(pfaf_str.str[:partition_level]):
+        rows = rows.sort_values('HYBAS_ID')
+        name = f'{region}_{prefix}'
+        attrs = pd.DataFrame(rows.drop(columns=['geometry'])).reset_index(drop=True)
+        geom = np.array(rows.geometry.to_wkb(), dtype=object)
+        attrs.to_pickle(os.path.join(level_dir, f'{name}_attrs.pkl'))
+        pd.to_pickle(geom, os.path.join(level_dir, f'{name}_geom.pkl'))
+        partitions.append({'name': name, 'region': region, 'pfaf_prefix': prefix, 'n_basins': len(attrs),
+                           'bounds': [float(x) for x in rows.total_bounds]})
+    return partitions
+
+
+def write_basin_store(regional_gdfs, store_dir='data/basin_store', level='12', partition_level=2):
+    '''
+    Description
+    ---------
+    writes basin store from regional geodataframes, regions are handled one at a time so global geometry is never concatenated
+
+    Parameters
+    ---------
+    regional_gdfs: iterable of (region, geodataframe) tuples, geodataframes can be read lazily (e.g. generator)
+    store_dir: str, directory of store
+    level: str, HydroBASINS pfaf level of basins
+    partition_level: int, number of leading PFAF_ID digits used to partition
+
+    Output
+    ---------
+    store files (see module description)
+    '''
+    level_dir = os.path.join(store_dir, f'lvl{level}')
+    os.makedirs(level_dir, exist_ok=True)
+    partitions = []
+    for region, regional_gdf in regional_gdfs:
+        partitions += write_partitions(regional_gdf, region, level_dir, partition_level)
+    write_store_index(partitions, level_dir, level, partition_level)
+
+
+def write_store_index(partitions, level_dir, level='12', partition_level=2):
+    '''
+    Description
+    ---------
+    writes HYBAS_ID index and partitions.json after all partitions are written (see write_partitions)
+    '''
+    #build index from attributes only
+    ids = []
+    part_nums = []
+    rows = []
+    for part_num, partition in enumerate(partitions):
+        part_ids = pd.read_pickle(os.path.join(level_dir, f"{partition['name']}_attrs.pkl"))['HYBAS_ID'].to_numpy(dtype=np.int64)
+        ids.append(part_ids)
+        part_nums.append(np.full(len(part_ids), part_num, dtype=np.int32))
+        rows.append(np.arange(len(part_ids), dtype=np.int32))
+    ids = np.concatenate(ids) if ids else np.array([], dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    np.savez(os.path.join(level_dir, 'index.npz'), hybas_id=ids[order],
+             partition=np.concatenate(part_nums)[order] if part_nums else np.array([], dtype=np.int32),
+             row=np.concatenate(rows)[order] if rows else np.array([], dtype=np.int32))
+    with open(os.path.join(level_dir, 'partitions.json'), 'w') as outfile:
+        json.dump({'level': str(level), 'partition_level': int(partition_level), 'crs': 'EPSG:4326', 'partitions': partitions}, outfile, indent=1)
+
+
+def store_exists(store_dir='data/basin_store', level='12'):
+    return os.path.exists(os.path.join(store_dir, f'lvl{level}', 'partitions.json'))
+
+
+class BasinStore:
+    def __init__(self, store_dir='data/basin_store', level='12', cache_partitions=8):
+        '''
+        Description
+        ---------
+        Reads basin attributes and geometry from the basin store
+
+        Parameters
+        ---------
+        store_dir: str, directory of store
+        level: str, HydroBASINS pfaf level of basins
+        cache_partitions: number of attribute partitions kept in memory after being read
+        '''
+        self.level_dir = os.path.join(store_dir, f'lvl{level}')
+        with open(os.path.join(self.level_dir, 'partitions.json'), 'r') as infile:
+            meta = json.load(infile)
+        self.partition_level = meta['partition_level']
+        self.crs = meta['crs']
+        self.partitions = meta['partitions']
+        self.cache_partitions = cache_partitions
+        self._attrs_cache = {}
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            with np.load(os.path.join(self.level_dir, 'index.npz')) as index:
+                self._index = {key: index[key] for key in index.files}
+        return self._index
+
+    def select_partitions(self, region=None, pfaf_prefix=None):
+        '''
+        Description
+        ---------
+        returns partitions (list of dictionaries) matching region and pfaf prefix filters
+        region can be a str or list of str, pfaf_prefix a str or int of any length (e.g. '1', '12', '1234')
+        '''
+        if isinstance(region, str):
+            region = [region]
+        selected = []
+        for partition in self.partitions:
+            if region is not None and partition['region'] not in region:
+                continue
+            if pfaf_prefix is not None:
+                prefix = str(pfaf_prefix)
+                part_prefix = partition['pfaf_prefix']
+                if not (part_prefix.startswith(prefix) or prefix.startswith(part_prefix)):
+                    continue
+            selected.append(partition)
+        return selected
+
+    def _attrs(self, name):
+        if name not in self._attrs_cache:
+            if len(self._attrs_cache) >= self.cache_partitions:
+                self._attrs_cache.pop(next(iter(self._attrs_cache)))
+            self._attrs_cache[name] = pd.read_pickle(os.path.join(self.level_dir, f'{name}_attrs.pkl'))
+        return self._attrs_cache[name]
+
+    def _wkb(self, name):
+        return pd.read_pickle(os.path.join(self.level_dir, f'{name}_geom.pkl'))
+
+    def _prefix_mask(self, attrs, pfaf_prefix):
+        prefix = str(pfaf_prefix)
+        if len(prefix) <= self.partition_level:
+            return None
+        return attrs['PFAF_ID'].astype('int64').astype(str).str.startswith(prefix).to_numpy()
+
+    def read_df(self, region=None, pfaf_prefix=None, columns=None):
+        '''
+        Description
+        ---------
+        returns dataframe of basin attributes (no geometry) for basins matching region and pfaf prefix filters
+        columns: optional list of columns to return
+        '''
+        frames = []
+        for partition in self.select_partitions(region, pfaf_prefix):
+            attrs = self._attrs(partition['name'])
+            if pfaf_prefix is not None:
+                mask = self._prefix_mask(attrs, pfaf_prefix)
+                if mask is not None:
+                    attrs = attrs[mask]
+            frames.append(attrs if columns is None else attrs[columns])
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def read_gdf(self, region=None, pfaf_prefix=None, columns=None):
+        '''
+        Description
+        ---------
+        returns geodataframe of basins matching region and pfaf prefix filters, geometry is decoded only for returned rows
+        columns: optional list of attribute columns to return with geometry
+        '''
+        import geopandas as gpd
+        frames = []
+        for partition in self.select_partitions(region, pfaf_prefix):
+            attrs = self._attrs(partition['name'])
+            wkb = self._wkb(partition['name'])
+            if pfaf_prefix is not None:
+                mask = self._prefix_mask(attrs, pfaf_prefix)
+                if mask is not None:
+                    attrs = attrs[mask]
+                    wkb = wkb[mask]
+            if columns is not None:
+                attrs = attrs[columns]
+            frames.append(gpd.GeoDataFrame(attrs.reset_index(drop=True), geometry=gpd.GeoSeries.from_wkb(wkb), crs=self.crs))
+        if not frames:
+            return gpd.GeoDataFrame(columns=(columns or []) + ['geometry'], geometry='geometry', crs=self.crs)
+        return gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), geometry='geometry', crs=self.crs)
+
+    def iter_partitions(self, region=None, pfaf_prefix=None, columns=None, geometry=True):
+        '''
+        Description
+        ---------
+        yields (partition dictionary, dataframe or geodataframe) one partition at a time, memory is bounded by partition size
+        '''
+        for partition in self.select_partitions(region, pfaf_prefix):
+            if geometry:
+                yield partition, self.read_gdf(partition['region'], partition['pfaf_prefix'], columns)
+            else:
+                yield partition, self.read_df(partition['region'], partition['pfaf_prefix'], columns)
+
+    def locate(self, hybas_ids):
+        '''
+        Description
+        ---------
+        binary search of index for HYBAS_IDs, returns arrays of partition number and row (-1 if id is not in store)
+        '''
+        hybas_ids = np.atleast_1d(np.asarray(hybas_ids, dtype=np.int64))
+        index_ids = self.index['hybas_id']
+        pos = np.searchsorted(index_ids, hybas_ids)
+        pos_clipped = np.minimum(pos, len(index_ids) - 1)
+        found = (len(index_ids) > 0) & (index_ids[pos_clipped] == hybas_ids)
+        part = np.where(found, self.index['partition'][pos_clipped], -1)
+        row = np.where(found, self.index['row'][pos_clipped], -1)
+        return part, row
+
+    def lookup(self, hybas_ids, columns=None):
+        '''
+        Description
+        ---------
+        returns attribute rows for HYBAS_IDs (in order supplied), ids not in store are dropped
+        '''
+        hybas_ids = np.atleast_1d(np.asarray(hybas_ids, dtype=np.int64))
+        part, row = self.locate(hybas_ids)
+        frames = []
+        positions = []
+        for part_num in np.unique(part[part >= 0]):
+            selected = np.nonzero(part == part_num)[0]
+            attrs = self._attrs(self.partitions[part_num]['name'])
+            sub = attrs.iloc[row[selected]]
+            frames.append(sub if columns is None else sub[columns])
+            positions.append(selected)
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        df = pd.concat(frames, ignore_index=True)
+        return df.iloc[np.argsort(np.concatenate(positions), kind='stable')].reset_index(drop=True)
+
+    def geometry(self, hybas_ids):
+        '''
+        Description
+        ---------
+        returns GeoSeries of geometry for HYBAS_IDs indexed by HYBAS_ID, only requested geometries are decoded
+        '''
+        import geopandas as gpd
+        hybas_ids = np.atleast_1d(np.asarray(hybas_ids, dtype=np.int64))
+        part, row = self.locate(hybas_ids)
+        wkb = np.empty(len(hybas_ids), dtype=object)
+        for part_num in np.unique(part[part >= 0]):
+            selected = part == part_num
+            wkb[selected] = self._wkb(self.partitions[part_num]['name'])[row[selected]]
+        found = part >= 0
+        return gpd.GeoSeries.from_wkb(wkb[found], index=hybas_ids[found], crs=self.crs)
+
+
+############################################################################################
+############################################################################################
@@ -1,6 +1,18 @@
+import os
+import heapq
+import hashlib
 import numpy as np
 import pandas as pd
 import h5py
+from utils import executor
+from utils import flow_graph
+from utils import memory
+
+
+#group of the network hdf file holding a hash of each drainage system (see update_network), not a basin id
+SYSTEMS_GROUP = '_systems'
+#columns of up_seg_df written to the network, a change in any of them changes the system hash
+HASH_COLUMNS = ['seg_id', 'upseg_id', 'PFAF_ID', 'SUB_AREA', 'UP_AREA', 'ORDER']
 
 
 #Stream Segment Class
@@ -84,9 +96,9 @@ def upstream_build_network(traverse_queue,hdf_name):
     while traverse_queue_indx < len(traverse_queue):
         seg = traverse_queue[traverse_queue_indx]
         traverse_queue_indx += 1
-        my_id=np.int(seg.seg_id)
-        my_pfaf_id=np.int(seg.pfaf_id)
-        my_order = np.int(seg.order)
+        my_id=np.int64(seg.seg_id)
+        my_pfaf_id=np.int64(seg.pfaf_id)
+        my_order = np.int64(seg.order)
         my_area=np.float32(seg.area_sqkm)
         my_tot_area=np.float32(seg.tot_area_sqkm)
         tmp = [t for t in seg.all_parents.values()]
@@ -105,7 +117,7 @@ def upstream_build_network(traverse_queue,hdf_name):
         grp.create_dataset('order',data=my_order)
         # If the segment has no parent, write an empty dataset (Makes read in easier)
         if (len(tmp) > 0):
-            my_parents=np.zeros(len(p_tmp),dtype=np.int)+p_tmp
+            my_parents=np.zeros(len(p_tmp),dtype=np.int64)+p_tmp
             #Compression is effective when there are over 256 parents, only compress when effective
             if (my_parents.size > 256):
                 # Write the parent IDs using GZIP compression and Byte order shuffling
@@ -131,3 +143,312 @@ def upstream_build_network(traverse_queue,hdf_name):
         seg.parents = None 
         
     f.close()
+
+
+def drainage_systems(all_data):
+    '''
+    Description
+    ---------
+    returns HYBAS_ID of the outlet (ocean outlet or endorheic sink, ENDO == 2) of the drainage system of each basin.
+    Drainage systems share no edges, so their upstream networks can be built independently.
+
+    Parameters
+    ---------
+    all_data: dataframe of level 12 basins with HYBAS_ID, NEXT_DOWN and ENDO
+    '''
+    graph = flow_graph.FlowGraph.from_basin_df(all_data, dist_col=None)
+    index = flow_graph.DownstreamIndex(graph)
+    positions = np.arange(graph.n)
+    outlets = graph.hybas_ids[index.kth_ancestor(positions, index.depth)]
+    return pd.Series(outlets, index=graph.hybas_ids).reindex(all_data['HYBAS_ID'].to_numpy()).to_numpy()
+
+
+def prep_up_seg_df(all_data):
+    '''
+    Description
+    ---------
+    converts level 12 basin attributes (NEXT_DOWN) to the seg_id/upseg_id table used by upstream_setup, same steps as
+    step4_build_upstream_network.ipynb.  Adds system_id (see drainage_systems) so drainage systems can be built separately.
+
+    Parameters
+    ---------
+    all_data: dataframe of level 12 basins (e.g. f_mng.read_pkl_df('data/basins_lvl12_df.pkl'))
+
+    Output
+    ---------
+    up_seg_df: dataframe with seg_id, upseg_id, PFAF_ID, SUB_AREA, UP_AREA, ORDER and system_id
+    '''
+    all_data = all_data[['HYBAS_ID', 'NEXT_DOWN', 'ENDO', 'PFAF_ID', 'SUB_AREA', 'UP_AREA', 'ORDER']].copy()
+    all_data['system_id'] = drainage_systems(all_data)
+    #set segment_id to 0 if endo sink (we don't want to connect to rest of network), or next down if not endo sink
+    all_data['temp_seg_id'] = np.where(all_data['ENDO']==2, 0, all_data['NEXT_DOWN'])
+    seg_ids = all_data[['temp_seg_id','HYBAS_ID']]
+    seg_ids = seg_ids.rename(columns={'temp_seg_id':'seg_id','HYBAS_ID':'upseg_id'})
+    #merge data with itself to create up_seg dataframe from next_down (reverse from seg, down_seg to seg_upseg)
+    up_seg_df = pd.merge(all_data, seg_ids, left_on='HYBAS_ID', right_on='seg_id', how='left')
+    #if no value for seg_id, these are headwaters, fill nan with HyBas_ID and upseg_id = 0 (no upstream basin)
+    values = {'seg_id': up_seg_df['HYBAS_ID'], 'upseg_id': 0}
+    up_seg_df = up_seg_df.fillna(value=values)
+    return up_seg_df.drop(columns=['HYBAS_ID','NEXT_DOWN','temp_seg_id'])
+
+
+def pack_systems(system_sizes, n_units):
+    '''
+    Description
+    ---------
+    bin-packs drainage systems into n_units work units balanced by basin count (longest processing time first: largest
+    system goes to the unit with the fewest basins)
+
+    Parameters
+    ---------
+    system_sizes: pandas series of number of basins indexed by system_id
+    n_units: int, number of work units
+
+    Output
+    ---------
+    units: list of lists of system_id, largest unit first
+    '''
+    system_sizes = system_sizes.sort_values(ascending=False)
+    n_units = max(1, min(int(n_units), len(system_sizes)))
+    heap = [(0, i) for i in range(n_units)]
+    units = [[] for i in range(n_units)]
+    loads = [0] * n_units
+    for system_id, size in system_sizes.items():
+        load, i = heapq.heappop(heap)
+        units[i].append(system_id)
+        loads[i] = load + int(size)
+        heapq.heappush(heap, (loads[i], i))
+    order = np.argsort(loads)[::-1]
+    return [units[i] for i in order if units[i]]
+
+
+def build_unit(task):
+    '''
+    Description
+    ---------
+    builds upstream network of one work unit to its own hdf file, run in worker processes by parallel_build_network
+    task: (hdf_name of unit, up_seg_df rows of the unit's drainage systems)
+    '''
+    unit_hdf_name, unit_df = task
+    if os.path.exists(unit_hdf_name):
+        os.remove(unit_hdf_name)
+    upstream_build_network(upstream_setup(unit_df), unit_hdf_name)
+    return unit_hdf_name
+
+
+def system_hashes(up_seg_df):
+    '''
+    Description
+    ---------
+    returns hash of the rows of each drainage system (seg_id, upseg_id and the basin attributes written to the network
+    store), used to find systems that changed since the network was built
+
+    Parameters
+    ---------
+    up_seg_df: dataframe from prep_up_seg_df (requires system_id)
+
+    Output
+    ---------
+    hashes: pandas series of sha1 hex digests indexed by system_id
+    '''
+    df = up_seg_df.sort_values(['system_id', 'seg_id', 'upseg_id'])
+    values = df[HASH_COLUMNS].to_numpy(dtype=np.float64)
+    system_ids = df['system_id'].to_numpy(dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, system_ids[1:] != system_ids[:-1]])
+    ends = np.r_[starts[1:], len(df)]
+    hashes = [hashlib.sha1(values[start:end].tobytes()).hexdigest() for start, end in zip(starts, ends)]
+    return pd.Series(hashes, index=system_ids[starts])
+
+
+def basin_systems(up_seg_df):
+    '''
+    Description
+    ---------
+    returns system_id of each basin as a pandas series indexed by HYBAS_ID (seg_id)
+    '''
+    basins = up_seg_df.drop_duplicates('seg_id')
+    return pd.Series(basins['system_id'].to_numpy(dtype=np.int64), index=basins['seg_id'].to_numpy(dtype=np.int64))
+
+
+def read_system_index(hdf_name):
+    '''
+    Description
+    ---------
+    reads system hashes and basin membership stored with the network (see write_system_index)
+
+    Output
+    ---------
+    hashes, basin_system: pandas series (see system_hashes and basin_systems), (None, None) if the file has no index
+    '''
+    if not os.path.exists(hdf_name):
+        return None, None
+    with h5py.File(hdf_name, 'r') as h5:
+        if SYSTEMS_GROUP not in h5:
+            return None, None
+        grp = h5[SYSTEMS_GROUP]
+        hashes = pd.Series(grp['hash'][()].astype(str), index=grp['system_id'][()])
+        basin_system = pd.Series(grp['basin_system'][()], index=grp['basin_id'][()])
+    return hashes, basin_system
+
+
+def write_system_index(h5, hashes, basin_system):
+    '''
+    Description
+    ---------
+    writes system hashes and basin membership to the SYSTEMS_GROUP group of an open hdf file
+    '''
+    if SYSTEMS_GROUP in h5:
+        del h5[SYSTEMS_GROUP]
+    grp = h5.create_group(SYSTEMS_GROUP)
+    grp.create_dataset('system_id', data=hashes.index.to_numpy(dtype=np.int64))
+    grp.create_dataset('hash', data=hashes.to_numpy().astype('S40'))
+    grp.create_dataset('basin_id', data=basin_system.index.to_numpy(dtype=np.int64), compression='gzip', shuffle=True)
+    grp.create_dataset('basin_system', data=basin_system.to_numpy(dtype=np.int64), compression='gzip', shuffle=True)
+
+
+def merge_networks(unit_hdf_names, hdf_name, keep_from=None, skip_ids=None, system_index=None):
+    '''
+    Description
+    ---------
+    copies basin groups of unit hdf files into one hdf file.  The file is written to a temporary file and moved into
+    place, so readers see either the old or the new network.
+
+    Parameters
+    ---------
+    unit_hdf_names: list of hdf files from build_unit
+    hdf_name: str, output hdf file
+    keep_from: optional existing network, its basin groups are copied unchanged except for skip_ids
+    skip_ids: set of str basin ids not copied from keep_from (basins being rebuilt or removed)
+    system_index: optional (hashes, basin_system) written with write_system_index
+    '''
+    tmp_name = f'{hdf_name}.tmp'
+    skip_ids = skip_ids or set()
+    sources = ([keep_from] if keep_from else []) + list(unit_hdf_names)
+    with h5py.File(tmp_name, 'w') as out:
+        for source in sources:
+            with h5py.File(source, 'r') as src:
+                #low level copy avoids building a python group object for each of the ~1M basins
+                for name in src.keys():
+                    if name == SYSTEMS_GROUP or (source == keep_from and name in skip_ids):
+                        continue
+                    name = name.encode()
+                    h5py.h5o.copy(src.id, name, out.id, name)
+        if system_index is not None:
+            write_system_index(out, *system_index)
+    os.replace(tmp_name, hdf_name)
+
+
+def build_units(up_seg_df, part_dir, workers=None, units_per_worker=4):
+    '''
+    Description
+    ---------
+    builds upstream networks of the drainage systems in up_seg_df in worker processes.  Systems are bin-packed into
+    units_per_worker units per worker so one large system does not leave other workers idle at the end, each unit is
+    written to its own hdf file in part_dir.
+
+    Output
+    ---------
+    unit_hdf_names: list of unit hdf files
+    '''
+    system_sizes = up_seg_df.groupby('system_id')['seg_id'].nunique()
+    if workers is None:
+        budget = memory.MemoryBudget()
+        #all_parents dictionaries of a system are held until its outlet is reached
+        worker_bytes = int(system_sizes.max()) * budget.bytes_per_basin('build_network', 4000)
+        workers, _ = budget.plan_pool(len(system_sizes), worker_bytes)
+    units = pack_systems(system_sizes, workers * units_per_worker)
+
+    os.makedirs(part_dir, exist_ok=True)
+    groups = up_seg_df.groupby('system_id').indices
+    tasks = []
+    for i, unit in enumerate(units):
+        rows = np.concatenate([groups[system_id] for system_id in unit])
+        tasks.append((os.path.join(part_dir, f'unit_{i}.h5'), up_seg_df.iloc[np.sort(rows)]))
+    print(f'{len(system_sizes)} drainage systems packed into {len(units)} units for {workers} workers')
+    with executor.Executor('serial' if workers == 1 else None, workers=workers, chunksize=1) as ex:
+        return ex.map(build_unit, tasks, task_ids=[os.path.basename(task[0]) for task in tasks], label='network units')
+
+
+def _remove_units(unit_hdf_names, part_dir):
+    for unit_hdf_name in unit_hdf_names:
+        os.remove(unit_hdf_name)
+    if os.path.isdir(part_dir) and not os.listdir(part_dir):
+        os.rmdir(part_dir)
+
+
+def parallel_build_network(up_seg_df, hdf_name='output/hb12_network.h5', workers=None, units_per_worker=4):
+    '''
+    Description
+    ---------
+    builds the upstream network (same output as upstream_build_network) with drainage systems split across worker
+    processes (see build_units), units are merged into hdf_name with a hash of each system for update_network
+
+    Parameters
+    ---------
+    up_seg_df: dataframe from prep_up_seg_df (requires system_id)
+    hdf_name: str, output hdf file, replaced if it exists
+    workers: number of worker processes, defaults to memory budget plan (see utils/memory.py)
+    units_per_worker: work units per worker
+
+    Output
+    ---------
+    hdf_name
+    '''
+    part_dir = f'{hdf_name}_parts'
+    unit_hdf_names = build_units(up_seg_df, part_dir, workers, units_per_worker)
+    merge_networks(unit_hdf_names, hdf_name, system_index=(system_hashes(up_seg_df), basin_systems(up_seg_df)))
+    _remove_units(unit_hdf_names, part_dir)
+    return hdf_name
+
+
+def update_network(up_seg_df, hdf_name='output/hb12_network.h5', workers=None, remove_missing=False):
+    '''
+    Description
+    ---------
+    updates an existing network for changed drainage systems only.  Systems whose rows (HYBAS_ID, NEXT_DOWN and stored
+    attributes) hash differently from the hashes stored with the network are rebuilt, groups of untouched systems are
+    copied unchanged and the file is replaced in one step.  Builds the full network if hdf_name does not exist or was
+    built without hashes (e.g. by upstream_build_network).
+
+    Parameters
+    ---------
+    up_seg_df: dataframe from prep_up_seg_df, all basins or whole drainage systems of a sub-region
+    hdf_name: str, network hdf file
+    workers: number of worker processes for rebuilt systems
+    remove_missing: remove stored systems that are not in up_seg_df, leave False when updating a sub-region
+
+    Output
+    ---------
+    rebuilt: list of system_id rebuilt
+    '''
+    new_hashes = system_hashes(up_seg_df)
+    old_hashes, old_basin_system = read_system_index(hdf_name)
+    if old_hashes is None:
+        if os.path.exists(hdf_name):
+            print(f'Warning, {hdf_name} has no drainage system hashes, rebuilding all systems')
+        parallel_build_network(up_seg_df, hdf_name, workers)
+        return new_hashes.index.tolist()
+
+    changed = new_hashes[new_hashes != old_hashes.reindex(new_hashes.index)]
+    new_basin_system = basin_systems(up_seg_df)
+    #stored systems holding basins of changed systems (e.g. systems merged or split by a NEXT_DOWN fix) are replaced too
+    changed_basins = new_basin_system[new_basin_system.isin(changed.index)].index
+    affected = set(old_basin_system.reindex(changed_basins).dropna().astype(np.int64).tolist()) | set(changed.index.tolist())
+    if remove_missing:
+        affected |= set(old_hashes.index.difference(new_hashes.index).tolist())
+    rebuild = sorted(set(changed.index.tolist()) | (affected & set(new_hashes.index.tolist())))
+    if not affected:
+        print(f'No drainage systems changed, {hdf_name} is up to date')
+        return []
+
+    skip_ids = set(str(basin_id) for basin_id in old_basin_system[old_basin_system.isin(affected)].index)
+    hashes = pd.concat([old_hashes.drop(list(affected & set(old_hashes.index.tolist()))), new_hashes.reindex(rebuild)])
+    basin_system = pd.concat([old_basin_system[~old_basin_system.isin(affected)], new_basin_system[new_basin_system.isin(rebuild)]])
+    print(f'{len(rebuild)} drainage systems to rebuild, {len(affected) - len(rebuild)} removed, '
+          f'{len(old_hashes) - len(affected & set(old_hashes.index.tolist()))} unchanged')
+
+    part_dir = f'{hdf_name}_parts'
+    unit_hdf_names = build_units(up_seg_df[up_seg_df['system_id'].isin(rebuild)], part_dir, workers) if rebuild else []
+    merge_networks(unit_hdf_names, hdf_name, keep_from=hdf_name, skip_ids=skip_ids, system_index=(hashes, basin_system))
+    _remove_units(unit_hdf_names, part_dir)
+    return rebuild
@@ -0,0 +1,289 @@
+#Import packages
+import os
+import numpy as np
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from utils import progress
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    executor used by parallel drivers (step2_mp_attribution.py, upstream_sum_mp_example.py, lakes/build_lk_catchment_mp.py)
+    so the backend, number of workers and chunksize can be chosen per run without code changes.
+
+    Backends:
+        serial  -> tasks run one at a time in the main process (useful for debugging and profiling)
+        process -> multiprocessing pool, forked where available, read-only shared state is set up once per worker by an
+                   initializer instead of being pickled with every chunk of tasks
+        thread  -> thread pool, shared state is used in place (useful when tasks release the GIL, e.g. raster reads)
+        cluster -> dask.distributed LocalCluster (optional dependency), shared state is broadcast once to each worker
+
+    Shared state is read in tasks with get_shared(name) or by wrapping the task function with SharedTask.
+    numpy arrays in shared state are handed to process and cluster workers in shared memory (SharedArray), so workers
+    attach to one copy rather than each holding their own.
+
+    Settings (environment variables take priority over defaults, empty values are treated as unset):
+        GFF_EXECUTOR  -> backend (default process), a backend passed by the caller takes priority
+        GFF_WORKERS   -> number of workers, takes priority over workers passed by the caller
+        GFF_CHUNKSIZE -> number of tasks sent to a worker at once, takes priority over chunksize passed by the caller
+
+    Example
+    ---------
+    with executor.Executor(workers=workers, chunksize=chunksize, shared={'gdf': gdf}) as ex:
+        results = ex.map(executor.SharedTask(run_the_stats, 'gdf'), basin_list, label='basins')
+'''
+
+BACKENDS = ['serial', 'process', 'thread', 'cluster']
+
+#read-only state of the current process (worker or main process for serial and thread backends)
+_shared = {}
+
+
+class SharedArray:
+    def __init__(self, array=None, name=None, shape=None, dtype=None):
+        '''
+        Description
+        ---------
+        numpy array held in shared memory.  Created from an array in the main process, pickles as the shared memory name
+        so workers attach to the same memory instead of receiving a copy.
+
+        Parameters
+        ---------
+        array : numpy array copied into new shared memory (main process)
+        name, shape, dtype : used to attach to existing shared memory (workers)
+        '''
+        from multiprocessing import shared_memory
+        if array is not None:
+            array = np.ascontiguousarray(array)
+            if array.dtype == object:
+                raise ValueError('SharedArray requires a numeric numpy array, object arrays can not be shared')
+            self._shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            self.shape = array.shape
+            self.dtype = array.dtype.str
+            self.owner = True
+            self.array[...] = array
+        else:
+            #workers started by multiprocessing share the resource tracker of the main process, only the owner unlinks
+            self._shm = shared_memory.SharedMemory(name=name)
+            self.shape = tuple(shape)
+            self.dtype = dtype
+            self.owner = False
+        self.name = self._shm.name
+
+    @property
+    def array(self):
+        return np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=self._shm.buf)
+
+    def __reduce__(self):
+        return (SharedArray, (None, self.name, self.shape, self.dtype))
+
+    def close(self):
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+
+def set_shared(shared):
+    '''
+    Description
+    ---------
+    sets read-only state of the current process, used as the process pool initializer
+    '''
+    _shared.clear()
+    _shared.update(shared or {})
+
+
+def get_shared(name):
+    '''
+    Description
+    ---------
+    returns shared state set for the run (see Executor shared), shared numpy arrays are returned as numpy arrays
+    '''
+    value = _shared[name]
+    if isinstance(value, SharedArray):
+        return value.array
+    return value
+
+
+class SharedTask:
+    def __init__(self, func, *names):
+        '''
+        Description
+        ---------
+        Calls func with shared state as leading arguments, e.g. SharedTask(upstream_sum, 'np_basin_data') runs
+        upstream_sum(np_basin_data, task) in workers without pickling np_basin_data with the tasks
+
+        Parameters
+        ---------
+        func : function (or functools.partial), accepts shared values followed by the task argument
+        names : names of shared values (see Executor shared)
+        '''
+        self.func = func
+        self.names = names
+
+    def __call__(self, item):
+        return self.func(*[get_shared(name) for name in self.names], item)
+
+
+def _run_chunk(func, shared, chunk):
+    #cluster workers keep the broadcast state between chunks, only reset when a new run sends different state
+    if _shared.get('_run_id') != shared.get('_run_id'):
+        set_shared(shared)
+    return [func(item) for item in chunk]
+
+
+class Executor:
+    def __init__(self, backend=None, workers=None, chunksize=None, shared=None, share_arrays=True):
+        '''
+        Description
+        ---------
+        Runs a function across tasks with the chosen backend.  Use as a context manager so workers and shared
+        memory are released at the end of the run.
+
+        Parameters
+        ---------
+        backend : 'serial', 'process', 'thread' or 'cluster', defaults to GFF_EXECUTOR or 'process'
+                  (callers pass a backend when it is required, e.g. 'serial' for a single worker)
+        workers : number of workers (e.g. from memory.MemoryBudget.plan_pool), GFF_WORKERS takes priority
+        chunksize : tasks sent to a worker at once, defaults to progress.default_chunksize, GFF_CHUNKSIZE takes priority
+        shared : dictionary of read-only state used by tasks (see get_shared and SharedTask)
+        share_arrays : hand numpy arrays in shared to process and cluster workers in shared memory
+        '''
+        self.backend = (backend or os.environ.get('GFF_EXECUTOR') or 'process').lower()
+        if self.backend not in BACKENDS:
+            raise ValueError(f'Unknown executor backend {self.backend}, use one of {BACKENDS}')
+        workers = os.environ.get('GFF_WORKERS') or workers
+        self.workers = 1 if self.backend == 'serial' else max(1, int(workers or os.cpu_count() or 1))
+        chunksize = os.environ.get('GFF_CHUNKSIZE') or chunksize
+        self.chunksize = int(chunksize) if chunksize else None
+        self.shared = dict(shared or {})
+        self.share_arrays = share_arrays
+        self._arrays = []
+        self._pool = None
+        self._client = None
+        self._started = False
+
+    #progress.default_chunksize reads worker count of pools from _processes
+    @property
+    def _processes(self):
+        return self.workers
+
+    def _worker_shared(self):
+        if not self.share_arrays or self.backend not in ['process', 'cluster']:
+            return self.shared
+        worker_shared = {}
+        for name, value in self.shared.items():
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                value = SharedArray(value)
+                self._arrays.append(value)
+            worker_shared[name] = value
+        return worker_shared
+
+    def start(self):
+        if self._started:
+            return self
+        if self.backend in ['serial', 'thread']:
+            set_shared(self.shared)
+            if self.backend == 'thread':
+                self._pool = ThreadPool(self.workers)
+        elif self.backend == 'process':
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+            self._pool = context.Pool(self.workers, initializer=set_shared, initargs=(self._worker_shared(),))
+        else:
+            try:
+                from dask.distributed import Client, LocalCluster
+            except ImportError:
+                raise ImportError('cluster executor backend requires dask.distributed (pip install "dask[distributed]")')
+            self._client = Client(LocalCluster(n_workers=self.workers, threads_per_worker=1, processes=True))
+            worker_shared = self._worker_shared()
+            worker_shared['_run_id'] = f'{os.getpid()}_{id(self)}'
+            self._cluster_shared = self._client.scatter([worker_shared], broadcast=True)[0]
+        self._started = True
+        return self
+
+    def imap_unordered(self, func, items, chunksize=1):
+        '''
+        Description
+        ---------
+        same as Pool.imap_unordered for the chosen backend, used by progress.run_pool
+        '''
+        self.start()
+        if self.backend == 'serial':
+            return (func(item) for item in items)
+        if self.backend in ['process', 'thread']:
+            return self._pool.imap_unordered(func, items, chunksize)
+        return self._cluster_imap(func, items, chunksize)
+
+    def _cluster_imap(self, func, items, chunksize):
+        from dask.distributed import as_completed
+        items = list(items)
+        futures = [self._client.submit(_run_chunk, func, self._cluster_shared, items[i:i + chunksize], pure=False)
+                   for i in range(0, len(items), max(1, chunksize))]
+        for future in as_completed(futures):
+            for result in future.result():
+                yield result
+
+    def map(self, func, tasks, task_ids=None, chunksize=None, monitor=None, track_running=True, **monitor_kwargs):
+        '''
+        Description
+        ---------
+        runs func for each task with progress reporting (see progress.run_pool), results are in the order of tasks
+
+        Parameters
+        ---------
+        func : function (or functools.partial, SharedTask, instrumentation.InstrumentedTask) run for each task
+        tasks : list of task arguments
+        task_ids, monitor, track_running, monitor_kwargs : see progress.run_pool
+        chunksize : overrides chunksize of executor for this map
+        '''
+        self.start()
+        return progress.run_pool(self, func, tasks, task_ids=task_ids, chunksize=chunksize or self.chunksize,
+                                 monitor=monitor, track_running=track_running, **monitor_kwargs)
+
+    def close(self, terminate=False):
+        '''
+        Description
+        ---------
+        releases workers and shared memory, terminate stops workers without waiting for queued tasks (used on errors)
+        '''
+        if self._pool is not None:
+            if terminate:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._client is not None:
+            cluster = self._client.cluster
+            self._client.close()
+            cluster.close()
+            self._client = None
+        for array in self._arrays:
+            array.close()
+        self._arrays = []
+        if self.backend in ['serial', 'thread']:
+            set_shared({})
+        self._started = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        #on an error (e.g. a failed task re-raised by map) remaining queued tasks are not waited for
+        self.close(terminate=exc_type is not None)
+        return False
+
+    def __repr__(self):
+        return f'Executor(backend={self.backend}, workers={self.workers}, chunksize={self.chunksize})'
+
+
+############################################################################################
+############################################################################################
@@ -15,11 +15,13 @@
 #Import packages
 import os
 import pandas as pd
-import rasterio
-import geopandas as gpd
 import pickle
 import sys
 import json
+import re
+from functools import lru_cache
+from utils import memory
+#rasterio and geopandas are imported within the functions that use them so importing this module stays fast
 
 ###############################################################################################
 #The below section includes methods to gather and store information about files in a directory
@@ -44,19 +46,28 @@ class FileInfo:
 
     def tif_info(self):
         if (self.file_name).endswith('.tif'): 
+            import rasterio
             try:
-                file_data = rasterio.open(self.file_path)
-                xmin, ymin, xmax, ymax = file_data.bounds
-                self.bounds = {'xmin': xmin, 'xmax':xmax, 'ymin':ymin, 'ymax':ymax}
-                self.no_data_val = file_data.nodata
-                #rasterio geotransform, produces values ()
-                gt = file_data.transform
-                self.pixel_size = gt[0]
-                self.crs = str(file_data.crs)
+                #with statement ensures file handle is closed
+                with rasterio.open(self.file_path) as file_data:
+                    xmin, ymin, xmax, ymax = file_data.bounds
+                    self.bounds = {'xmin': xmin, 'xmax':xmax, 'ymin':ymin, 'ymax':ymax}
+                    self.no_data_val = file_data.nodata
+                    #rasterio geotransform, produces values ()
+                    gt = file_data.transform
+                    self.pixel_size = gt[0]
+                    self.crs = str(file_data.crs)
+                    #raster layout, used to estimate bytes read and to find rasters that need preparation
+                    self.dtype = file_data.dtypes[0]
+                    self.width = file_data.width
+                    self.height = file_data.height
+                    self.block_shape = list(file_data.block_shapes[0])
+                    self.tiled = bool(file_data.profile.get('tiled', False))
+                    self.overviews = file_data.overviews(1)
             except:
                 pass
 
-    def user_supplied_info(self, csv_file='data/var/file_processing_info.csv'):
+    def user_supplied_info(self, csv_file='data/var/file_processing_info.csv', info_table=None):
         '''
         Description
         ---------
@@ -64,12 +75,21 @@ class FileInfo:
 
         Parameters
         ---------
-        missing_info: list of arrays documenting which files are available but have missing information 
+        csv_file: str, path to user supplied csv file, only read if info_table is not supplied
+        info_table: optional dataframe from read_processing_info (indexed by file_name), avoids reading csv for each file
+
+        Output
+        ---------
+        missing_info: dictionary documenting file that is available but has missing information, None if information is complete
         '''
         missing_info = {}
         try:
-            df = pd.read_csv(csv_file)
-            df_row = df.loc[df['file_name']==self.file_name]
+            if info_table is None:
+                info_table = read_processing_info(csv_file)
+            if self.file_name in info_table.index:
+                df_row = info_table.loc[[self.file_name]]
+            else:
+                df_row = info_table.iloc[0:0]
             rows, cols = df_row.shape
             if rows > 1:
                 print (f'{self.file_name} is duplicated in data/var/src_processing_info.csv')
@@ -78,12 +98,13 @@ class FileInfo:
                 missing_info['missing_fields']=['field_name','variable', 'src_short','summary_type','label','all_touched','conditional']
                 return missing_info
             else:
-                #if any nan in df
-                if len(df_row.columns[df_row.isna().any()].tolist())>0:
+                #if any nan in required columns of df
+                required = [col for col in df_row.columns if col in REQUIRED_COLUMNS]
+                if len(df_row[required].columns[df_row[required].isna().any()].tolist())>0:
                     #add file name to missing data 
                     missing_info['file_name']=self.file_name
                     #add list of columns with missing data in src_processing_info.csv for this file
-                    missing_info['missing_fields']=df_row.columns[df_row.isna().any()].tolist()
+                    missing_info['missing_fields']=df_row[required].columns[df_row[required].isna().any()].tolist()
                     return missing_info
                 else:
                     self.variable = df_row.iloc[0]['variable']
@@ -92,21 +113,160 @@ class FileInfo:
                     self.label = df_row.iloc[0]['label']
                     self.categorical = df_row.iloc[0]['categorical']
                     self.pixel_inclusion = df_row.iloc[0]['pixel_inclusion']
+                    #optional value rules applied as windows are read during attribution (see utils/raster_io.py ValueRules)
+                    for col in OPTIONAL_COLUMNS:
+                        if col in df_row.columns and pd.notna(df_row.iloc[0][col]):
+                            setattr(self, col, float(df_row.iloc[0][col]))
+                    #files of a temporal stack are attributed together (see attribution.file_stacks)
+                    if 'stack' in df_row.columns and pd.notna(df_row.iloc[0]['stack']):
+                        self.stack = str(df_row.iloc[0]['stack'])
+                        epoch = df_row.iloc[0]['epoch'] if 'epoch' in df_row.columns else None
+                        self.epoch = epoch_from_name(self.file_name) if pd.isna(epoch) else _epoch_str(epoch)
+                        if self.epoch is None:
+                            del self.variable
+                            missing_info['file_name']=self.file_name
+                            missing_info['missing_fields']=['epoch']
+                            return missing_info
             
         except:
             missing_info['file_name']=self.file_name
             missing_info['file_failed']= True
             return missing_info
 
-def store_file_info(file_list, directory, short_name):
+
+#Columns of file_processing_info.csv that must have a value, other columns are optional
+REQUIRED_COLUMNS = ['file_name', 'variable', 'src_short', 'summary_type', 'label', 'categorical', 'pixel_inclusion']
+#Optional columns, leave blank when not needed
+#   nodata_override -> value treated as nodata instead of the nodata value of the file (e.g. Pasture2000_5m.tif)
+#   valid_min, valid_max -> pixels outside the range are treated as nodata
+#   scale, offset -> values are converted to value * scale + offset
+#   sketch_bins, sketch_min, sketch_max -> histogram of pixel values per basin for upstream and pfaf percentiles
+#                                          (see attribution.sketch_edges), sketch_log = 1 spaces bins on a log scale
+OPTIONAL_COLUMNS = ['nodata_override', 'valid_min', 'valid_max', 'scale', 'offset', 'sketch_bins', 'sketch_min', 'sketch_max',
+                    'sketch_log']
+#Optional temporal stack columns, kept as text
+#   stack -> name of variable the file is one epoch of (e.g. lc100_tree for LC100 tree-coverfraction-layer 2015 to 2019),
+#            epochs of a stack must be on the same grid, each epoch keeps its own label
+#   epoch -> epoch of the file (e.g. 2015), when blank the epoch is read from the file name (e.g. epoch2015 or 2015)
+STACK_COLUMNS = ['stack', 'epoch']
+EPOCH_PATTERNS = [r'epoch(\d+)', r'(?<!\d)((?:19|20)\d{2})(?!\d)']
+
+
+def _epoch_str(epoch):
+    #csv columns with blanks are read as float, 2015.0 -> '2015'
+    if isinstance(epoch, float) and epoch.is_integer():
+        epoch = int(epoch)
+    return str(epoch)
+
+
+def epoch_from_name(file_name):
+    '''
+    Description
+    ---------
+    returns epoch in a file name (e.g. '2015' from ..._LC100_epoch2015_global_v2.0.1_...tif), None if none is found
+    '''
+    for pattern in EPOCH_PATTERNS:
+        match = re.search(pattern, file_name)
+        if match:
+            return match.group(1)
+    return None
+
+
+def read_processing_info(csv_file='data/var/file_processing_info.csv'):
+    '''
+    Description
+    ---------
+    reads user supplied file processing information once into a dataframe indexed by file_name for fast lookup
+
+    Parameters
+    ---------
+    csv_file: str, path to user supplied csv file
+    '''
+    df = pd.read_csv(csv_file)
+    return df.set_index('file_name', drop=False).rename_axis(None).sort_index()
+
+
+def _probe_header(file_name, file_path):
+    '''
+    Description
+    ---------
+    reads raster header information for one file, run in a thread pool by build_file_catalog (GDAL releases the GIL)
+    '''
+    file_info = FileInfo(file_name, file_path)
+    file_info.tif_info()
+    header = dict(file_info.__dict__)
+    del header['file_name'], header['file_path']
+    return header
+
+
+def build_file_catalog(file_list, directory, short_name, csv_file='data/var/file_processing_info.csv', max_workers=8):
+    '''
+    Description
+    ---------
+    builds information about files used in processing steps.  Raster headers are probed concurrently in a thread pool and
+    stored in a catalog with file size and modified time, so later runs only probe new or changed files.
+    User supplied information is read once from csv_file.
+
+    Parameters
+    ---------
+    file_list: list of dictionaries with file_name and file_path (see find_files)
+    directory: str, directory where outputs are written
+    short_name: str, name used for outputs
+    csv_file: str, path to user supplied file processing information
+    max_workers: int, number of threads used to probe raster headers
+
+    Output
+    ---------
+    f'{directory}/{short_name}_file_info.json' : information for files that are ready to process
+    f'{directory}/{short_name}_catalog.json' : raster header information with size and mtime of each file, keyed by file_path
+    all_file_info: list of dictionaries (same as file_info.json)
+    missing_info: list of dictionaries documenting files that are missing user supplied information
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    catalog_file = f'{directory}/{short_name}_catalog.json'
+    catalog = {}
+    if os.path.exists(catalog_file):
+        with open(catalog_file, 'r') as infile:
+            catalog = json.load(infile)
+
+    #find files that are new or changed since the catalog was written
+    to_probe = []
+    file_stats = {}
+    for file in file_list:
+        stat = os.stat(file['file_path'])
+        file_stats[file['file_path']] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        cached = catalog.get(file['file_path'])
+        if cached is None or cached['size'] != stat.st_size or cached['mtime'] != stat.st_mtime:
+            to_probe.append(file)
+
+    if to_probe:
+        print (f'Reading headers of {len(to_probe)} new or changed files ({len(file_list)-len(to_probe)} unchanged)')
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            headers = executor.map(_probe_header, [f['file_name'] for f in to_probe], [f['file_path'] for f in to_probe])
+            for file, header in zip(to_probe, headers):
+                entry = dict(file_stats[file['file_path']])
+                entry['header'] = header
+                catalog[file['file_path']] = entry
+
+    #drop files from catalog that no longer exist in file_list for this short_name
+    catalog = {path: entry for path, entry in catalog.items() if path in file_stats}
+    tmp_file = f'{catalog_file}.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump(catalog, outfile)
+    os.replace(tmp_file, catalog_file)
+
+    info_table = read_processing_info(csv_file)
     all_file_info = []
     missing_info = []
     for file in file_list:
-        file_name = file['file_name']
-        file_path = file['file_path']
-        file_info = FileInfo(file_name, file_path)
-        file_info.tif_info()
-        missing_data = file_info.user_supplied_info()
+        file_info = FileInfo(file['file_name'], file['file_path'])
+        file_info.__dict__.update(catalog[file['file_path']]['header'])
+        #prepared copy is kept while the source raster is unchanged (see prepare_rasters)
+        prepared = catalog[file['file_path']].get('prepared')
+        if prepared and prepared['source_mtime'] == catalog[file['file_path']]['mtime'] and os.path.exists(prepared['path']):
+            file_info.prepared_path = prepared['path']
+        missing_data = file_info.user_supplied_info(info_table=info_table)
         if missing_data:
             missing_info.append(missing_data) 
         #Append only if file info is complete
@@ -115,12 +275,292 @@ def store_file_info(file_list, directory, short_name):
 
     outfile_name = f'{directory}/{short_name}_file_info.json'
 
-    with open(outfile_name, 'w') as outfile:        
+    #written to a temporary file and moved in place, an interrupted run never leaves a truncated file info
+    tmp_file = f'{outfile_name}.tmp'
+    with open(tmp_file, 'w') as outfile:
         json.dump(all_file_info, outfile)
+    os.replace(tmp_file, outfile_name)
     
     return all_file_info, missing_info
 
 
+def store_file_info(file_list, directory, short_name):
+    '''
+    Description
+    ---------
+    writes f'{directory}/{short_name}_file_info.json', see build_file_catalog
+    '''
+    return build_file_catalog(file_list, directory, short_name)
+
+
+
+def needs_preparation(header, block_size=512, min_overview_size=1024):
+    '''
+    Description
+    ---------
+    evaluates raster layout from catalog header (see build_file_catalog).  Striped (untiled) rasters and large rasters
+    without overviews are poorly laid out for windowed reads of small basins.
+
+    Parameters
+    ---------
+    header: dictionary of raster header information (tiled, block_shape, overviews, width, height)
+    block_size: int, tile size of prepared rasters, rasters smaller than one tile are not prepared
+    min_overview_size: int, rasters with width or height above this size should have overviews
+    '''
+    if 'width' not in header or 'height' not in header:
+        return False
+    if header['width'] <= block_size and header['height'] <= block_size:
+        return False
+    if not header.get('tiled'):
+        return True
+    return max(header['width'], header['height']) > min_overview_size and not header.get('overviews')
+
+
+def _prepare_raster(file_path, prepared_path, block_size=512, compress='DEFLATE'):
+    '''
+    Description
+    ---------
+    rewrites a raster as an internally tiled, compressed cloud optimized GeoTIFF with overviews.  Written to a temporary
+    file first so an interrupted run never leaves a partial prepared raster.  Run in worker processes by prepare_rasters.
+    '''
+    import rasterio
+    import rasterio.shutil
+    os.makedirs(os.path.dirname(prepared_path), exist_ok=True)
+    tmp_path = f'{prepared_path}.tmp.tif'
+    with rasterio.Env(GDAL_NUM_THREADS='ALL_CPUS'):
+        with rasterio.open(file_path) as src:
+            dtype = src.dtypes[0]
+        #predictor 2 (horizontal differencing) for integers, 3 (floating point) for floats
+        predictor = 3 if dtype.startswith('float') else 2
+        rasterio.shutil.copy(file_path, tmp_path, driver='COG', COMPRESS=compress, PREDICTOR=predictor,
+                             BLOCKSIZE=block_size, OVERVIEWS='AUTO', RESAMPLING='NEAREST', BIGTIFF='IF_SAFER')
+    os.replace(tmp_path, prepared_path)
+    return prepared_path
+
+
+def prepare_rasters(directory='data/var', short_name='tif_vars', prepared_dir='data/var_prepared', block_size=512,
+                    min_overview_size=1024, workers=4, force=False):
+    '''
+    Description
+    ---------
+    rewrites poorly laid out rasters (see needs_preparation) as tiled, compressed cloud optimized GeoTIFFs with overviews
+    so windowed reads of small basins only read the blocks covering the basin.  Files are prepared in parallel.
+    Rasters are only rewritten when the source raster is newer than the prepared copy, so the step can be rerun.
+    The prepared path is recorded in the catalog and f'{directory}/{short_name}_file_info.json' (prepared_path),
+    attribution reads prepared_path when it is present.
+
+    Run after store_file_info (see step1_data_management.ipynb)
+
+    Parameters
+    ---------
+    directory: str, directory with catalog and file info written by build_file_catalog
+    short_name: str, name used for outputs of build_file_catalog
+    prepared_dir: str, directory for prepared rasters, mirrors folders of source rasters.  Keep outside of directory
+                  so find_files does not pick up prepared copies.
+    block_size: int, tile size (pixels)
+    min_overview_size: int, see needs_preparation
+    workers: int, number of worker processes (see utils/executor.py)
+    force: bool, prepare all rasters regardless of layout or modified time
+
+    Output
+    ---------
+    prepared: list of source file paths that have a prepared copy
+    '''
+    from utils import executor
+    catalog_file = f'{directory}/{short_name}_catalog.json'
+    info_file = f'{directory}/{short_name}_file_info.json'
+    with open(catalog_file, 'r') as infile:
+        catalog = json.load(infile)
+
+    to_prepare = []
+    for file_path, entry in catalog.items():
+        header = entry.get('header', {})
+        if not (force or needs_preparation(header, block_size, min_overview_size)):
+            continue
+        prepared_path = os.path.join(prepared_dir, os.path.relpath(file_path, directory))
+        up_to_date = os.path.exists(prepared_path) and os.stat(prepared_path).st_mtime >= entry['mtime']
+        if up_to_date and not force:
+            entry['prepared'] = {'path': prepared_path, 'source_mtime': entry['mtime']}
+            continue
+        to_prepare.append((file_path, prepared_path))
+
+    if to_prepare:
+        print (f'Preparing {len(to_prepare)} rasters as tiled GeoTIFFs with overviews')
+        with executor.Executor(workers=min(workers, len(to_prepare)), chunksize=1) as ex:
+            results = ex.map(_prepare_task, [(fp, pp, block_size) for fp, pp in to_prepare], task_ids=[fp for fp, pp in to_prepare],
+                             label='prepared rasters')
+        for (file_path, prepared_path), result in zip(to_prepare, results):
+            if result is None:
+                print (f'Warning, {file_path} could not be prepared, the source raster will be read')
+                continue
+            catalog[file_path]['prepared'] = {'path': prepared_path, 'source_mtime': catalog[file_path]['mtime']}
+
+    tmp_file = f'{catalog_file}.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump(catalog, outfile)
+    os.replace(tmp_file, catalog_file)
+
+    #record prepared paths in file info used by attribution
+    with open(info_file, 'r') as infile:
+        all_file_info = json.load(infile)
+    for file_info in all_file_info:
+        prepared = catalog.get(file_info['file_path'], {}).get('prepared')
+        if prepared:
+            file_info['prepared_path'] = prepared['path']
+    #same as the catalog, an interrupted run never leaves a truncated file info for attribution
+    tmp_file = f'{info_file}.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump(all_file_info, outfile)
+    os.replace(tmp_file, info_file)
+    return [path for path, entry in catalog.items() if entry.get('prepared')]
+
+
+def _prepare_task(task):
+    file_path, prepared_path, block_size = task
+    try:
+        return _prepare_raster(file_path, prepared_path, block_size)
+    except Exception as e:
+        print (f'Warning, failed to prepare {file_path}: {e}')
+        return None
+
+
+#numpy dtype names to GDAL data type names used in VRT files
+GDAL_DATA_TYPES = {'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32', 'int32': 'Int32',
+                   'uint64': 'UInt64', 'int64': 'Int64', 'float32': 'Float32', 'float64': 'Float64'}
+
+#fields of file info that must match for files of a label to be combined into one mosaic
+MOSAIC_MATCH_FIELDS = ['crs', 'dtype', 'no_data_val', 'pixel_size', 'summary_type', 'categorical', 'pixel_inclusion'] + OPTIONAL_COLUMNS + \
+    STACK_COLUMNS
+
+
+def _vrt_xml(tiles, vrt_path):
+    '''
+    Description
+    ---------
+    builds VRT xml mosaicking tiles (file info dictionaries of one label) on their common grid
+
+    Output
+    ---------
+    xml: str, None if tiles are not on a common grid
+    bounds: dictionary of mosaic bounds
+    '''
+    from xml.sax.saxutils import escape
+    first = tiles[0]
+    res_x = float(first['pixel_size'])
+    res_y = (first['bounds']['ymax'] - first['bounds']['ymin']) / first['height']
+    x0 = min([t['bounds']['xmin'] for t in tiles])
+    y0 = max([t['bounds']['ymax'] for t in tiles])
+    x1 = max([t['bounds']['xmax'] for t in tiles])
+    y1 = min([t['bounds']['ymin'] for t in tiles])
+    width = int(round((x1 - x0) / res_x))
+    height = int(round((y0 - y1) / res_y))
+    sources = []
+    covered = 0
+    for t in tiles:
+        x_off = (t['bounds']['xmin'] - x0) / res_x
+        y_off = (y0 - t['bounds']['ymax']) / res_y
+        #tiles must fall on whole pixels of the mosaic grid
+        if abs(x_off - round(x_off)) > 1e-3 or abs(y_off - round(y_off)) > 1e-3:
+            return None, None
+        source_path = t.get('prepared_path') or t['file_path']
+        rel_path = os.path.relpath(os.path.abspath(source_path), os.path.dirname(os.path.abspath(vrt_path)))
+        sources.append(f'''    <SimpleSource>
+      <SourceFilename relativeToVRT="1">{escape(rel_path)}</SourceFilename>
+      <SourceBand>1</SourceBand>
+      <SrcRect xOff="0" yOff="0" xSize="{t['width']}" ySize="{t['height']}"/>
+      <DstRect xOff="{int(round(x_off))}" yOff="{int(round(y_off))}" xSize="{t['width']}" ySize="{t['height']}"/>
+    </SimpleSource>''')
+        covered += t['width'] * t['height']
+    nodata = first.get('no_data_val')
+    #without a nodata value, areas between tiles would be read as 0
+    if nodata is None and covered < width * height:
+        return None, None
+    nodata_xml = f'\n    <NoDataValue>{nodata}</NoDataValue>' if nodata is not None else ''
+    xml = f'''<VRTDataset rasterXSize="{width}" rasterYSize="{height}">
+  <SRS>{escape(str(first['crs']))}</SRS>
+  <GeoTransform>{x0!r}, {res_x!r}, 0.0, {y0!r}, 0.0, {-res_y!r}</GeoTransform>
+  <VRTRasterBand dataType="{GDAL_DATA_TYPES[first['dtype']]}" band="1">{nodata_xml}
+{chr(10).join(sources)}
+  </VRTRasterBand>
+</VRTDataset>
+'''
+    return xml, {'xmin': x0, 'xmax': x0 + width * res_x, 'ymin': y0 - height * res_y, 'ymax': y0}
+
+
+def build_mosaics(directory='data/var', short_name='tif_vars', vrt_dir='data/var_vrt'):
+    '''
+    Description
+    ---------
+    groups tiled datasets (e.g. LC100 20 degree tiles) by label into one virtual mosaic (GDAL VRT) per label, so basins
+    spanning tile seams are attributed with one window instead of one zonal stats call per tile and a merge.
+    VRT files are written as xml, GDAL python bindings are not needed.  Labels with files that do not share a grid,
+    data type, nodata value or processing information are left as separate files.
+
+    Run after store_file_info (and prepare_rasters if used, mosaics then reference the prepared rasters)
+
+    Parameters
+    ---------
+    directory: str, directory with file info written by build_file_catalog
+    short_name: str, name used for outputs of build_file_catalog
+    vrt_dir: str, directory where VRT files are written
+
+    Output
+    ---------
+    f'{directory}/{short_name}_mosaic_info.json' : file info with one record per mosaic (file_path of the VRT, tiles lists
+        the file names in the mosaic) and the records of files that are not part of a mosaic, read using read_file_info
+    mosaic_info: list of dictionaries (same as mosaic_info.json)
+    '''
+    with open(f'{directory}/{short_name}_file_info.json', 'r') as infile:
+        all_file_info = json.load(infile)
+    os.makedirs(vrt_dir, exist_ok=True)
+
+    labels = {}
+    for file_info in all_file_info:
+        labels.setdefault(file_info['label'], []).append(file_info)
+
+    mosaic_info = []
+    for label, tiles in labels.items():
+        if len(tiles) == 1:
+            mosaic_info += tiles
+            continue
+        usable = all(['bounds' in t and 'width' in t and t.get('dtype') in GDAL_DATA_TYPES for t in tiles])
+        matching = usable and all([t.get(field) == tiles[0].get(field) for t in tiles for field in MOSAIC_MATCH_FIELDS])
+        vrt_path = os.path.join(vrt_dir, f'{label}.vrt')
+        xml, bounds = _vrt_xml(tiles, vrt_path) if matching else (None, None)
+        if xml is None:
+            print (f'Warning, files of {label} can not be combined into a mosaic, files will be attributed separately')
+            mosaic_info += tiles
+            continue
+        with open(vrt_path, 'w') as outfile:
+            outfile.write(xml)
+        mosaic = {field: tiles[0][field] for field in MOSAIC_MATCH_FIELDS + ['variable', 'src_short', 'label'] if field in tiles[0]}
+        mosaic.update({'file_name': f'{label}.vrt', 'file_path': vrt_path, 'bounds': bounds,
+                       'tiles': [t['file_name'] for t in tiles]})
+        mosaic_info.append(mosaic)
+
+    #same as file info, an interrupted run never leaves a truncated mosaic info
+    mosaic_file = f'{directory}/{short_name}_mosaic_info.json'
+    tmp_file = f'{mosaic_file}.tmp'
+    with open(tmp_file, 'w') as outfile:
+        json.dump(mosaic_info, outfile)
+    os.replace(tmp_file, mosaic_file)
+    return mosaic_info
+
+
+def read_file_info(directory='data/var', short_name='tif_vars', mosaic=True):
+    '''
+    Description
+    ---------
+    reads file info used by attribution, the mosaic info from build_mosaics is used when it exists and is newer
+    than the file info (otherwise file info from build_file_catalog)
+    '''
+    info_file = f'{directory}/{short_name}_file_info.json'
+    mosaic_file = f'{directory}/{short_name}_mosaic_info.json'
+    if mosaic and os.path.exists(mosaic_file) and os.stat(mosaic_file).st_mtime >= os.stat(info_file).st_mtime:
+        info_file = mosaic_file
+    with open(info_file, 'r') as infile:
+        return json.load(infile)
+
 
 def find_files(directory='data/var', prefix=None, suffix=None):
     '''
@@ -151,25 +591,33 @@ def find_files(directory='data/var', prefix=None, suffix=None):
 #The below section includes methods to build and store HydroSHEDS data for efficient use in processing steps
 ###############################################################################################
 
-def build_basin_data(level='12', version='v1c', directory = 'data/HydroSHEDS'):
+def build_basin_data(level='12', version='v1c', directory = 'data/HydroSHEDS', store_dir='data/basin_store', partition_level=2, write_gdf_pkl=False):
     '''
     Description
     ---------
-    create pickle files to quickly read in HydroBASINS standard basin data in geodataframe, dataframe
+    create basin store and pickle files to quickly read in HydroBASINS standard basin data in geodataframe, dataframe
     currently assumes set regions (see region variable) and file types (.shp) based on v1c standard basins
 
     Parameters
     ---------
     level: str, HydroBASINS PFAF level acceptable values ['02','03','04','05','06','07','08','09','10','11','12'], default = '12'
     version: version of HydroBASINS as denoted in file_name  
+    store_dir: str, directory of basin store partitioned by region and pfaf prefix (see utils/basin_store.py)
+    partition_level: int, number of leading PFAF_ID digits used to partition basin store
+    write_gdf_pkl: bool, if True also write the global geodataframe pickle (requires concatenating all geometry in memory)
     
     Output
     ---------
-    f'data/basins_lvl{level}_gdf.pkl' : pickle file of basin attributes for specified basin level with geometry for creating global gdf, read using def read_pkl_gdf
+    f'{store_dir}/lvl{level}/' : basin store, read using def read_pkl_gdf and def read_pkl_df (with optional region and pfaf_prefix filters)
+    f'data/basins_lvl{level}_gdf.pkl' : only if write_gdf_pkl, pickle file of basin attributes for specified basin level with geometry for creating global gdf
     f'data/basins_lvl{level}_df.pkl' : pickle file of basin attributes for specified basin level without geometry for creating global df, read using def read_pkl_df
     f'data/basins_lvl{level}.txt' : pickle file of full list of HydroBASIN ids for specified basin level, read using def read_pkl_df
     print : currently reports to user via print if wrong number of regional files detected, and if wrong number of identifiers is detected
+    print : warning if concatenating regional data is estimated to exceed the memory budget (see utils/memory.py)
     '''
+    import geopandas as gpd
+    from utils import basin_store
+    budget = memory.MemoryBudget()
     
     regions = ['af','ar','as','au','eu','gr','na','sa','si']
     
@@ -198,25 +646,43 @@ def build_basin_data(level='12', version='v1c', directory = 'data/HydroSHEDS'):
 
         list_hybas_ids = []
         reg_df_list = []
+        partitions = []
+        level_dir = os.path.join(store_dir, f'lvl{level}')
+        os.makedirs(level_dir, exist_ok=True)
         for file in files:
             file_path = file['file_path']
             try:
                 regional_gdf = gpd.read_file(file_path)
-            except:
-                print (f'Failed to build geodataframe for: {file_path}')
+            except Exception as e:
+                #skip region, otherwise the previous region's geodataframe would be written under this region's name
+                print (f'Failed to build geodataframe for: {file_path} ({e})')
+                continue
+
+            try:
+                #Write regional partitions of basin store, file names are hybas_{region}_lev{level}_{version}.shp
+                region = file['file_name'].split('_')[1]
+                partitions += basin_store.write_partitions(regional_gdf, region, level_dir, partition_level)
+            except (OSError, KeyError, ValueError, IndexError) as e:
+                print (f'Failed to write basin store partitions for: {file_path} ({e})')
+                continue
             
             try:
                 #Create regional basin dataframe, add to global list of dataframes
-                regional_df = pd.DataFrame(regional_gdf)
+                if write_gdf_pkl:
+                    regional_df = pd.DataFrame(regional_gdf)
+                else:
+                    regional_df = pd.DataFrame(regional_gdf.drop(columns=['geometry']))
                 reg_df_list.append(regional_df)
                 #Create list of ids in regional list and add to global list
                 regional_id_list = (regional_df['HYBAS_ID']).to_list()
                 list_hybas_ids += regional_id_list
-            except:
-                print (f'Failed to convert to dataframe and list for: {file_path}')
+            except (KeyError, ValueError) as e:
+                print (f'Failed to convert to dataframe and list for: {file_path} ({e})')
 
         if len(list_hybas_ids) != 1034083:
             print (f'Warning, expected 1034083 ids, you have {str(len(list_hybas_ids))}')
+
+        basin_store.write_store_index(partitions, level_dir, level, partition_level)
                  
         try:
             #pickle list of hydrobasin ids
@@ -226,31 +692,112 @@ def build_basin_data(level='12', version='v1c', directory = 'data/HydroSHEDS'):
             with open(outfile_list_ids, "wb") as f:   
                 pickle.dump(list_hybas_ids, f)
                 
+            #concat copies regional data, warn before running if that is likely to exceed the memory budget
+            regional_bytes = sum([int(df.memory_usage(deep=True).sum()) for df in reg_df_list])
+            budget.check('build_basin_data concat', regional_bytes)
             #pickle dataframe of basin data for all regions
-            basin_data_w_geom = pd.concat(reg_df_list) 
-            outfile_basin_gdf = f'data/basins_lvl{level}_gdf.pkl' 
-            basin_data_w_geom.to_pickle(outfile_basin_gdf)
-            basin_data = basin_data_w_geom.drop(columns=['geometry'])
+            start_rss = memory.rss_bytes()
+            basin_data = pd.concat(reg_df_list) 
+            budget.record('build_basin_data', len(basin_data), memory.rss_bytes() - start_rss)
+            if write_gdf_pkl:
+                outfile_basin_gdf = f'data/basins_lvl{level}_gdf.pkl' 
+                basin_data.to_pickle(outfile_basin_gdf)
+                basin_data = basin_data.drop(columns=['geometry'])
             outfile_basin_df = f'data/basins_lvl{level}_df.pkl' 
             basin_data.to_pickle(outfile_basin_df)
 
-        except:
-            print (f'Failed to pickle files')
+        except (OSError, pickle.PicklingError, ValueError) as e:
+            print (f'Failed to pickle files ({e})')
 
     
-def read_pkl_gdf(file_path='data/basins_lvl12_gdf.pkl', crs={'init':'epsg:4326'}):
-    temp_df = pd.read_pickle(file_path)
+def _filter_basins(df, region=None, pfaf_prefix=None):
+    #filter for data read from whole-file pickles, region is identified by first digit of PFAF_ID
+    region_digits = {'af': '1', 'eu': '2', 'si': '3', 'as': '4', 'au': '5', 'sa': '6', 'na': '7', 'ar': '8', 'gr': '9'}
+    if region is None and pfaf_prefix is None:
+        return df
+    pfaf_str = df['PFAF_ID'].astype('int64').astype(str)
+    mask = pd.Series(True, index=df.index)
+    if region is not None:
+        regions = [region] if isinstance(region, str) else region
+        mask &= pfaf_str.str[0].isin([region_digits[r] for r in regions])
+    if pfaf_prefix is not None:
+        mask &= pfaf_str.str.startswith(str(pfaf_prefix))
+    return df[mask]
+
+def read_pkl_gdf(file_path=None, crs={'init':'epsg:4326'}, region=None, pfaf_prefix=None, columns=None, store_dir='data/basin_store', level='12'):
+    '''
+    Description
+    ---------
+    reads level 12 basins with geometry.  Uses basin store (see build_basin_data) when file_path is not supplied and store exists,
+    only partitions matching region and pfaf_prefix are read.  Otherwise reads pickle (default 'data/basins_lvl12_gdf.pkl') and filters.
+
+    Parameters
+    ---------
+    file_path: str, optional path of pickled geodataframe
+    region: str or list of str, HydroBASINS region code(s) (e.g. 'af')
+    pfaf_prefix: str or int, leading digits of PFAF_ID (e.g. '17' or '1721')
+    columns: list of attribute columns to return with geometry, defaults to all
+    '''
+    import geopandas as gpd
+    from utils import basin_store
+    if file_path is None and basin_store.store_exists(store_dir, level):
+        return basin_store.BasinStore(store_dir, level).read_gdf(region, pfaf_prefix, columns)
+    if file_path is None:
+        file_path = f'data/basins_lvl{level}_gdf.pkl'
+    temp_df = _filter_basins(pd.read_pickle(file_path), region, pfaf_prefix)
+    if columns is not None:
+        temp_df = temp_df[columns + ['geometry']]
     gdf = gpd.GeoDataFrame(temp_df, crs=crs, geometry='geometry')
     return gdf
 
-def read_pkl_df(file_path='data/basins_lvl12_df.pkl'):
+def read_pkl_df(file_path=None, region=None, pfaf_prefix=None, columns=None, store_dir='data/basin_store', level='12'):
+    '''
+    Description
+    ---------
+    reads level 12 basin attributes (no geometry).  Uses basin store when file_path is not supplied and store exists, geometry is never read.
+    Otherwise reads pickle (default 'data/basins_lvl12_df.pkl') and filters.  See read_pkl_gdf for parameters.
+    Note other pickled objects (e.g. 'data/basins_lvl12.txt' list of ids) can be read by supplying file_path without filters.
+    '''
+    from utils import basin_store
+    if file_path is None and basin_store.store_exists(store_dir, level):
+        return basin_store.BasinStore(store_dir, level).read_df(region, pfaf_prefix, columns)
+    if file_path is None:
+        file_path = f'data/basins_lvl{level}_df.pkl'
     df = pd.read_pickle(file_path)
+    if region is None and pfaf_prefix is None and columns is None:
+        return df
+    df = _filter_basins(df, region, pfaf_prefix)
+    if columns is not None:
+        df = df[columns]
     return df
 
-def basin_list_by_pfaf_lvl(level=12, df = read_pkl_df()):
+@lru_cache(maxsize=1)
+def load_basin_gdf(file_path=None):
+    '''
+    Description
+    ---------
+    Same as read_pkl_gdf but data are read the first time they are needed and then cached for the life of the process.
+    Callers should not modify the returned geodataframe, make a copy first.
+    '''
+    return read_pkl_gdf(file_path)
+
+@lru_cache(maxsize=1)
+def load_basin_df(file_path=None):
+    '''
+    Description
+    ---------
+    Same as read_pkl_df but data are read the first time they are needed and then cached for the life of the process.
+    Callers should not modify the returned dataframe, make a copy first.
+    '''
+    return read_pkl_df(file_path)
+
+def basin_list_by_pfaf_lvl(level=12, df=None):
     '''
     pass desired basin level to get unique list of pfaf ids at that level
+    df defaults to cached level 12 basin dataframe (see load_basin_df)
     '''
+    if df is None:
+        df = load_basin_df()
     level = int(level)
     pfaf_lvl12_ids = df['PFAF_ID'].tolist()
     pfaf_lvlx_ids = list(set([str(x)[:level] for x in pfaf_lvl12_ids]))
@@ -0,0 +1,489 @@
+#Import packages
+import numpy as np
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    NEXT_DOWN graph of level 12 HydroBASINS held as numpy arrays, used to compute upstream summaries for all basins in one
+    pass down the network.  Basins are grouped into topological levels (a basin's level is after the levels of all basins
+    flowing into it), each level hands its partial sums to the downstream basins in one vectorized step, so run time grows
+    with the number of basins instead of the total size of every upstream set.
+
+    Distance weighted summaries carry flow distance along the graph.  The distance between a basin and the basin it
+    flows into is the difference of their DIST_MAIN values (km along the river to the outlet of the system), local values
+    are treated as located at the pour point of their basin.
+        exponential      -> K(d) = exp(-d / length_scale), decay is applied to partial sums as they move downstream:
+                            S(v) = x(v) + sum over basins u flowing into v of exp(-d(u, v) / length_scale) * S(u)
+        inverse_distance -> K(d) = (1 + d / length_scale) ** -power, not separable along the path so it is approximated by
+                            a weighted sum of exponential kernels (see exponential_mixture), one pass per term
+
+    DownstreamIndex answers downstream questions (e.g. dams or reservoir capacity between a basin and the ocean or sink,
+    minimum protected fraction downstream) from ancestor jump tables (binary lifting) and aggregates along root paths.
+    Aggregates to the outlet are computed for all basins in one pass up the levels, sums/min/max over the next k
+    downstream basins and k-th downstream basin queries take O(log depth) per basin and are vectorized over basins.
+
+    FlowGraph.contract derives networks of coarser Pfafstetter levels from the level 12 graph, so upstream summaries at
+    e.g. level 6 run on rolled up local aggregates (pfaf_summarize.summarize) over a graph of thousands of basins.
+
+    step4_build_upstream_network.ipynb drops DIST_MAIN and DIST_SINK before building the network, FlowGraph.from_basin_df
+    reads them from the basin attributes (file_management.load_basin_df or read_pkl_df) instead.
+'''
+
+KERNELS = ['exponential', 'inverse_distance']
+#nan-ignoring functions so basins without a value do not hide values of other basins on the path
+PATH_STATS = {'sum': np.add, 'min': np.fmin, 'max': np.fmax}
+
+
+def exponential_mixture(length_scale, power=1.0, max_distance=None, n_terms=12):
+    '''
+    Description
+    ---------
+    fits (1 + d / length_scale) ** -power with a weighted sum of exponential kernels, sum(w * exp(-d / s)), for distances
+    from 0 to max_distance.  Weights are fit by least squares on relative error and kept non-negative.
+
+    Parameters
+    ---------
+    length_scale : float, length scale of inverse distance kernel (km)
+    power : float, power of inverse distance kernel
+    max_distance : float, largest distance the fit needs to cover (km), defaults to 1000 * length_scale
+    n_terms : int, number of exponential terms
+
+    Output
+    ---------
+    weights, scales, max_error : arrays of term weights and length scales (km), largest relative error over the fit range
+    '''
+    max_ratio = max(10.0, (max_distance or 1000.0 * length_scale) / length_scale)
+    ratio = np.concatenate([[0.0], np.logspace(-3, np.log10(max_ratio), 400)])
+    target = (1.0 + ratio) ** -power
+    scales = np.logspace(-2, np.log10(max_ratio) + 1, n_terms)
+    basis = np.exp(-ratio[:, None] / scales[None, :])
+    keep = np.ones(n_terms, dtype=bool)
+    while True:
+        #weight rows by 1 / target so the tail of the kernel is fit as closely as the head
+        fit, residuals, rank, singular = np.linalg.lstsq(basis[:, keep] / target[:, None], np.ones(len(ratio)), rcond=None)
+        if (fit >= 0).all():
+            break
+        keep[np.flatnonzero(keep)[np.argmin(fit)]] = False
+    weights = np.zeros(n_terms)
+    weights[keep] = fit
+    max_error = float(np.max(np.abs(basis @ weights - target) / target))
+    return weights[keep], scales[keep] * length_scale, max_error
+
+
+class FlowGraph:
+    def __init__(self, hybas_ids, next_down, dist=None, sink=None):
+        '''
+        Description
+        ---------
+        NEXT_DOWN graph with topological levels for vectorized upstream accumulation
+
+        Parameters
+        ---------
+        hybas_ids : array of HYBAS_ID
+        next_down : array of NEXT_DOWN, 0 (or an id not in hybas_ids) for basins draining to the ocean or a sink
+        dist : optional array of DIST_MAIN (or DIST_SINK) in km, required for distance weighted summaries
+        sink : optional boolean array of basins treated as outlets (ENDO == 2, same as step4_build_upstream_network.ipynb)
+        '''
+        hybas_ids = np.asarray(hybas_ids, dtype=np.int64)
+        order = np.argsort(hybas_ids, kind='stable')
+        self.hybas_ids = hybas_ids[order]
+        if len(self.hybas_ids) > 1 and (np.diff(self.hybas_ids) == 0).any():
+            raise ValueError('FlowGraph requires unique HYBAS_ID values')
+        self.n = len(self.hybas_ids)
+        self.down = self.positions(np.asarray(next_down, dtype=np.int64)[order])
+        if sink is not None:
+            self.down[np.asarray(sink, dtype=bool)[order]] = -1
+        self.edge_length = None
+        if dist is not None:
+            dist = np.asarray(dist, dtype=np.float64)[order]
+            has_down = self.down >= 0
+            self.edge_length = np.zeros(self.n)
+            #DIST_MAIN decreases downstream, small negative differences are rounding in the source data
+            self.edge_length[has_down] = np.clip(dist[has_down] - dist[self.down[has_down]], 0, None)
+            self.edge_length[np.isnan(self.edge_length)] = 0.0
+        self.levels = self._topological_levels()
+
+    @classmethod
+    def from_basin_df(cls, basin_df, dist_col='DIST_MAIN'):
+        '''
+        Description
+        ---------
+        builds FlowGraph from HydroBASINS attributes (HYBAS_ID, NEXT_DOWN, optional ENDO and dist_col)
+        dist_col : 'DIST_MAIN', 'DIST_SINK' or None to skip distances
+        '''
+        dist = basin_df[dist_col].to_numpy() if dist_col is not None and dist_col in basin_df.columns else None
+        if dist_col is not None and dist is None:
+            print(f'Warning, {dist_col} not in basin data, only unweighted upstream summaries are available')
+        sink = basin_df['ENDO'].to_numpy() == 2 if 'ENDO' in basin_df.columns else None
+        return cls(basin_df['HYBAS_ID'].to_numpy(), basin_df['NEXT_DOWN'].to_numpy(), dist, sink)
+
+    def positions(self, ids):
+        '''
+        Description
+        ---------
+        returns positions of ids in the graph (sorted HYBAS_ID order), -1 for ids not in the graph
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.n == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.hybas_ids, ids), self.n - 1)
+        return np.where(self.hybas_ids[pos] == ids, pos, -1)
+
+    def _topological_levels(self):
+        has_down = self.down >= 0
+        in_degree = np.bincount(self.down[has_down], minlength=self.n)
+        frontier = np.flatnonzero(in_degree == 0)
+        levels = []
+        n_placed = 0
+        while len(frontier):
+            levels.append(frontier)
+            n_placed += len(frontier)
+            targets = self.down[frontier]
+            targets = targets[targets >= 0]
+            if not len(targets):
+                break
+            targets, counts = np.unique(targets, return_counts=True)
+            in_degree[targets] -= counts
+            frontier = targets[in_degree[targets] == 0]
+        if n_placed != self.n:
+            raise ValueError(f'NEXT_DOWN graph has a cycle, {self.n - n_placed} basins could not be ordered')
+        return levels
+
+    def align(self, ids, values):
+        '''
+        Description
+        ---------
+        returns values (rows matching ids) as a float64 array in graph order, basins without values are 0
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        values = values.reshape(len(values), -1)
+        pos = self.positions(ids)
+        if (pos < 0).any():
+            print(f'Warning, {int((pos < 0).sum())} ids are not in the flow graph and are ignored')
+        aligned = np.zeros((self.n, values.shape[1]))
+        aligned[pos[pos >= 0]] = values[pos >= 0]
+        return aligned
+
+    def _propagate(self, values, decay=None, func=np.add):
+        totals = np.array(values, dtype=np.float64, copy=True)
+        for level in self.levels:
+            targets = self.down[level]
+            has_down = targets >= 0
+            sources = level[has_down]
+            moving = totals[sources]
+            if decay is not None:
+                moving = moving * decay[sources][:, None]
+            func.at(totals, targets[has_down], moving)
+        return totals
+
+    def accumulate(self, values, length_scale=None, kernel='exponential', power=1.0, n_terms=12, stat='sum'):
+        '''
+        Description
+        ---------
+        upstream sums of values for every basin (basin itself included), optionally weighted by flow distance
+
+        Parameters
+        ---------
+        values : array in graph order with one row per basin (see align), 1 or 2 dimensional
+        length_scale : km, None for unweighted sums (same as network_calc.upstream_summary 'sum')
+        kernel : 'exponential' or 'inverse_distance' (see module description)
+        power : power of inverse distance kernel
+        n_terms : number of exponential terms approximating the inverse distance kernel
+        stat : 'sum', or 'min' / 'max' of upstream values (nan ignored, no distance weighting)
+
+        Output
+        ---------
+        totals : array with the shape of values
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        flat = values.ndim == 1
+        values = values.reshape(self.n, -1)
+        if stat != 'sum':
+            if stat not in PATH_STATS or length_scale is not None:
+                raise ValueError(f'Upstream {stat} is not supported, use sum (optionally distance weighted), min or max')
+            totals = self._propagate(values, func=PATH_STATS[stat])
+        elif length_scale is None:
+            totals = self._propagate(values)
+        else:
+            if kernel not in KERNELS:
+                raise ValueError(f'Unknown kernel {kernel}, use one of {KERNELS}')
+            if self.edge_length is None:
+                raise ValueError('Distance weighted summaries require distances, build FlowGraph with dist (e.g. DIST_MAIN)')
+            if kernel == 'exponential':
+                totals = self._propagate(values, np.exp(-self.edge_length / length_scale))
+            else:
+                max_distance = self.max_distance()
+                weights, scales, max_error = exponential_mixture(length_scale, power, max_distance, n_terms)
+                if max_error > 0.05:
+                    print(f'Warning, inverse distance kernel approximated with max relative error {max_error:.3f}, increase n_terms')
+                totals = np.zeros(values.shape)
+                for weight, scale in zip(weights, scales):
+                    totals += weight * self._propagate(values, np.exp(-self.edge_length / scale))
+        return totals[:, 0] if flat else totals
+
+    def max_distance(self):
+        '''
+        Description
+        ---------
+        returns the longest flow path length in the graph (km)
+        '''
+        longest = np.zeros(self.n)
+        for level in self.levels:
+            targets = self.down[level]
+            has_down = targets >= 0
+            np.maximum.at(longest, targets[has_down], longest[level[has_down]] + self.edge_length[level[has_down]])
+        return float(longest.max()) if self.n else 0.0
+
+    def distance_to_outlet(self):
+        '''
+        Description
+        ---------
+        returns flow distance (km) from each basin's pour point to its ocean outlet or sink
+        '''
+        if self.edge_length is None:
+            raise ValueError('Distances require a FlowGraph built with dist (e.g. DIST_MAIN)')
+        distance = self.edge_length.copy()
+        for level in reversed(self.levels):
+            targets = self.down[level]
+            has_down = targets >= 0
+            distance[level[has_down]] += distance[targets[has_down]]
+        return distance
+
+    def upstream_ranges(self):
+        '''
+        Description
+        ---------
+        orders basins depth first from their outlets (Euler tour) so the upstream basins of every basin are one contiguous
+        range: basins upstream of position v (v included) are order[start[v]:start[v] + size[v]].  Built level by level.
+
+        Output
+        ---------
+        order, start, size : arrays of positions in tour order, tour index of each basin, number of upstream basins
+        '''
+        size = np.rint(self.accumulate(np.ones(self.n))).astype(np.int64)
+        has_down = self.down >= 0
+        #basins flowing into the same basin are placed one after another, each after the upstream ranges of the previous
+        children = np.flatnonzero(has_down)
+        children = children[np.argsort(self.down[children], kind='stable')]
+        before = np.cumsum(size[children]) - size[children]
+        group_first = np.searchsorted(self.down[children], self.down[children], side='left')
+        sibling_offset = np.zeros(self.n, dtype=np.int64)
+        sibling_offset[children] = before - before[group_first]
+        roots = np.flatnonzero(~has_down)
+        start = np.zeros(self.n, dtype=np.int64)
+        start[roots] = np.cumsum(size[roots]) - size[roots]
+        for level in reversed(self.levels):
+            level = level[has_down[level]]
+            start[level] = start[self.down[level]] + 1 + sibling_offset[level]
+        order = np.empty(self.n, dtype=np.int64)
+        order[start] = np.arange(self.n)
+        return order, start, size
+
+    def contract(self, pfaf_ids, pfaf_level, up_area=None):
+        '''
+        Description
+        ---------
+        contracts the level 12 graph to a coarser Pfafstetter level.  Each pfaf_level prefix becomes one node, its outlet is
+        the basin with the largest upstream area among basins draining out of the prefix, and the prefix drains to the
+        prefix of the basin below its outlet.
+
+        Parameters
+        ---------
+        pfaf_ids : array of level 12 PFAF_ID in graph order
+        pfaf_level : int, Pfafstetter level (e.g. 6)
+        up_area : optional array of UP_AREA in graph order, defaults to the number of upstream basins
+
+        Output
+        ---------
+        prefixes, next_down, outlets, dist : arrays with one row per prefix, pfaf_level id, pfaf_level id downstream (0 for
+                                            outlets and sinks), position of outlet basin, distance of outlet to its
+                                            ocean outlet or sink (nan without distances), use FlowGraph(prefixes, next_down, dist)
+        '''
+        pfaf_ids = np.asarray(pfaf_ids, dtype=np.int64)
+        n_digits = len(str(int(pfaf_ids.max())))
+        basin_prefix = pfaf_ids // 10 ** (n_digits - int(pfaf_level))
+        if up_area is None:
+            up_area = self.accumulate(np.ones(self.n))
+        up_area = np.asarray(up_area, dtype=np.float64)
+        down_prefix = np.zeros(self.n, dtype=np.int64)
+        has_down = self.down >= 0
+        down_prefix[has_down] = basin_prefix[self.down[has_down]]
+        leaving = np.flatnonzero(down_prefix != basin_prefix)
+        #largest upstream area first within each prefix, first row of each prefix is its outlet
+        leaving = leaving[np.lexsort((-up_area[leaving], basin_prefix[leaving]))]
+        first = np.r_[True, basin_prefix[leaving][1:] != basin_prefix[leaving][:-1]]
+        outlets = leaving[first]
+        if self.edge_length is not None:
+            dist = self.distance_to_outlet()[outlets]
+        else:
+            dist = np.full(len(outlets), np.nan)
+        return basin_prefix[outlets], down_prefix[outlets], outlets, dist
+
+
+class PathTable:
+    __slots__ = ['stat', 'levels']
+
+    def __init__(self, stat, levels):
+        '''
+        Description
+        ---------
+        aggregates of values over the 2**k basins starting at each basin and moving downstream (levels[k]), built by
+        DownstreamIndex.path_table
+        '''
+        self.stat = stat
+        self.levels = levels
+
+
+class DownstreamIndex:
+    def __init__(self, graph):
+        '''
+        Description
+        ---------
+        Downstream path index of a FlowGraph.  depth is the number of steps from a basin to its outlet (0 for outlets),
+        jump[k] is the basin 2**k steps downstream (-1 past the outlet).
+
+        Parameters
+        ---------
+        graph : FlowGraph
+
+        Example
+        ---------
+        index = flow_graph.DownstreamIndex(graph)
+        dams_below = index.downstream(graph.align(ids, dam_counts), 'sum')
+        '''
+        self.graph = graph
+        self.depth = np.zeros(graph.n, dtype=np.int64)
+        #levels run upstream to downstream, reversed each basin's downstream basin is set before the basin
+        for level in reversed(graph.levels):
+            targets = graph.down[level]
+            has_down = targets >= 0
+            self.depth[level[has_down]] = self.depth[targets[has_down]] + 1
+        self.max_depth = int(self.depth.max()) if graph.n else 0
+        self.jump = [graph.down.astype(np.int64)]
+        while (1 << len(self.jump)) <= self.max_depth:
+            previous = self.jump[-1]
+            self.jump.append(np.where(previous >= 0, previous[np.maximum(previous, 0)], -1))
+
+    @property
+    def nbytes(self):
+        return self.depth.nbytes + sum([jump.nbytes for jump in self.jump])
+
+    def _values(self, values, stat):
+        if stat not in PATH_STATS:
+            raise ValueError(f'Unknown path stat {stat}, use one of {list(PATH_STATS)}')
+        values = np.array(values, dtype=np.float64, copy=True).reshape(self.graph.n, -1)
+        if stat == 'sum':
+            values[np.isnan(values)] = 0.0
+        return values
+
+    def downstream(self, values, stat='sum', include_self=False):
+        '''
+        Description
+        ---------
+        aggregates values over the path from every basin to its outlet (ocean or endorheic sink), one pass over levels
+
+        Parameters
+        ---------
+        values : array in graph order (see FlowGraph.align), 1 or 2 dimensional
+        stat : 'sum', 'min' or 'max', nan values are ignored
+        include_self : include the basin's own value, False aggregates only basins downstream of it
+
+        Output
+        ---------
+        array with the shape of values, nan for min/max of basins with no downstream values
+        '''
+        flat = np.ndim(values) == 1
+        values = self._values(values, stat)
+        func = PATH_STATS[stat]
+        totals = values.copy()
+        for level in reversed(self.graph.levels):
+            targets = self.graph.down[level]
+            has_down = targets >= 0
+            totals[level[has_down]] = func(totals[level[has_down]], totals[targets[has_down]])
+        if not include_self:
+            below = np.full(totals.shape, 0.0 if stat == 'sum' else np.nan)
+            has_down = self.graph.down >= 0
+            below[has_down] = totals[self.graph.down[has_down]]
+            totals = below
+        return totals[:, 0] if flat else totals
+
+    def distance_to_outlet(self):
+        '''
+        Description
+        ---------
+        returns flow distance (km) from each basin's pour point to the ocean or sink, summed from graph edge lengths
+        '''
+        return self.graph.distance_to_outlet()
+
+    def kth_ancestor(self, positions, k):
+        '''
+        Description
+        ---------
+        returns positions of the basins k steps downstream of positions (vectorized), -1 where the path ends before k steps
+        '''
+        current = np.array(positions, dtype=np.int64, copy=True).reshape(-1)
+        k = np.broadcast_to(np.asarray(k, dtype=np.int64), current.shape)
+        current[(k < 0) | (k > np.where(current >= 0, self.depth[np.maximum(current, 0)], -1))] = -1
+        for bit, jump in enumerate(self.jump):
+            move = (current >= 0) & (((k >> bit) & 1) == 1)
+            current[move] = jump[current[move]]
+        return current
+
+    def path_table(self, values, stat='sum'):
+        '''
+        Description
+        ---------
+        builds PathTable of values for path_aggregate queries, O(n log depth) once per variable and stat
+        '''
+        func = PATH_STATS[stat]
+        levels = [self._values(values, stat)]
+        #one more level than jumps, paths can be max_depth + 1 basins long
+        for jump in self.jump:
+            previous = levels[-1]
+            has_jump = jump >= 0
+            combined = previous.copy()
+            combined[has_jump] = func(previous[has_jump], previous[jump[has_jump]])
+            levels.append(combined)
+        return PathTable(stat, levels)
+
+    def path_aggregate(self, table, positions, steps):
+        '''
+        Description
+        ---------
+        aggregates values over the next steps basins on the path starting at each position (the basin itself counts as
+        the first step), paths shorter than steps stop at the outlet.  O(log depth) per basin, vectorized over positions.
+
+        Parameters
+        ---------
+        table : PathTable from path_table
+        positions : array of basin positions (see FlowGraph.positions)
+        steps : int or array of number of basins to aggregate
+
+        Output
+        ---------
+        array with one row per position, one column per variable
+        '''
+        func = PATH_STATS[table.stat]
+        current = np.array(positions, dtype=np.int64, copy=True).reshape(-1)
+        steps = np.broadcast_to(np.asarray(steps, dtype=np.int64), current.shape)
+        #steps past the outlet add nothing, cap so only existing jumps are used
+        steps = np.minimum(steps, np.where(current >= 0, self.depth[np.maximum(current, 0)] + 1, 0))
+        n_columns = table.levels[0].shape[1]
+        result = np.full((len(current), n_columns), 0.0 if table.stat == 'sum' else np.nan)
+        for bit, level in enumerate(table.levels):
+            use = (current >= 0) & (((steps >> bit) & 1) == 1)
+            result[use] = func(result[use], level[current[use]])
+            if bit < len(self.jump):
+                current[use] = self.jump[bit][current[use]]
+        return result
+
+
+############################################################################################
+############################################################################################
@@ -0,0 +1,406 @@
+#Import packages
+import os
+import json
+import math
+import time
+import pickle
+import cProfile
+import pstats
+import io
+from collections import defaultdict
+from multiprocessing import util as mp_util
+from utils import memory
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    lightweight instrumentation for processing steps.  Includes timers (context manager or decorator), counters,
+    per worker aggregation of timers and counters back to the parent process, a json-lines log writer and
+    optional cProfile capture per worker that can be merged into one report.  Timers can also sample peak resident memory
+    of a stage (see utils/memory.py).
+
+    Note: only standard library packages are used so this module is cheap to import in worker processes
+'''
+
+
+class Metrics:
+    def __init__(self):
+        '''
+        Description
+        ---------
+        Holds timers (seconds per stage), number of timed calls per stage, counters and peaks (e.g. peak rss) for a process or task.
+        Peaks are combined using max instead of sum when metrics are merged.
+        '''
+        self.pid = os.getpid()
+        self.timers = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.peaks = {}
+
+    def add_time(self, stage, seconds):
+        self.timers[stage] += float(seconds)
+        self.calls[stage] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def peak(self, name, value):
+        if value > self.peaks.get(name, value - 1):
+            self.peaks[name] = value
+
+    def merge(self, other):
+        '''
+        Description
+        ---------
+        Adds timers, calls and counters from another Metrics object or from a snapshot (dict) into this object
+
+        Parameters
+        ---------
+        other : Metrics object or dictionary created using Metrics.snapshot()
+        '''
+        if isinstance(other, Metrics):
+            other = other.snapshot()
+        for stage, seconds in other['timers'].items():
+            self.timers[stage] += seconds
+        for stage, calls in other['calls'].items():
+            self.calls[stage] += calls
+        for name, value in other['counters'].items():
+            self.counters[name] += value
+        for name, value in other.get('peaks', {}).items():
+            self.peak(name, value)
+
+    def snapshot(self):
+        return {'pid': self.pid,
+                'timers': dict(self.timers),
+                'calls': dict(self.calls),
+                'counters': dict(self.counters),
+                'peaks': dict(self.peaks)}
+
+    def reset(self):
+        self.timers.clear()
+        self.calls.clear()
+        self.counters.clear()
+        self.peaks.clear()
+
+
+#Process level metrics, InstrumentedTask swaps in a fresh Metrics object while a task is running
+METRICS = Metrics()
+_active = METRICS
+
+#Process level profiler, only created if InstrumentedTask is asked to profile
+_profiler = None
+_profile_start = 0
+
+
+def active_metrics():
+    return _active
+
+
+def count(name, value=1):
+    '''
+    Description
+    ---------
+    Adds value to a named counter (e.g. 'zonal_stats_calls', 'bytes_read', 'basins_processed') of the active metrics
+    '''
+    _active.count(name, value)
+
+
+class Timer:
+    def __init__(self, stage, log=None, track_memory=False):
+        '''
+        Description
+        ---------
+        Times a stage of processing and adds the time to the active metrics.  Can be used as a context manager
+        or as a decorator.
+
+        Parameters
+        ---------
+        stage : str, name of the stage being timed (e.g. 'raster_io', 'result_assembly')
+        log : optional JsonlLog, if supplied a 'stage' record is written when the stage finishes
+        track_memory : bool, if True peak rss of the stage is sampled on a background thread and recorded as the peak
+                       f'{stage}_peak_rss' (bytes).  Intended for long stages, not per basin timers.
+
+        Example
+        ---------
+        with Timer('load_basins'):
+            gdf = f_mng.read_pkl_gdf()
+
+        @Timer('zonal_stats')
+        def run(): ...
+        '''
+        self.stage = stage
+        self.log = log
+        self.track_memory = track_memory
+        self.seconds = None
+        self.sampler = None
+
+    def __enter__(self):
+        if self.track_memory:
+            self.sampler = memory.PeakSampler().__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._start
+        _active.add_time(self.stage, self.seconds)
+        fields = {}
+        if self.sampler is not None:
+            self.sampler.__exit__(exc_type, exc_value, traceback)
+            _active.peak(f'{self.stage}_peak_rss', self.sampler.peak_bytes)
+            fields = {'peak_rss_mb': round(self.sampler.peak_bytes / 1048576, 1),
+                      'rss_delta_mb': round((self.sampler.end_bytes - self.sampler.start_bytes) / 1048576, 1)}
+        if self.log is not None:
+            self.log.write('stage', stage=self.stage, seconds=self.seconds, failed=exc_type is not None, **fields)
+        return False
+
+    def __call__(self, func):
+        stage = self.stage
+        log = self.log
+        track_memory = self.track_memory
+
+        def wrapper(*args, **kwargs):
+            with Timer(stage, log, track_memory):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+
+def timed(stage):
+    '''
+    Description
+    ---------
+    Decorator version of Timer, e.g. @timed('rasterization')
+    '''
+    return Timer(stage)
+
+
+_dtype_bytes = {'uint8': 1, 'int8': 1, 'uint16': 2, 'int16': 2, 'uint32': 4, 'int32': 4,
+                'float32': 4, 'float64': 8, 'int64': 8, 'uint64': 8}
+
+
+def estimate_window_bytes(xmin, xmax, ymin, ymax, pixel_size, dtype=None):
+    '''
+    Description
+    ---------
+    Estimates bytes read for a raster window covering the supplied bounds.  This is an estimate, block
+    layout of the raster is not considered.
+
+    Parameters
+    ---------
+    xmin, xmax, ymin, ymax : bounds of spatial unit in crs of the raster
+    pixel_size : pixel size of the raster (units of the crs)
+    dtype : str, numpy style name of the raster data type, defaults to 4 bytes per pixel if not known
+    '''
+    pixel_size = abs(float(pixel_size))
+    if pixel_size == 0:
+        return 0
+    cols = math.ceil((float(xmax) - float(xmin)) / pixel_size) + 1
+    rows = math.ceil((float(ymax) - float(ymin)) / pixel_size) + 1
+    return int(rows * cols * _dtype_bytes.get(str(dtype), 4))
+
+
+class JsonlLog:
+    def __init__(self, file_path, run_id=None):
+        '''
+        Description
+        ---------
+        Machine readable log, one json record per line.  Every record includes the record type, run id, pid and time
+
+        Parameters
+        ---------
+        file_path : str, path to log file (e.g. 'output/step2_metrics.jsonl'), records are appended
+        run_id : str, identifier of the run, defaults to start time of the run
+        '''
+        self.file_path = file_path
+        self.run_id = run_id or time.strftime('%Y%m%dT%H%M%S')
+
+    def write(self, record_type, **fields):
+        record = {'type': record_type, 'run_id': self.run_id, 'pid': os.getpid(), 'time': time.time()}
+        record.update(fields)
+        with open(self.file_path, 'a') as outfile:
+            outfile.write(json.dumps(record, default=str) + '\n')
+
+    def write_metrics(self, metrics, label='run', **fields):
+        '''
+        Description
+        ---------
+        Writes a 'metrics' record with timers, calls and counters from a Metrics object or snapshot
+        '''
+        if isinstance(metrics, Metrics):
+            metrics = metrics.snapshot()
+        fields.update(metrics)
+        #keep pid of the record as the pid the metrics were collected in
+        fields['metrics_pid'] = fields.pop('pid', None)
+        self.write('metrics', label=label, **fields)
+
+
+def _dump_profile(profile_dir):
+    #start time in the name so a reused pid (e.g. pool of a later region) does not overwrite an earlier capture
+    if _profiler is not None:
+        _profiler.dump_stats(os.path.join(profile_dir, f'worker_{os.getpid()}_{_profile_start}.prof'))
+
+
+class InstrumentedTask:
+    def __init__(self, func, profile_dir=None, measure_pickle=False):
+        '''
+        Description
+        ---------
+        Wraps a function that is mapped across worker processes so metrics collected while running each task are
+        returned to the parent with the result.  Use unpack_results in the parent to split results from metrics.
+
+        Parameters
+        ---------
+        func : function (or functools.partial) to run for each task
+        profile_dir : str, optional directory, if supplied a cProfile capture is kept per worker and written to
+                      f'{profile_dir}/worker_{pid}_{start}.prof' when the worker exits.  Merge with merge_profiles,
+                      clear captures of earlier runs with clear_profiles before the run.
+        measure_pickle : bool, if True time and size the pickling of each result (this pickles results twice)
+
+        Output
+        ---------
+        each call returns a tuple (result, metrics snapshot)
+        '''
+        self.func = func
+        self.profile_dir = profile_dir
+        self.measure_pickle = measure_pickle
+
+    def _start_profiler(self):
+        global _profiler, _profile_start
+        if _profiler is None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            _profiler = cProfile.Profile()
+            _profile_start = time.time_ns()
+            mp_util.Finalize(None, _dump_profile, args=(self.profile_dir,), exitpriority=10)
+        _profiler.enable()
+
+    def __call__(self, *args, **kwargs):
+        global _active
+        task_metrics = Metrics()
+        previous = _active
+        _active = task_metrics
+        if self.profile_dir:
+            self._start_profiler()
+        try:
+            with Timer('task'):
+                result = self.func(*args, **kwargs)
+        finally:
+            if self.profile_dir:
+                _profiler.disable()
+            _active = previous
+        #peak rss of the worker process so far, merged using max so per worker peaks are reported in the parent
+        task_metrics.peak('worker_peak_rss', memory.peak_rss_bytes())
+        if self.measure_pickle:
+            start = time.perf_counter()
+            task_metrics.count('result_bytes', len(pickle.dumps(result)))
+            task_metrics.add_time('result_pickle', time.perf_counter() - start)
+        return result, task_metrics.snapshot()
+
+
+def unpack_results(results, metrics=None):
+    '''
+    Description
+    ---------
+    Splits results returned from InstrumentedTask into results and metrics, aggregating metrics overall and per worker
+
+    Parameters
+    ---------
+    results : list of (result, metrics snapshot) tuples
+    metrics : Metrics object to add task metrics to, defaults to the process level metrics
+
+    Output
+    ---------
+    task_results : list of results in the same order as supplied
+    per_worker : dictionary of Metrics objects keyed by worker pid
+    '''
+    if metrics is None:
+        metrics = METRICS
+    task_results = []
+    per_worker = {}
+    for result, snapshot in results:
+        task_results.append(result)
+        metrics.merge(snapshot)
+        pid = snapshot['pid']
+        if pid not in per_worker:
+            per_worker[pid] = Metrics()
+            per_worker[pid].pid = pid
+        per_worker[pid].merge(snapshot)
+    return task_results, per_worker
+
+
+def clear_profiles(profile_dir):
+    '''
+    Description
+    ---------
+    Removes worker_*.prof captures of earlier runs from profile_dir so merge_profiles only merges the current run
+    '''
+    if not os.path.isdir(profile_dir):
+        return
+    for f in os.listdir(profile_dir):
+        if f.startswith('worker_') and f.endswith('.prof'):
+            os.remove(os.path.join(profile_dir, f))
+
+
+def merge_profiles(profile_dir, outfile=None, sort='cumulative', top=40):
+    '''
+    Description
+    ---------
+    Merges cProfile captures written by InstrumentedTask workers into one report
+
+    Parameters
+    ---------
+    profile_dir : str, directory holding worker_*.prof files
+    outfile : str, optional path to write merged pstats data (can be opened with pstats or snakeviz)
+    sort : str, pstats sort key
+    top : int, number of functions to include in report
+
+    Output
+    ---------
+    report : str, text report of merged profile, None if no profiles were found
+    '''
+    files = [os.path.join(profile_dir, f) for f in sorted(os.listdir(profile_dir))
+             if f.startswith('worker_') and f.endswith('.prof')]
+    if not files:
+        return None
+    stream = io.StringIO()
+    stats = pstats.Stats(*files, stream=stream)
+    if outfile:
+        stats.dump_stats(outfile)
+    stats.sort_stats(sort).print_stats(top)
+    return stream.getvalue()
+
+
+def summary(metrics=None):
+    '''
+    Description
+    ---------
+    Returns a short text summary of timers and counters, stages sorted by time
+    '''
+    if metrics is None:
+        metrics = METRICS
+    if isinstance(metrics, dict):
+        snapshot = metrics
+    else:
+        snapshot = metrics.snapshot()
+    lines = []
+    for stage, seconds in sorted(snapshot['timers'].items(), key=lambda x: -x[1]):
+        lines.append(f"{stage}: {seconds:.2f} s ({snapshot['calls'].get(stage, 0)} calls)")
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append(f'{name}: {value}')
+    for name, value in sorted(snapshot.get('peaks', {}).items()):
+        if name.endswith('_rss'):
+            lines.append(f'{name}: {value/1048576:.1f} MB')
+        else:
+            lines.append(f'{name}: {value}')
+    return '\n'.join(lines)
+
+
+############################################################################################
+############################################################################################
@@ -0,0 +1,246 @@
+#Import packages
+import os
+import sys
+import json
+import time
+import resource
+import threading
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    memory tracking and memory budgets for global scale steps.  Includes resident memory (rss) readings, a sampler that
+    captures peak rss during a stage, and a MemoryBudget object that learns bytes per basin from past runs, warns before a
+    stage is likely to exceed the budget and chooses worker count and chunk size for pool drivers.
+
+    Budget is set by parameter or the environment variable GFF_MEMORY_BUDGET (e.g. GFF_MEMORY_BUDGET=24GB), otherwise 80% of
+    available memory is used.
+'''
+
+_units = {'b': 1, 'kb': 1024, 'mb': 1024**2, 'gb': 1024**3, 'tb': 1024**4}
+
+
+def parse_bytes(value):
+    '''
+    Description
+    ---------
+    Converts values such as '16GB', '500 mb' or 1e9 to bytes (int)
+    '''
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip().lower().replace(' ', '')
+    for unit in sorted(_units, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * _units[unit])
+    return int(float(text))
+
+
+def rss_bytes():
+    '''
+    Description
+    ---------
+    Returns current resident memory (bytes) of this process.  Uses /proc when available (linux), otherwise peak resident memory
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    '''
+    Description
+    ---------
+    Returns peak resident memory (bytes) of this process over its lifetime
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is kilobytes on linux and bytes on mac
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def available_bytes():
+    '''
+    Description
+    ---------
+    Returns memory available to new processes (bytes).  Uses MemAvailable from /proc/meminfo when available otherwise physical memory
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class PeakSampler:
+    def __init__(self, interval=0.2):
+        '''
+        Description
+        ---------
+        Samples rss on a background thread while a stage runs, capturing peak rss of the stage.
+        Use as a context manager, after exit start_bytes, peak_bytes and end_bytes are available.
+
+        Parameters
+        ---------
+        interval : seconds between samples
+        '''
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, rss_bytes())
+
+    def __enter__(self):
+        self.start_bytes = rss_bytes()
+        self.peak_bytes = self.start_bytes
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.end_bytes = rss_bytes()
+        self.peak_bytes = max(self.peak_bytes, self.end_bytes)
+        return False
+
+
+class MemoryBudget:
+    def __init__(self, budget=None, profile_file='output/memory_profile.json'):
+        '''
+        Description
+        ---------
+        Memory budget used by pool drivers
+
+        Parameters
+        ---------
+        budget : bytes or str (e.g. '24GB'), defaults to GFF_MEMORY_BUDGET environment variable or 80% of available memory
+        profile_file : str, json file of bytes per basin measured in previous runs, updated by record
+        '''
+        if budget is None:
+            budget = os.environ.get('GFF_MEMORY_BUDGET')
+        if budget is None:
+            budget = int(available_bytes() * 0.8)
+        self.budget = parse_bytes(budget)
+        self.profile_file = profile_file
+        self.profile = {}
+        if profile_file and os.path.exists(profile_file):
+            with open(profile_file, 'r') as infile:
+                self.profile = json.load(infile)
+
+    def record(self, stage, n_basins, n_bytes):
+        '''
+        Description
+        ---------
+        Records measured memory use of a stage as bytes per basin, stored to profile_file for use in later runs
+
+        Parameters
+        ---------
+        stage : str, name of stage (e.g. 'load_basins', 'worker')
+        n_basins : number of basins held by the stage
+        n_bytes : bytes used by the stage, typically rss after minus rss before or peak minus start from PeakSampler
+        '''
+        if n_basins <= 0 or n_bytes <= 0:
+            return
+        self.profile[stage] = {'bytes_per_basin': n_bytes / n_basins, 'n_basins': int(n_basins), 'updated': time.strftime('%Y-%m-%d %H:%M:%S')}
+        if self.profile_file:
+            tmp_file = f'{self.profile_file}.tmp'
+            with open(tmp_file, 'w') as outfile:
+                json.dump(self.profile, outfile, indent=1)
+            os.replace(tmp_file, self.profile_file)
+
+    def bytes_per_basin(self, stage, default=None):
+        if stage in self.profile:
+            return self.profile[stage]['bytes_per_basin']
+        return default
+
+    def check(self, stage, n_bytes, in_use=None):
+        '''
+        Description
+        ---------
+        Warns (print) if a stage is likely to exceed the budget
+
+        Parameters
+        ---------
+        stage : str, name of stage, used in warning
+        n_bytes : estimated additional bytes needed by stage
+        in_use : bytes already in use, defaults to rss of this process
+
+        Output
+        ---------
+        fits : bool, False if estimate exceeds budget
+        '''
+        if in_use is None:
+            in_use = rss_bytes()
+        estimate = in_use + n_bytes
+        if estimate > self.budget:
+            print(f'Warning, {stage} is estimated to need {estimate/1024**3:.1f} GB, memory budget is {self.budget/1024**3:.1f} GB')
+            return False
+        return True
+
+    def check_basins(self, stage, n_basins, in_use=None):
+        '''
+        Description
+        ---------
+        Same as check but estimate is based on measured bytes per basin for the stage, no check if stage has not been measured
+        '''
+        per_basin = self.bytes_per_basin(stage)
+        if per_basin is None:
+            return True
+        return self.check(stage, per_basin * n_basins, in_use)
+
+    def plan_pool(self, n_tasks, worker_bytes, result_bytes=0, max_workers=None, max_chunksize=64, parent_bytes=None):
+        '''
+        Description
+        ---------
+        Chooses worker count and chunk size so the pool is expected to stay within budget.  Warns (print) if even one worker does not fit.
+
+        Parameters
+        ---------
+        n_tasks : number of tasks to map
+        worker_bytes : estimated bytes used by each worker (e.g. copy of basin data plus working memory)
+        result_bytes : estimated bytes of the result of one task, results of a chunk are held by the worker and the parent
+        max_workers : upper limit of workers, defaults to number of cpus minus one
+        max_chunksize : upper limit of chunksize
+        parent_bytes : bytes held by the parent process, defaults to rss of this process
+
+        Output
+        ---------
+        workers : int
+        chunksize : int
+        '''
+        if max_workers is None:
+            max_workers = max(1, (os.cpu_count() or 2) - 1)
+        if parent_bytes is None:
+            parent_bytes = rss_bytes()
+        #results of all tasks are collected by the parent
+        headroom = self.budget - parent_bytes - (result_bytes * n_tasks)
+        workers = int(headroom // worker_bytes) if worker_bytes > 0 else max_workers
+        workers = max(1, min(workers, max_workers, max(1, n_tasks)))
+        if headroom < worker_bytes:
+            print(f'Warning, pool of 1 worker is estimated to exceed memory budget of {self.budget/1024**3:.1f} GB')
+
+        chunksize, extra = divmod(n_tasks, workers * 4)
+        if extra:
+            chunksize += 1
+        if result_bytes > 0:
+            #each worker may hold a chunk of results while the parent holds another
+            spare = max(0, headroom - workers * worker_bytes)
+            chunksize = min(chunksize, int(spare // (2 * workers * result_bytes)))
+        chunksize = max(1, min(chunksize, max_chunksize))
+        return workers, chunksize
+
+
+############################################################################################
+############################################################################################
@@ -1,9 +1,13 @@
 #Import packages
 from utils import file_management as f_mng
+from utils import attribution as attr
+from utils import flow_graph
+from utils import memory
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 import h5py
-import sys
+import os
 
 
 ############################################################################################
@@ -16,6 +20,11 @@ import sys
     Description
     ---------
     methods to help support upstream summaries of variables, these methods currently include target basin  
+    network records are read with NetworkReader (one open file per process, batched reads, LRU cache of records)
+    upstream_decay_summary computes flow distance weighted summaries for all basins in one pass (see utils/flow_graph.py)
+    downstream_summary aggregates variables between each basin and its outlet (ocean or endorheic sink)
+    contracted_network and pfaf_upstream_summary give upstream summaries at coarser pfaf levels (e.g. 06 to 08)
+    upstream_quantiles and pfaf_quantiles give approximate percentiles by merging basin histograms (attribution.write_sketches)
 '''
 class BasinInfo(object):
     """ Define a river segment """
@@ -28,21 +37,135 @@ class BasinInfo(object):
         self.order=None
         self.up_seg_ids=None
 
+    @property
+    def nbytes(self):
+        #approximate size held in the NetworkReader cache
+        return 200 + (self.up_seg_ids.nbytes if self.up_seg_ids is not None else 0)
+
+
+class NetworkReader:
+    def __init__(self, hdf_name='output/hb12_network.h5', cache_bytes=None):
+        '''
+        Description
+        ---------
+        Reads basin records of the upstream network hdf file (step4_build_upstream_network.ipynb).  The file is opened
+        once per process (reopened after a fork), records are read in storage order by get_many and decoded records
+        (sorted up_seg_ids) are kept in a least recently used cache bounded by bytes.
+
+        Parameters
+        ---------
+        hdf_name: str, network hdf file
+        cache_bytes: max bytes of cached records (e.g. 256 * 1024**2 or '1GB'), defaults to GFF_NETWORK_CACHE or 256MB, 0 disables cache
+        '''
+        self.hdf_name = hdf_name
+        if cache_bytes is None:
+            cache_bytes = os.environ.get('GFF_NETWORK_CACHE', '256MB')
+        self.cache_bytes = memory.parse_bytes(cache_bytes)
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._h5 = None
+        self._pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self):
+        #an hdf handle inherited through fork is not safe to use, each process opens its own
+        if self._h5 is None or self._pid != os.getpid():
+            self._cache.clear()
+            self._cached_bytes = 0
+            self._h5 = h5py.File(self.hdf_name, 'r')
+            self._pid = os.getpid()
+        return self._h5
+
+    def close(self):
+        if self._h5 is not None and self._pid == os.getpid():
+            self._h5.close()
+        self._h5 = None
+
+    def _decode(self, basin_id, grp):
+        item = BasinInfo()
+        item.id = basin_id
+        item.area = np.array(grp.get('area'), dtype=np.float32)
+        item.tot_area = np.array(grp.get('tot_area'), dtype=np.float32)
+        item.pfaf_id = np.array(grp.get('pfaf_id'), dtype=np.int64)
+        item.order = np.array(grp.get('order'), dtype=np.int8)
+        item.up_seg_ids = np.sort(np.array(grp.get('up_seg_ids'), dtype=np.int64))
+        return item
+
+    def _remember(self, basin_id, item):
+        if self.cache_bytes <= 0 or item.nbytes > self.cache_bytes:
+            return
+        self._cache[basin_id] = item
+        self._cached_bytes += item.nbytes
+        while self._cached_bytes > self.cache_bytes:
+            old_id, old_item = self._cache.popitem(last=False)
+            self._cached_bytes -= old_item.nbytes
+
+    def get_many(self, basin_ids):
+        '''
+        Description
+        ---------
+        returns records of basin_ids, read in the order records are stored in the file (fewer seeks than id order)
+
+        Output
+        ---------
+        items: dictionary of basin id (int) to BasinInfo, None for ids not in the network
+        '''
+        h5 = self._file()
+        items = {}
+        to_read = []
+        #duplicate ids are read (and counted as misses) once
+        for basin_id in dict.fromkeys(int(basin_id) for basin_id in basin_ids):
+            if basin_id in self._cache:
+                self._cache.move_to_end(basin_id)
+                items[basin_id] = self._cache[basin_id]
+                self.hits += 1
+                continue
+            grp = h5.get(str(basin_id))
+            if grp is None:
+                items[basin_id] = None
+                continue
+            to_read.append((h5py.h5o.get_info(grp.id).addr, basin_id, grp))
+        for addr, basin_id, grp in sorted(to_read, key=lambda x: x[0]):
+            item = self._decode(basin_id, grp)
+            self.misses += 1
+            self._remember(basin_id, item)
+            items[basin_id] = item
+        return items
+
+    def get(self, basin_id):
+        '''
+        Description
+        ---------
+        returns BasinInfo of one basin, None if the basin is not in the network
+        '''
+        return self.get_many([basin_id])[int(basin_id)]
+
+    def __repr__(self):
+        return (f'NetworkReader({self.hdf_name}, cached {len(self._cache)} records {self._cached_bytes/1024**2:.1f} MB, '
+                f'hits {self.hits}, misses {self.misses})')
+
+
+_readers = {}
+
+
+def network_reader(hdf_name='output/hb12_network.h5'):
+    '''
+    Description
+    ---------
+    returns the NetworkReader of the current process for hdf_name, shared by calls so the file stays open and cached
+    '''
+    key = (os.getpid(), hdf_name)
+    if key not in _readers:
+        _readers[key] = NetworkReader(hdf_name)
+    return _readers[key]
+
+
 def get(hdf_name, basin_id):
-    """ Given a hdf5 file name, obtain the record for the specified idNumber """
-    item=BasinInfo() # Init a river segment
-    with h5py.File(hdf_name,'r') as h5: # Open the hdf5 database and grab the entry
-      tmp=h5.get(str(basin_id))
-      item.id=basin_id
-      try:
-        item.area=np.array(tmp.get('area'),dtype=np.float32)
-        item.tot_area=np.array(tmp.get('tot_area'),dtype=np.float32)
-        item.pfaf_id=np.array(tmp.get('pfaf_id'),dtype=np.int)
-        item.order=np.array(tmp.get('order'),dtype=np.int8)
-        item.up_seg_ids=np.sort(np.array(tmp.get('up_seg_ids'),dtype=np.int))
-      except:
+    """ Given a hdf5 file name, obtain the record for the specified idNumber, None if the id is not in the file """
+    item = network_reader(hdf_name).get(basin_id)
+    if item is None:
         print(f'The hdf database does not contain data for id number {basin_id}.')
-        sys.exit()
     return item
 
 
@@ -54,7 +177,7 @@ def add_field_from_hb12(df, field_name, df_hybas_id='HYBAS_ID'):
     field_name: str, name of column that needs to be merged into df.  multiple fields can be defined but must be comma delimited
     df_hybas_id: str, this is the join field of ids, included as variable in case name changed 
     '''
-    hb12_df = f_mng.read_pkl_df(file_path='data/basins_lvl12_df.pkl')
+    hb12_df = f_mng.load_basin_df()
     hb12_df = hb12_df[['HYBAS_ID', field_name]]
     df_merge = df.merge(hb12_df, how='left', left_on=df_hybas_id, right_on='HYBAS_ID')
     return df_merge
@@ -97,6 +220,9 @@ def upstream_summary(np_basin_local_var_data, col_names, summary_type, basin_id)
     hdf_name='output/hb12_network.h5'
     #get basin info from hdf
     basin_info = get(hdf_name, str(int(basin_id)))
+    if basin_info is None:
+        #missing ids are reported in results instead of stopping the pool
+        return {'hybas_id': int(basin_id), 'missing': True}
     #get list of upstream basin ids, add target id to list
     upstream_basins = basin_info.up_seg_ids.tolist()
     #Add target basin to list
@@ -124,5 +250,257 @@ def upstream_summary(np_basin_local_var_data, col_names, summary_type, basin_id)
     return basin_upstream_stats
 
 
+def upstream_decay_summary(local_var_df, var_cols, length_scale, kernel='exponential', summary_type='sum', weight_col='SUB_AREA',
+                           id_col='HYBAS_ID', basin_df=None, dist_col='DIST_MAIN', power=1.0, graph=None):
+    '''
+    Description
+    ---------
+    upstream summaries of local variables for all basins, weighted by flow distance to each basin (see utils/flow_graph.py)
+
+    Parameters
+    ---------
+    local_var_df: pandas dataframe with id_col and var_cols (e.g. local stats from attribution.json_stats_to_csv)
+    var_cols: list of str, column names to summarize
+    length_scale: float, km, None for unweighted summaries (same as upstream_summary)
+    kernel: 'exponential' or 'inverse_distance'
+    summary_type: 'sum' or 'area_weighted_mean' (distance weighted mean, weighted by weight_col of basin_df)
+    weight_col: str, basin_df column used as weight for area_weighted_mean
+    basin_df: HydroBASINS attributes with HYBAS_ID, NEXT_DOWN, PFAF_ID and dist_col, defaults to f_mng.load_basin_df()
+    dist_col: 'DIST_MAIN' or 'DIST_SINK'
+    power: power of inverse distance kernel
+    graph: optional flow_graph.FlowGraph reused between calls
+
+    Output
+    ---------
+    df: dataframe with hybas_id, pfaf_id and f'{col}_up_{kernel short name}{length_scale}' columns (e.g. crop_up_exp50)
+    '''
+    if summary_type not in ['sum', 'area_weighted_mean']:
+        raise ValueError(f'Unsupported summary_type {summary_type}, use sum or area_weighted_mean')
+    if basin_df is None:
+        basin_df = f_mng.load_basin_df()
+    if graph is None:
+        graph = flow_graph.FlowGraph.from_basin_df(basin_df, dist_col if length_scale is not None else None)
+
+    values = local_var_df[var_cols].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0.0)
+    ids = local_var_df[id_col].to_numpy()
+    if summary_type == 'area_weighted_mean':
+        weights = graph.align(basin_df['HYBAS_ID'].to_numpy(), basin_df[weight_col].to_numpy(dtype=np.float64))
+        #basins missing a value do not add weight to the mean of that column
+        pos = graph.positions(ids)
+        weight = np.where(pos[:, None] >= 0, weights[pos], 0.0)
+        numerator = graph.accumulate(graph.align(ids, values * weight), length_scale, kernel, power)
+        denominator = graph.accumulate(graph.align(ids, valid * weight), length_scale, kernel, power)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats = np.where(denominator > 0, numerator / denominator, np.nan)
+    else:
+        stats = graph.accumulate(graph.align(ids, values), length_scale, kernel, power)
+
+    if length_scale is None:
+        suffix = 'up'
+    else:
+        suffix = f"up_{'exp' if kernel == 'exponential' else 'idw'}{length_scale:g}"
+    pfaf = basin_df[['HYBAS_ID', 'PFAF_ID']].set_index('HYBAS_ID')['PFAF_ID']
+    df = pd.DataFrame({'hybas_id': graph.hybas_ids, 'pfaf_id': pfaf.reindex(graph.hybas_ids).to_numpy()})
+    for i, col in enumerate(var_cols):
+        df[f'{col}_{suffix}'] = stats[:, i]
+    return df
+
+
+def downstream_summary(local_var_df, var_cols, stat='sum', include_self=False, id_col='HYBAS_ID', basin_df=None, index=None):
+    '''
+    Description
+    ---------
+    summaries of local variables over the basins downstream of every basin, e.g. number of GRanD dams or reservoir
+    capacity between a basin and the ocean or sink, minimum protected fraction downstream
+
+    Parameters
+    ---------
+    local_var_df: pandas dataframe with id_col and var_cols
+    var_cols: list of str, column names to summarize
+    stat: 'sum', 'min' or 'max', missing values are ignored
+    include_self: include the basin's own value
+    basin_df: HydroBASINS attributes with HYBAS_ID, NEXT_DOWN and PFAF_ID, defaults to f_mng.load_basin_df()
+    index: optional flow_graph.DownstreamIndex reused between calls
+
+    Output
+    ---------
+    df: dataframe with hybas_id, pfaf_id, dist_outlet (km, when DIST_MAIN is available) and f'{col}_dn_{stat}' columns
+    '''
+    if basin_df is None:
+        basin_df = f_mng.load_basin_df()
+    if index is None:
+        index = flow_graph.DownstreamIndex(flow_graph.FlowGraph.from_basin_df(basin_df))
+    graph = index.graph
+    values = local_var_df[var_cols].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    aligned = np.full((graph.n, len(var_cols)), np.nan)
+    pos = graph.positions(local_var_df[id_col].to_numpy())
+    aligned[pos[pos >= 0]] = values[pos >= 0]
+    stats = index.downstream(aligned, stat, include_self)
+
+    pfaf = basin_df[['HYBAS_ID', 'PFAF_ID']].set_index('HYBAS_ID')['PFAF_ID']
+    df = pd.DataFrame({'hybas_id': graph.hybas_ids, 'pfaf_id': pfaf.reindex(graph.hybas_ids).to_numpy()})
+    if graph.edge_length is not None:
+        df['dist_outlet'] = index.distance_to_outlet()
+    for i, col in enumerate(var_cols):
+        df[f'{col}_dn_{stat}'] = stats[:, i]
+    return df
+
+
+def contracted_network(pfaf_level, basin_df=None, graph=None, outfile=None):
+    '''
+    Description
+    ---------
+    builds the upstream network of a coarser pfaf level from the level 12 NEXT_DOWN graph (see FlowGraph.contract).
+    Only needs to be built once per level, the table is small enough to save and reuse (e.g. 'output/pfaf06_network.csv').
+
+    Parameters
+    ---------
+    pfaf_level: HydroBASINS pfaf basin level, str, choices include ['02','03','04','05','06','07','08','09','10','11']
+    basin_df: HydroBASINS level 12 attributes with HYBAS_ID, NEXT_DOWN, PFAF_ID, UP_AREA and DIST_MAIN, defaults to f_mng.load_basin_df()
+    graph: optional level 12 flow_graph.FlowGraph
+    outfile: optional csv path
+
+    Output
+    ---------
+    network_df: dataframe with f'pfaf_{pfaf_level}', NEXT_DOWN (downstream pfaf id, 0 for outlets), OUTLET_ID (HYBAS_ID of
+                outlet basin) and DIST_MAIN (km from outlet to the ocean or sink)
+    '''
+    if basin_df is None:
+        basin_df = f_mng.load_basin_df()
+    if graph is None:
+        graph = flow_graph.FlowGraph.from_basin_df(basin_df)
+    basins = basin_df.set_index('HYBAS_ID').reindex(graph.hybas_ids)
+    up_area = basins['UP_AREA'].to_numpy(dtype=np.float64) if 'UP_AREA' in basins.columns else None
+    prefixes, next_down, outlets, dist = graph.contract(basins['PFAF_ID'].to_numpy(), pfaf_level, up_area)
+    network_df = pd.DataFrame({f'pfaf_{pfaf_level}': prefixes, 'NEXT_DOWN': next_down,
+                               'OUTLET_ID': graph.hybas_ids[outlets], 'DIST_MAIN': dist})
+    if outfile:
+        network_df.to_csv(outfile, sep=',', index=False)
+    return network_df
+
+
+def pfaf_upstream_summary(summary_df, pfaf_level, network_df, length_scale=None, kernel='exponential'):
+    '''
+    Description
+    ---------
+    upstream summaries of pfaf level basins from their local summaries (pfaf_summarize.summarize) and the contracted
+    network, without reading level 12 data.  mean columns are area weighted (sub_area), max and min columns take the
+    upstream max and min, sum, count and nodata columns are summed.
+
+    Parameters
+    ---------
+    summary_df: dataframe from pfaf_summarize.summarize
+    pfaf_level: str, same level as summary_df (e.g. '06')
+    network_df: dataframe from contracted_network for the same level
+    length_scale, kernel: optional distance weighting of sums and means (see upstream_decay_summary)
+
+    Output
+    ---------
+    df: dataframe with f'pfaf_{pfaf_level}' and f'{col}_up' columns for each summarized column, up_area is the sum of sub_area
+    '''
+    pfaf_field_name = f'pfaf_{pfaf_level}'
+    graph = flow_graph.FlowGraph(network_df[pfaf_field_name].to_numpy(), network_df['NEXT_DOWN'].to_numpy(),
+                                 network_df['DIST_MAIN'].to_numpy() if length_scale is not None else None)
+    ids = summary_df[pfaf_field_name].to_numpy()
+    area = graph.align(ids, summary_df['sub_area'].to_numpy(dtype=np.float64))
+    df = pd.DataFrame({pfaf_field_name: graph.hybas_ids})
+    df['up_area'] = graph.accumulate(area, length_scale, kernel)[:, 0]
+    for col in summary_df.columns:
+        if col in [pfaf_field_name, 'sub_area']:
+            continue
+        values = pd.to_numeric(summary_df[col], errors='coerce').to_numpy(dtype=np.float64)
+        if col.endswith('mean'):
+            valid = ~np.isnan(values)
+            weight = summary_df['sub_area'].to_numpy(dtype=np.float64)
+            numerator = graph.accumulate(graph.align(ids, np.where(valid, values * weight, 0.0)), length_scale, kernel)
+            denominator = graph.accumulate(graph.align(ids, np.where(valid, weight, 0.0)), length_scale, kernel)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                up = np.where(denominator > 0, numerator / denominator, np.nan)[:, 0]
+        elif col.endswith(('max', 'min')):
+            aligned = np.full((graph.n, 1), np.nan)
+            pos = graph.positions(ids)
+            aligned[pos[pos >= 0], 0] = values[pos >= 0]
+            up = graph.accumulate(aligned, stat=col[-3:])[:, 0]
+        elif col.endswith(('sum', 'count', 'nodata')):
+            up = graph.accumulate(graph.align(ids, np.nan_to_num(values)), length_scale, kernel)[:, 0]
+        else:
+            continue
+        df[f'{col}_up'] = up
+    return df
+
+
+def _quantile_name(label, q):
+    return f'{label}_p{q * 100:g}'.replace('.', '_')
+
+
+def upstream_quantiles(sketch_file, label, quantiles=(0.5, 0.9), basin_df=None, graph=None):
+    '''
+    Description
+    ---------
+    approximate percentiles of pixel values over each basin and everything upstream of it (e.g. upstream median slope),
+    basin histograms are added along the network in one pass (see utils/flow_graph.py) instead of reading pixels again.
+    Memory is number of basins x number of bins.
+
+    Parameters
+    ---------
+    sketch_file: str, npz file from attribution.write_sketches (e.g. 'output/tif_hb12_sketch.npz')
+    label: str, label of variable
+    quantiles: list of quantiles, e.g. [0.5, 0.9]
+    basin_df: HydroBASINS attributes with HYBAS_ID, NEXT_DOWN and PFAF_ID, defaults to f_mng.load_basin_df()
+    graph: optional flow_graph.FlowGraph reused between calls
+
+    Output
+    ---------
+    df: dataframe with hybas_id, pfaf_id and f'{label}_p{q * 100}_up' columns (e.g. slope_p50_up)
+    '''
+    ids, counts, edges = attr.read_sketches(sketch_file, label)
+    if basin_df is None:
+        basin_df = f_mng.load_basin_df()
+    if graph is None:
+        graph = flow_graph.FlowGraph.from_basin_df(basin_df, dist_col=None)
+    upstream_counts = graph.accumulate(graph.align(ids, counts))
+    values = attr.sketch_quantiles(upstream_counts, edges, quantiles)
+    pfaf = basin_df[['HYBAS_ID', 'PFAF_ID']].set_index('HYBAS_ID')['PFAF_ID']
+    df = pd.DataFrame({'hybas_id': graph.hybas_ids, 'pfaf_id': pfaf.reindex(graph.hybas_ids).to_numpy()})
+    for i, q in enumerate(quantiles):
+        df[f'{_quantile_name(label, q)}_up'] = values[:, i]
+    return df
+
+
+def pfaf_quantiles(sketch_file, label, pfaf_level, quantiles=(0.5, 0.9), basin_df=None):
+    '''
+    Description
+    ---------
+    approximate percentiles of pixel values over local areas of pfaf level basins, merging level 12 basin histograms
+
+    Parameters
+    ---------
+    sketch_file, label, quantiles: see upstream_quantiles
+    pfaf_level: HydroBASINS pfaf basin level, str, choices include ['02','03','04','05','06','07','08','09','10','11']
+    basin_df: HydroBASINS attributes with HYBAS_ID and PFAF_ID, defaults to f_mng.load_basin_df()
+
+    Output
+    ---------
+    df: dataframe with f'pfaf_{pfaf_level}' and f'{label}_p{q * 100}' columns
+    '''
+    ids, counts, edges = attr.read_sketches(sketch_file, label)
+    if basin_df is None:
+        basin_df = f_mng.load_basin_df()
+    pfaf = basin_df[['HYBAS_ID', 'PFAF_ID']].set_index('HYBAS_ID')['PFAF_ID'].reindex(ids)
+    keep = pfaf.notna().to_numpy()
+    pfaf_12 = pfaf.to_numpy()[keep].astype(np.int64)
+    prefixes = pfaf_12 // 10 ** (len(str(int(pfaf_12.max()))) - int(pfaf_level))
+    unique_prefixes, group = np.unique(prefixes, return_inverse=True)
+    merged = np.zeros((len(unique_prefixes), counts.shape[1]))
+    np.add.at(merged, group, counts[keep])
+    values = attr.sketch_quantiles(merged, edges, quantiles)
+    df = pd.DataFrame({f'pfaf_{pfaf_level}': unique_prefixes})
+    for i, q in enumerate(quantiles):
+        df[_quantile_name(label, q)] = values[:, i]
+    return df
+
+
 ############################################################################################
 ############################################################################################
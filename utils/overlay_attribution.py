@@ -0,0 +1,258 @@
+#Import packages
+import os
+import json
+import numpy as np
+import pandas as pd
+from functools import partial
+from utils import basin_store
+from utils import executor
+from utils import memory
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    attributes line (e.g. roads) and polygon (e.g. protected areas, wetlands) data to level 12 HydroBASINS.
+    Basins are processed one pfaf chunk at a time (~3,000 basins, see chunk size test in step3_shp_to_hydrobasin_attribution.ipynb)
+    in a process pool.  Within a chunk candidate basin/feature pairs are found with a spatial index before intersecting, and
+    intersected geometries are only held for the chunk being processed.
+
+    Lengths (km) and areas (sq km) are geodesic (WGS84 ellipsoid).  Polygon pieces within a basin are dissolved before
+    measuring area, so overlapping features (e.g. WDPA protected areas) are not counted twice.  Weighted means use the
+    area of each feature piece.
+    Output records use the same format as tif attribution (see step2_mp_attribution.py) so attribution.json_stats_to_csv can be used:
+        {label: {f'{label}_length' or f'{label}_area': value,
+                 f'{label}_area_frac': area / SUB_AREA (polygons only),
+                 f'{label}_{column}_mean': length or area weighted mean of column,
+                 'src_file': [{'file_name': name of layer file, 'bounds_eval': 1}]},
+         'id': HYBAS_ID, 'pfaf_12': PFAF_ID, 'sub_area': SUB_AREA}
+'''
+
+
+def pfaf_chunks(basin_df, max_basins=3000, start_level=3, max_level=12):
+    '''
+    Description
+    ---------
+    splits basins into pfaf prefixes holding at most max_basins level 12 basins.  Starts at start_level and splits
+    prefixes with too many basins into the next pfaf level
+
+    Parameters
+    ---------
+    basin_df: dataframe with PFAF_ID of level 12 basins (e.g. from file_management.read_pkl_df)
+    max_basins: int, max number of basins per chunk
+    start_level: int, pfaf level to start from
+
+    Output
+    ---------
+    chunks: list of (pfaf prefix, number of basins) tuples
+    '''
+    pfaf_str = basin_df['PFAF_ID'].astype('int64').astype(str)
+    chunks = []
+    pending = [(start_level, pfaf_str)]
+    while pending:
+        level, values = pending.pop()
+        counts = values.str[:level].value_counts()
+        for prefix, n in counts.items():
+            if n > max_basins and level < max_level:
+                pending.append((level + 1, values[values.str.startswith(prefix)]))
+            else:
+                chunks.append((prefix, int(n)))
+    return sorted(chunks)
+
+
+def geodesic_measure(geoms, measure_name):
+    '''
+    Description
+    ---------
+    returns geodesic length (km) or area (sq km) of geometries in lon/lat (EPSG:4326).
+    measure_name ('length' or 'area') is set by layer type, points and touching edges in intersection results measure 0
+    '''
+    from pyproj import Geod
+    geod = Geod(ellps='WGS84')
+    measures = np.zeros(len(geoms), dtype=np.float64)
+    for i, geom in enumerate(geoms):
+        if geom is None or geom.is_empty:
+            continue
+        if measure_name == 'area':
+            area, perimeter = geod.geometry_area_perimeter(geom)
+            measures[i] = abs(area) / 1e6
+        else:
+            measures[i] = geod.geometry_length(geom) / 1e3
+    return measures
+
+
+def layer_measure(layer_file, layer=None):
+    '''
+    Description
+    ---------
+    returns 'area' for polygon layers and 'length' for line layers, read from the layer schema
+    '''
+    import fiona
+    with fiona.open(layer_file, layer=layer) as src:
+        geometry_type = str(src.schema['geometry']).replace('3D ', '')
+    if geometry_type in ('Polygon', 'MultiPolygon'):
+        return 'area'
+    if geometry_type in ('LineString', 'MultiLineString'):
+        return 'length'
+    raise ValueError(f'Overlay attribution requires a line or polygon layer, {layer_file} has {geometry_type} geometry')
+
+
+def intersect_chunk(basins, features, value_columns, measure_name):
+    '''
+    Description
+    ---------
+    intersects features with basins of one chunk and returns measure (length or area) of each intersection with attribute values.
+    Pairs are prefiltered with a spatial index so only candidate pairs are intersected.
+
+    Output
+    ---------
+    pairs: dataframe with HYBAS_ID, measure, value_columns and geometry for each basin/feature intersection
+    '''
+    import geopandas as gpd
+    if hasattr(basins.sindex, 'query_bulk'):
+        feature_pos, basin_pos = basins.sindex.query_bulk(features.geometry, predicate='intersects')
+    else:
+        feature_pos, basin_pos = basins.sindex.query(features.geometry, predicate='intersects')
+    if len(feature_pos) == 0:
+        return pd.DataFrame(columns=['HYBAS_ID', 'measure'] + value_columns + ['geometry'])
+    feature_geoms = gpd.GeoSeries(features.geometry.values[feature_pos])
+    basin_geoms = gpd.GeoSeries(basins.geometry.values[basin_pos])
+    intersections = feature_geoms.intersection(basin_geoms, align=False)
+    pairs = pd.DataFrame({'HYBAS_ID': basins['HYBAS_ID'].to_numpy()[basin_pos],
+                          'measure': geodesic_measure(intersections.values, measure_name)})
+    for column in value_columns:
+        pairs[column] = pd.to_numeric(features[column].to_numpy()[feature_pos], errors='coerce')
+    pairs['geometry'] = intersections.values
+    return pairs
+
+
+def dissolved_measure(pairs, measure_name):
+    '''
+    Description
+    ---------
+    returns Series of measure per HYBAS_ID after dissolving intersection pieces of each basin (union_all), so
+    overlapping features are measured once
+    '''
+    import shapely
+    if len(pairs) == 0:
+        return pd.Series(dtype=np.float64)
+    ids = pairs['HYBAS_ID'].to_numpy()
+    order = np.argsort(ids, kind='stable')
+    unique_ids, starts = np.unique(ids[order], return_index=True)
+    geoms = pairs['geometry'].to_numpy()
+    dissolved = [shapely.union_all(geoms[group]) for group in np.split(order, starts[1:])]
+    return pd.Series(geodesic_measure(dissolved, measure_name), index=unique_ids)
+
+
+def attribute_chunk(layer_file, label, value_columns, measure_name, layer, store_dir, pfaf_prefix):
+    '''
+    Description
+    ---------
+    attributes line or polygon features to basins in one pfaf chunk, run in worker processes by attribute_overlay
+
+    Output
+    ---------
+    records: list of dictionaries, one per basin in chunk (see module description)
+    '''
+    import geopandas as gpd
+    store = basin_store.BasinStore(store_dir)
+    basins = store.read_gdf(pfaf_prefix=pfaf_prefix, columns=['HYBAS_ID', 'PFAF_ID', 'SUB_AREA'])
+    if len(basins) == 0:
+        return []
+    #bbox as a geodataframe is reprojected to the crs of the layer by geopandas, a tuple would be read in the layer crs
+    features = gpd.read_file(layer_file, bbox=basins, layer=layer)
+    if features.crs is not None and basins.crs is not None and features.crs != basins.crs:
+        features = features.to_crs(basins.crs)
+    features = features[features.geometry.notna()]
+
+    is_polygon = measure_name == 'area'
+    pairs = intersect_chunk(basins, features, value_columns, measure_name)
+
+    #length or area weighted sums for weighted means
+    pairs = pairs.copy()
+    agg = {'measure': 'sum'}
+    for column in value_columns:
+        pairs[f'{column}_wsum'] = pairs[column] * pairs['measure']
+        pairs[f'{column}_wn'] = pairs['measure'].where(pairs[column].notna(), 0.0)
+        agg[f'{column}_wsum'] = 'sum'
+        agg[f'{column}_wn'] = 'sum'
+    summary = pairs.groupby('HYBAS_ID').agg(agg) if len(pairs) else pd.DataFrame(columns=list(agg))
+    if is_polygon:
+        summary['measure'] = dissolved_measure(pairs, measure_name).reindex(summary.index).fillna(0.0)
+
+    src_info = {'file_name': os.path.basename(layer_file), 'bounds_eval': 1}
+    records = []
+    for basin in basins[['HYBAS_ID', 'PFAF_ID', 'SUB_AREA']].itertuples(index=False):
+        stats = {}
+        measure = float(summary.at[basin.HYBAS_ID, 'measure']) if basin.HYBAS_ID in summary.index else 0.0
+        stats[f'{label}_{measure_name}'] = measure
+        if is_polygon and basin.SUB_AREA > 0:
+            #area is dissolved, values slightly above 1 only come from geodesic area differing from rounded SUB_AREA
+            stats[f'{label}_area_frac'] = min(1.0, measure / float(basin.SUB_AREA))
+        for column in value_columns:
+            weight = float(summary.at[basin.HYBAS_ID, f'{column}_wn']) if basin.HYBAS_ID in summary.index else 0.0
+            stats[f'{label}_{column}_mean'] = float(summary.at[basin.HYBAS_ID, f'{column}_wsum']) / weight if weight > 0 else None
+        stats['src_file'] = [src_info]
+        records.append({label: stats, 'id': int(basin.HYBAS_ID), 'pfaf_12': int(basin.PFAF_ID), 'sub_area': float(basin.SUB_AREA)})
+    return records
+
+
+def attribute_overlay(layer_file, label, value_columns=None, store_dir='data/basin_store', region=None, pfaf_prefix=None,
+                      max_basins=3000, workers=None, layer=None, outfile=None):
+    '''
+    Description
+    ---------
+    attributes line or polygon layer to level 12 basins, one pfaf chunk at a time in a process pool
+
+    Parameters
+    ---------
+    layer_file: str, path to line or polygon data (e.g. 'data/var/WDPA/protected_areas.shp')
+    label: str, short name used to name output stats (e.g. 'wdpa')
+    value_columns: list of numeric columns to summarize as length or area weighted means
+    store_dir: str, basin store directory (see file_management.build_basin_data)
+    region, pfaf_prefix: optional filters to attribute a subset of basins
+    max_basins: max number of level 12 basins processed at one time
+    workers: number of worker processes, defaults to memory budget plan (see utils/memory.py)
+    layer: layer name for multi-layer formats
+    outfile: optional json path (e.g. 'output/wdpa_hb12_att.json'), readable by attribution.json_stats_to_csv
+
+    Output
+    ---------
+    records: list of dictionaries, one per basin (see module description)
+    '''
+    value_columns = list(value_columns or [])
+    measure_name = layer_measure(layer_file, layer)
+    store = basin_store.BasinStore(store_dir)
+    basin_df = store.read_df(region, pfaf_prefix, columns=['HYBAS_ID', 'PFAF_ID'])
+    chunks = pfaf_chunks(basin_df, max_basins=max_basins, start_level=max(3, len(str(pfaf_prefix or ''))))
+    #largest chunks first so they do not finish last
+    chunks = sorted(chunks, key=lambda x: -x[1])
+    prefixes = [prefix for prefix, n in chunks]
+
+    if workers is None:
+        budget = memory.MemoryBudget()
+        per_basin = budget.bytes_per_basin('load_basins', 20000)
+        workers, _ = budget.plan_pool(len(prefixes), max_basins * per_basin * 4)
+    func = partial(attribute_chunk, layer_file, label, value_columns, measure_name, layer, store_dir)
+    with executor.Executor('serial' if workers == 1 else None, workers=workers, chunksize=1) as ex:
+        results = ex.map(func, prefixes, label=f'overlay chunks ({label})')
+
+    records = [record for chunk_records in results for record in chunk_records]
+    if region is not None:
+        #chunks are built from basins in region, drop basins from neighboring regions sharing a prefix (not expected in HydroBASINS)
+        ids = set(basin_df['HYBAS_ID'].tolist())
+        records = [record for record in records if record['id'] in ids]
+    if outfile:
+        with open(outfile, 'w') as out:
+            json.dump(records, out)
+    return records
+
+
+############################################################################################
+############################################################################################
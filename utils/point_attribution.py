@@ -0,0 +1,325 @@
+#Import packages
+import numpy as np
+import pandas as pd
+from functools import partial
+from utils import basin_store
+from utils import executor
+from utils import memory
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    attributes point data (e.g. GRanD dams, gauges, barriers, occurrence records) to level 12 HydroBASINS.
+    Generalizes the GRanD dam example in step3_shp_to_hydrobasin_attribution.ipynb for point files with millions of features.
+    Work is partitioned by basin store partition (region and pfaf prefix).  For each partition a worker builds a spatial
+    index of basin geometry once, streams points within the partition bounds in chunks and aggregates stats directly
+    into a HYBAS_ID indexed table.  Basins with no points get zero count and sum (mean, min and max are empty).
+
+    Stats are defined as a dictionary, e.g. {'count': True, 'CAP_MCM': ['sum', 'max']}
+    Output column names are f'{prefix}_count' and f'{prefix}_{column}_{stat}', e.g. grand_count, grand_CAP_MCM_sum
+    Supported stats for columns: sum, max, min, mean
+'''
+
+
+class BasinIndex:
+    def __init__(self, basins_gdf):
+        '''
+        Description
+        ---------
+        Prepared spatial index over basin geometry, reused for every chunk of points
+
+        Parameters
+        ---------
+        basins_gdf: geodataframe of basins with HYBAS_ID and geometry
+        '''
+        self.hybas_ids = basins_gdf['HYBAS_ID'].to_numpy(dtype=np.int64)
+        self.crs = basins_gdf.crs
+        self.sindex = basins_gdf.sindex
+
+    def assign(self, points_gdf, predicate='within'):
+        '''
+        Description
+        ---------
+        returns array of positions of points and array of HYBAS_IDs of the basins they fall within
+        '''
+        if self.crs is not None and points_gdf.crs is not None and points_gdf.crs != self.crs:
+            points_gdf = points_gdf.to_crs(self.crs)
+        #predicate is evaluated as point.predicate(basin), older geopandas versions use query_bulk for arrays of geometry
+        if hasattr(self.sindex, 'query_bulk'):
+            point_pos, basin_pos = self.sindex.query_bulk(points_gdf.geometry, predicate=predicate)
+        else:
+            point_pos, basin_pos = self.sindex.query(points_gdf.geometry, predicate=predicate)
+        return point_pos, self.hybas_ids[basin_pos]
+
+
+def parse_stats(stats):
+    '''
+    Description
+    ---------
+    converts stats dictionary to list of (column, stat) tuples, count is represented as (None, 'count')
+    '''
+    parsed = []
+    for column, column_stats in stats.items():
+        if column == 'count':
+            if column_stats:
+                parsed.append((None, 'count'))
+            continue
+        if isinstance(column_stats, str):
+            column_stats = column_stats.split()
+        for stat in column_stats:
+            if stat not in ['sum', 'max', 'min', 'mean']:
+                raise ValueError(f'Unsupported point stat {stat} for column {column}')
+            parsed.append((column, stat))
+    return parsed
+
+
+def aggregate_chunk(hybas_ids, values_df, parsed_stats):
+    '''
+    Description
+    ---------
+    aggregates one chunk of points to partial (mergeable) stats per HYBAS_ID.  mean is carried as sum and count.
+
+    Parameters
+    ---------
+    hybas_ids: array of HYBAS_ID for each assigned point
+    values_df: dataframe of point attribute columns, same rows as hybas_ids
+    parsed_stats: list from parse_stats
+    '''
+    df = pd.DataFrame({'HYBAS_ID': hybas_ids})
+    df['_count'] = 1
+    agg = {'_count': 'sum'}
+    for column, stat in parsed_stats:
+        if column is None:
+            continue
+        df[column] = pd.to_numeric(values_df[column].to_numpy(), errors='coerce')
+        if stat in ['sum', 'mean']:
+            df[f'_{column}_sum'] = df[column].fillna(0)
+            df[f'_{column}_n'] = df[column].notna().astype(np.int64)
+            agg[f'_{column}_sum'] = 'sum'
+            agg[f'_{column}_n'] = 'sum'
+        else:
+            df[f'_{column}_{stat}'] = df[column]
+            agg[f'_{column}_{stat}'] = stat
+    return df.groupby('HYBAS_ID').agg(agg)
+
+
+def merge_partials(partials):
+    '''
+    Description
+    ---------
+    merges partial aggregates from aggregate_chunk, sums are added and max/min combined
+    '''
+    partials = [p for p in partials if p is not None and len(p)]
+    if not partials:
+        return None
+    combined = pd.concat(partials)
+    agg = {}
+    for column in combined.columns:
+        if column.endswith('_max'):
+            agg[column] = 'max'
+        elif column.endswith('_min'):
+            agg[column] = 'min'
+        else:
+            agg[column] = 'sum'
+    return combined.groupby(level=0).agg(agg)
+
+
+def check_columns(point_file, parsed_stats, layer=None):
+    '''
+    Description
+    ---------
+    raises ValueError if columns of parsed_stats are not attributes of point_file, checked once by attribute_points
+    '''
+    import fiona
+    with fiona.open(point_file, layer=layer) as src:
+        properties = src.schema['properties']
+    missing = sorted(set([column for column, stat in parsed_stats if column is not None and column not in properties]))
+    if missing:
+        raise ValueError(f'Columns {missing} are not in {point_file}, available columns are {list(properties)}')
+
+
+def point_crs(point_file, layer=None):
+    '''
+    Description
+    ---------
+    returns crs (wkt) of point_file, read once by attribute_points and passed to workers
+    '''
+    import fiona
+    with fiona.open(point_file, layer=layer) as src:
+        return src.crs_wkt or None
+
+
+def partition_bbox(bounds, store_crs, crs):
+    '''
+    Description
+    ---------
+    returns partition bounds (xmin, ymin, xmax, ymax in crs of basin store) as a bbox in crs of the point file,
+    so points in a projected crs (e.g. Albers gauges) are not dropped by the bbox filter.  None (no filter) if the
+    bounds can not be transformed.
+    '''
+    bounds = tuple(bounds)
+    if crs is None or store_crs is None:
+        return bounds
+    from pyproj import CRS, Transformer
+    if CRS.from_user_input(crs) == CRS.from_user_input(store_crs):
+        return bounds
+    try:
+        bbox = Transformer.from_crs(store_crs, crs, always_xy=True).transform_bounds(*bounds)
+    except Exception:
+        return None
+    return bbox if np.all(np.isfinite(bbox)) else None
+
+
+def read_point_chunks(point_file, bbox=None, chunk_size=100000, columns=None, layer=None):
+    '''
+    Description
+    ---------
+    streams point features as geodataframes of at most chunk_size rows, optionally limited to features within bbox.
+    bbox filtering is fast when the point file has a spatial index (e.g. GeoPackage or shapefile with .qix)
+
+    Parameters
+    ---------
+    point_file: str, path to point data (any format readable by fiona)
+    bbox: tuple (xmin, ymin, xmax, ymax) in crs of point_file
+    chunk_size: int, max number of points held in memory
+    columns: list of attribute columns to keep
+    layer: str, layer name for multi-layer formats
+    '''
+    import fiona
+    with fiona.open(point_file, layer=layer) as src:
+        crs = src.crs_wkt or src.crs
+        features = src.filter(bbox=bbox) if bbox is not None else iter(src)
+        chunk = []
+        for feature in features:
+            chunk.append(feature)
+            if len(chunk) >= chunk_size:
+                yield _features_to_gdf(chunk, crs, columns)
+                chunk = []
+        if chunk:
+            yield _features_to_gdf(chunk, crs, columns)
+
+
+def _features_to_gdf(features, crs, columns):
+    import geopandas as gpd
+    gdf = gpd.GeoDataFrame.from_features(features, crs=crs)
+    if columns is not None:
+        gdf = gdf[[c for c in columns if c in gdf.columns] + ['geometry']]
+    return gdf
+
+
+def attribute_partition(point_file, parsed_stats, store_dir, chunk_size, predicate, layer, pfaf_prefix, crs, partition):
+    '''
+    Description
+    ---------
+    attributes points within one basin store partition, run in worker processes by attribute_points
+    pfaf_prefix: optional filter, only used if it is longer than the partition prefix
+    crs: crs of point_file (see point_crs), partition bounds are transformed to it before filtering points
+
+    Output
+    ---------
+    partial aggregates (see aggregate_chunk) for basins in partition, None if partition has no points
+    '''
+    store = basin_store.BasinStore(store_dir)
+    prefix = partition['pfaf_prefix']
+    if pfaf_prefix is not None and len(str(pfaf_prefix)) > len(prefix):
+        prefix = str(pfaf_prefix)
+    basins = store.read_gdf(partition['region'], prefix, columns=['HYBAS_ID'])
+    index = BasinIndex(basins)
+    columns = list(set([column for column, stat in parsed_stats if column is not None]))
+    partials = []
+    bbox = partition_bbox(partition['bounds'], store.crs, crs)
+    for points in read_point_chunks(point_file, bbox=bbox, chunk_size=chunk_size, columns=columns, layer=layer):
+        point_pos, hybas_ids = index.assign(points, predicate)
+        if len(point_pos):
+            partials.append(aggregate_chunk(hybas_ids, points.iloc[point_pos], parsed_stats))
+        #merge as we go so memory is bounded by number of basins in partition, not number of points
+        if len(partials) > 8:
+            partials = [merge_partials(partials)]
+    return merge_partials(partials)
+
+
+def finalize(partial_df, all_ids, parsed_stats, prefix):
+    '''
+    Description
+    ---------
+    converts merged partial aggregates to output columns.  count and sum are zero for basins with no points,
+    mean, min and max are left empty (NaN) as they are undefined without points
+    '''
+    out = pd.DataFrame(index=pd.Index(all_ids, name='HYBAS_ID'))
+    if partial_df is None:
+        partial_df = pd.DataFrame(index=pd.Index([], name='HYBAS_ID'))
+    partial_df = partial_df.reindex(out.index)
+    for column, stat in parsed_stats:
+        if column is None:
+            out[f'{prefix}_count'] = partial_df.get('_count', np.nan)
+            out[f'{prefix}_count'] = out[f'{prefix}_count'].fillna(0.0)
+        elif stat == 'sum':
+            out[f'{prefix}_{column}_sum'] = partial_df.get(f'_{column}_sum', np.nan)
+            out[f'{prefix}_{column}_sum'] = out[f'{prefix}_{column}_sum'].fillna(0.0)
+        elif stat == 'mean':
+            n = partial_df.get(f'_{column}_n')
+            out[f'{prefix}_{column}_mean'] = partial_df.get(f'_{column}_sum') / n.where(n > 0) if n is not None else np.nan
+        else:
+            out[f'{prefix}_{column}_{stat}'] = partial_df.get(f'_{column}_{stat}')
+    return out
+
+
+def attribute_points(point_file, stats, prefix, store_dir='data/basin_store', region=None, pfaf_prefix=None,
+                     workers=None, chunk_size=100000, predicate='within', layer=None, outfile=None):
+    '''
+    Description
+    ---------
+    attributes points to level 12 basins
+
+    Parameters
+    ---------
+    point_file: str, path to point data (e.g. 'data/var/GRanD_Version_1_3/GRanD_dams_v1_3.shp')
+    stats: dictionary of stats, e.g. {'count': True, 'CAP_MCM': ['sum', 'max']}
+    prefix: str, prefix of output columns (e.g. 'grand')
+    store_dir: str, basin store directory (see file_management.build_basin_data)
+    region, pfaf_prefix: optional filters to attribute a subset of basins
+    workers: number of worker processes, defaults to memory budget plan (see utils/memory.py)
+    chunk_size: max number of points held in memory by each worker
+    predicate: 'within' (default, same as step3 notebook) or 'intersects'
+    layer: layer name for multi-layer formats
+    outfile: optional csv path (e.g. 'output/hb12_grand_local.csv')
+
+    Output
+    ---------
+    df: dataframe indexed by HYBAS_ID with one row for every basin (count and sum zero-filled if no points)
+    '''
+    parsed_stats = parse_stats(stats)
+    check_columns(point_file, parsed_stats, layer)
+    store = basin_store.BasinStore(store_dir)
+    partitions = store.select_partitions(region, pfaf_prefix)
+    if not partitions:
+        raise ValueError('No basin store partitions match region and pfaf_prefix filters')
+
+    if workers is None:
+        budget = memory.MemoryBudget()
+        largest = max([p['n_basins'] for p in partitions])
+        per_basin = budget.bytes_per_basin('load_basins', 20000)
+        workers, _ = budget.plan_pool(len(partitions), largest * per_basin * 2)
+    func = partial(attribute_partition, point_file, parsed_stats, store_dir, chunk_size, predicate, layer, pfaf_prefix,
+                   point_crs(point_file, layer))
+    #largest partitions first so they do not finish last
+    partitions = sorted(partitions, key=lambda p: -p['n_basins'])
+    with executor.Executor('serial' if workers == 1 else None, workers=workers, chunksize=1) as ex:
+        partials = ex.map(func, partitions, task_ids=[x['name'] for x in partitions], label=f'point partitions ({prefix})')
+
+    all_ids = store.read_df(region, pfaf_prefix, columns=['HYBAS_ID'])['HYBAS_ID'].to_numpy()
+    df = finalize(merge_partials(partials), all_ids, parsed_stats, prefix)
+    if outfile:
+        df.to_csv(outfile, sep=',')
+    return df
+
+
+############################################################################################
+############################################################################################
@@ -0,0 +1,293 @@
+#Import packages
+import os
+import sys
+import json
+import time
+import heapq
+import numbers
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from utils import memory
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    progress reporting for long running multiprocessing steps.  Wraps pool execution so completed/total tasks, tasks per
+    second, ETA, memory of each worker and the slowest recent tasks are reported to the terminal and to a json status file
+    that can be polled while the run is going (e.g. watch cat output/step2_status.json)
+
+    Workers record when each task starts, so tasks that are running the longest (e.g. a hung worker or a huge basin) are
+    reported with their elapsed time.  Reports are refreshed by a timer thread, not only as tasks complete.
+'''
+
+
+def format_eta(eta):
+    '''
+    Description
+    ---------
+    formats seconds remaining as HH:MM:SS, with days added for runs longer than a day (e.g. 1d 06:00:00)
+    '''
+    if eta is None:
+        return '?'
+    days, seconds = divmod(int(eta), 86400)
+    hms = time.strftime('%H:%M:%S', time.gmtime(seconds))
+    return f'{days}d {hms}' if days else hms
+
+
+class TrackedTask:
+    def __init__(self, func, running=None):
+        '''
+        Description
+        ---------
+        Wraps a function mapped across workers so each result comes back with the task index, task id, worker pid,
+        duration and memory of the worker.  Used by run_pool.
+
+        Parameters
+        ---------
+        func : function (or functools.partial) run for each task, accepts one argument
+        running : optional dictionary (multiprocessing Manager dict for process pools) of task index to
+                  (task id, worker pid, start time) of tasks currently running, see ProgressMonitor running
+        '''
+        self.func = func
+        self.running = running
+
+    def __call__(self, item):
+        index, task_id, arg = item
+        pid = os.getpid()
+        if self.running is not None:
+            self.running[index] = (task_id, pid, time.time())
+        start = time.perf_counter()
+        try:
+            result = self.func(arg)
+        finally:
+            if self.running is not None:
+                self.running.pop(index, None)
+        seconds = time.perf_counter() - start
+        return index, task_id, pid, seconds, memory.rss_bytes(), result
+
+
+class ProgressMonitor:
+    def __init__(self, total, label='tasks', status_file=None, interval=30, n_slowest=10, window=1000, stream=sys.stdout):
+        '''
+        Description
+        ---------
+        Tracks completed tasks and reports progress
+
+        Parameters
+        ---------
+        total : int, number of tasks
+        label : str, describes tasks in report (e.g. 'basins in region af')
+        status_file : str, optional path of json status file, rewritten (atomically) at each report
+        interval : seconds between reports
+        n_slowest : number of slowest tasks to report
+        window : number of most recently completed tasks the slowest tasks are selected from
+        stream : where terminal reports are written, set to None for status file only
+
+        running (set by run_pool) is a dictionary of task index to (task id, worker pid, start time) of running tasks
+        '''
+        self.total = int(total)
+        self.label = label
+        self.status_file = status_file
+        self.interval = interval
+        self.n_slowest = n_slowest
+        self.recent = deque(maxlen=window)
+        self.stream = stream
+        self.completed = 0
+        self.workers = {}
+        self.start = time.time()
+        self.running = {}
+        self._last_report = 0
+        self._lock = threading.Lock()
+        self._report_lock = threading.Lock()
+        self._stop = None
+        self._thread = None
+
+    def start_timer(self):
+        '''
+        Description
+        ---------
+        reports every interval seconds from a background thread, so progress and running tasks are still reported
+        while no task completes (e.g. a hung worker)
+        '''
+        if self._stop is not None:
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._timer, args=(self._stop,), daemon=True)
+        self._thread.start()
+
+    def stop_timer(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._thread.join()
+            self._stop = None
+            self._thread = None
+
+    def _timer(self, stop):
+        while not stop.wait(self.interval):
+            if time.time() - self._last_report >= self.interval:
+                try:
+                    self.report()
+                except Exception as e:
+                    #progress reports never stop the run, e.g. status file on a full disk
+                    print(f'Warning, progress report failed: {e}')
+
+    def update(self, task_id, seconds, pid, rss):
+        now = time.time()
+        with self._lock:
+            self._update(task_id, seconds, pid, rss, now)
+        if now - self._last_report >= self.interval:
+            self.report()
+
+    def _update(self, task_id, seconds, pid, rss, now):
+        self.completed += 1
+        self.recent.append((seconds, task_id))
+        worker = self.workers.setdefault(pid, {'tasks': 0, 'busy_seconds': 0.0})
+        worker['tasks'] += 1
+        worker['busy_seconds'] += seconds
+        worker['rss_mb'] = round(rss / 1048576, 1)
+        worker['peak_rss_mb'] = max(worker.get('peak_rss_mb', 0), worker['rss_mb'])
+        worker['last_seen'] = now
+
+    def status(self):
+        with self._lock:
+            return self._status()
+
+    def _status(self):
+        now = time.time()
+        elapsed = now - self.start
+        rate = self.completed / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.completed
+        eta = remaining / rate if rate > 0 else None
+        slowest = heapq.nlargest(self.n_slowest, self.recent, key=lambda x: x[0])
+        workers = {}
+        for pid, worker in self.workers.items():
+            info = dict(worker)
+            #time since the worker last finished a task, large values suggest a hung worker or a very slow task
+            info['idle_seconds'] = round(now - info.pop('last_seen'), 1)
+            info['busy_seconds'] = round(info['busy_seconds'], 2)
+            workers[str(pid)] = info
+        running = self.running.copy() if self.running else {}
+        longest = heapq.nsmallest(self.n_slowest, running.values(), key=lambda x: x[2])
+        return {'label': self.label,
+                'completed': self.completed,
+                'total': self.total,
+                'elapsed_seconds': round(elapsed, 1),
+                'tasks_per_second': round(rate, 3),
+                'eta_seconds': round(eta, 1) if eta is not None else None,
+                'workers': workers,
+                'slowest': [{'id': task_id, 'seconds': round(seconds, 3)} for seconds, task_id in slowest],
+                'running': len(running),
+                'running_longest': [{'id': task_id, 'pid': pid, 'seconds': round(now - started, 1)}
+                                    for task_id, pid, started in longest],
+                'updated': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+    def report(self):
+        #called from the main thread and the timer thread
+        with self._report_lock:
+            return self._report()
+
+    def _report(self):
+        self._last_report = time.time()
+        status = self.status()
+        if self.stream is not None:
+            eta = status['eta_seconds']
+            eta_str = format_eta(eta)
+            rss = sum(w['rss_mb'] for w in status['workers'].values())
+            msg = (f"{self.label}: {status['completed']}/{status['total']} "
+                   f"({status['tasks_per_second']:.2f}/s, ETA {eta_str}, workers {len(status['workers'])} using {rss:.0f} MB)")
+            if status['slowest']:
+                slow = status['slowest'][0]
+                msg += f" slowest recent: {slow['id']} {slow['seconds']:.1f}s"
+            if status['running_longest']:
+                run = status['running_longest'][0]
+                msg += f" running longest: {run['id']} {run['seconds']:.1f}s (pid {run['pid']})"
+            print(msg, file=self.stream, flush=True)
+        if self.status_file:
+            tmp_file = f'{self.status_file}.tmp'
+            with open(tmp_file, 'w') as outfile:
+                json.dump(status, outfile, indent=1, default=str)
+            os.replace(tmp_file, self.status_file)
+        return status
+
+
+def default_chunksize(n_tasks, n_workers, max_chunksize=64):
+    '''
+    Description
+    ---------
+    Chunksize similar to Pool.map, capped so progress is still reported regularly
+    '''
+    chunksize, extra = divmod(n_tasks, max(1, n_workers) * 4)
+    if extra:
+        chunksize += 1
+    return max(1, min(chunksize, max_chunksize))
+
+
+def _running_registry(pool):
+    #dictionary workers record task starts in, None when workers can not reach one (cluster backend)
+    backend = getattr(pool, 'backend', None)
+    if backend in ['serial', 'thread'] or isinstance(pool, ThreadPool):
+        return {}, None
+    if backend == 'process' or (backend is None and isinstance(pool, multiprocessing.pool.Pool)):
+        manager = multiprocessing.Manager()
+        return manager.dict(), manager
+    return None, None
+
+
+def run_pool(pool, func, tasks, task_ids=None, chunksize=None, monitor=None, track_running=True, **monitor_kwargs):
+    '''
+    Description
+    ---------
+    Replacement for pool.map that reports progress as tasks complete.  Results are returned in the order of tasks.
+
+    Parameters
+    ---------
+    pool : multiprocessing Pool (or any object with imap_unordered)
+    func : function (or functools.partial) run for each task
+    tasks : list of task arguments
+    task_ids : list of identifiers reported for slow tasks (e.g. HYBAS_ID, lake id), defaults to the task argument
+    chunksize : number of tasks sent to a worker at once, defaults to default_chunksize
+    monitor : optional ProgressMonitor, supply to inspect worker information (e.g. peak_rss_mb) after the run
+    track_running : record task starts so the longest running tasks are reported, costs a message to a
+                    multiprocessing Manager per task with process pools, turn off for many very short tasks
+    monitor_kwargs : passed to ProgressMonitor (label, status_file, interval, n_slowest, window, stream)
+
+    Output
+    ---------
+    results : list of results in the same order as tasks
+    '''
+    tasks = list(tasks)
+    if task_ids is None:
+        task_ids = [task if isinstance(task, (numbers.Number, str)) else i for i, task in enumerate(tasks)]
+    if chunksize is None:
+        chunksize = default_chunksize(len(tasks), getattr(pool, '_processes', 1))
+    if monitor is None:
+        monitor = ProgressMonitor(len(tasks), **monitor_kwargs)
+    running, manager = _running_registry(pool) if track_running else (None, None)
+    monitor.running = running
+    results = [None] * len(tasks)
+    items = ((i, task_ids[i], task) for i, task in enumerate(tasks))
+    monitor.start_timer()
+    try:
+        for index, task_id, pid, seconds, rss, result in pool.imap_unordered(TrackedTask(func, running), items, chunksize):
+            results[index] = result
+            monitor.update(task_id, seconds, pid, rss)
+    finally:
+        monitor.stop_timer()
+        monitor.running = {}
+        if manager is not None:
+            manager.shutdown()
+    monitor.report()
+    return results
+
+
+############################################################################################
+############################################################################################
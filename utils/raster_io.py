@@ -0,0 +1,372 @@
+#Import packages
+import os
+import math
+import time
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils import instrumentation as instr
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    raster window reads for attribution.  Windows for upcoming basins are read on a small background thread pool
+    (GDAL releases the GIL while reading) so reading the next windows overlaps with zonal stats of the current window.
+    Each thread keeps its own open datasets, rasterio datasets should not be shared between threads.
+
+    The number of windows read ahead (queue depth) bounds memory held by prefetched windows.
+    Settings (environment variables take priority over defaults):
+        GFF_PREFETCH_DEPTH -> number of windows read ahead of computation, 0 reads each window when it is needed (default 4)
+        GFF_IO_THREADS     -> number of reader threads per worker (default 2)
+
+    Optional value rules from file_processing_info.csv are applied to each window as it is read (see ValueRules), so
+    rasters with a wrong nodata value, valid ranges or scaled values do not need rewritten copies on disk.
+
+    Metrics recorded (see utils/instrumentation.py):
+        io_wait  -> time computation waited for a window to be read (time not hidden by prefetching)
+        io_read  -> time spent reading windows on reader threads
+        compute  -> time spent on zonal stats and merging results (timed by the caller)
+        windows_read, window_bytes -> counters
+'''
+
+_local = threading.local()
+_done = object()
+
+
+def prefetch_settings(depth=None, threads=None):
+    '''
+    Description
+    ---------
+    returns (depth, threads) from arguments, GFF_PREFETCH_DEPTH and GFF_IO_THREADS
+    '''
+    depth = int(os.environ.get('GFF_PREFETCH_DEPTH', depth if depth is not None else 4))
+    threads = int(os.environ.get('GFF_IO_THREADS', threads if threads is not None else 2))
+    return max(0, depth), max(1, threads)
+
+
+def source_path(file):
+    '''
+    Description
+    ---------
+    returns path to read for a file info dictionary, the prepared copy when there is one (see file_management.prepare_rasters)
+    '''
+    return file.get('prepared_path') or file['file_path']
+
+
+def open_dataset(file_path):
+    '''
+    Description
+    ---------
+    returns rasterio dataset for file_path, kept open for the life of the thread
+    '''
+    import rasterio
+    datasets = getattr(_local, 'datasets', None)
+    if datasets is None:
+        datasets = _local.datasets = {}
+    if file_path not in datasets:
+        datasets[file_path] = rasterio.open(file_path)
+    return datasets[file_path]
+
+
+def close_datasets():
+    '''
+    Description
+    ---------
+    closes datasets opened by the current thread
+    '''
+    for dataset in getattr(_local, 'datasets', {}).values():
+        dataset.close()
+    _local.datasets = {}
+
+
+class ValueRules:
+    __slots__ = ['nodata_override', 'valid_min', 'valid_max', 'scale', 'offset']
+
+    def __init__(self, nodata_override=None, valid_min=None, valid_max=None, scale=None, offset=None):
+        '''
+        Description
+        ---------
+        Per file value rules applied to raster windows as they are read, set with optional columns of
+        file_processing_info.csv (nodata_override, valid_min, valid_max, scale, offset)
+
+        Parameters
+        ---------
+        nodata_override : value treated as nodata instead of the nodata value of the file
+        valid_min, valid_max : pixels below valid_min or above valid_max (raw values) are treated as nodata
+        scale, offset : valid pixels are converted to value * scale + offset
+        '''
+        self.nodata_override = nodata_override
+        self.valid_min = valid_min
+        self.valid_max = valid_max
+        self.scale = scale
+        self.offset = offset
+
+    @classmethod
+    def from_file_info(cls, file):
+        '''
+        Description
+        ---------
+        returns ValueRules for a file info dictionary (see file_management.build_file_catalog), None if no rules are set
+        '''
+        values = {}
+        for key in cls.__slots__:
+            value = file.get(key)
+            if value is not None and not (isinstance(value, float) and math.isnan(value)):
+                values[key] = float(value)
+        if not values:
+            return None
+        return cls(**values)
+
+    def apply(self, array, src_nodata, outside=None):
+        '''
+        Description
+        ---------
+        applies rules to a window of pixels (vectorized) with invalid pixels set to the returned nodata.
+        Values keep the dtype of the raster unless scale or offset is set (then float64), so windows stay small and
+        integer categories keep integer names in zonal stats (e.g. lu_10 rather than lu_10.0).
+
+        Parameters
+        ---------
+        array : numpy array of raw pixel values
+        src_nodata : nodata value of the file
+        outside : optional boolean array of pixels outside the raster extent
+
+        Output
+        ---------
+        values, nodata : array of values and nodata value to pass to zonal stats
+        '''
+        nodata = self.nodata_override if self.nodata_override is not None else src_nodata
+        invalid = np.zeros(array.shape, dtype=bool) if outside is None else outside.copy()
+        if nodata is not None:
+            invalid |= np.isnan(array) if math.isnan(nodata) else (array == nodata)
+        if self.valid_min is not None:
+            invalid |= array < self.valid_min
+        if self.valid_max is not None:
+            invalid |= array > self.valid_max
+        if self.scale is None and self.offset is None:
+            fill = self._fill_value(array.dtype, nodata)
+            if fill is not None:
+                values = array.copy()
+                values[invalid] = fill
+                return values, fill
+        values = array.astype(np.float64)
+        if self.scale is not None:
+            values *= self.scale
+        if self.offset is not None:
+            values += self.offset
+        #same default as rasterstats when no nodata value is available
+        if nodata is None:
+            nodata = -999.0
+        values[invalid] = nodata
+        return values, nodata
+
+    def _fill_value(self, dtype, nodata):
+        #nodata value that fits dtype and no valid pixel can have, None if values have to be converted to float64
+        if dtype.kind == 'f':
+            return nodata if nodata is not None else -999.0
+        if dtype.kind not in 'iu':
+            return None
+        info = np.iinfo(dtype)
+        if nodata is not None and not math.isnan(nodata) and float(nodata).is_integer() and info.min <= nodata <= info.max:
+            return dtype.type(nodata)
+        #a value outside the valid range, e.g. 255 for uint8 with valid_max 100
+        if self.valid_max is not None and self.valid_max < info.max:
+            return dtype.type(info.max)
+        if self.valid_min is not None and self.valid_min > info.min:
+            return dtype.type(info.min)
+        return None
+
+
+class RasterWindow:
+    def __init__(self, array, affine, nodata, remapped=False, pixel_factor=1.0):
+        '''
+        Description
+        ---------
+        Pixels of a raster read for a bounding box, passed to rasterstats zonal_stats as an array with affine
+
+        Parameters
+        ---------
+        array : 2d numpy array (band 1)
+        affine : affine transform of array
+        nodata : nodata value of source raster, or of values after ValueRules are applied
+        remapped : True if ValueRules were applied, nodata then replaces the nodata value of the file
+        pixel_factor : number of full resolution pixels represented by each pixel (1 unless read in approximate mode)
+        '''
+        self.array = array
+        self.affine = affine
+        self.nodata = nodata
+        self.remapped = remapped
+        self.pixel_factor = pixel_factor
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+
+def read_window(file_path, xmin, xmax, ymin, ymax, band=1, rules=None, factor=1, min_pixels=10000, area=None):
+    '''
+    Description
+    ---------
+    reads pixels of a raster covering a bounding box.  The window is found the same way rasterstats finds windows
+    for geometry, so zonal stats of the returned array match zonal stats read from the file.
+
+    Parameters
+    ---------
+    file_path : str, path of raster
+    xmin, xmax, ymin, ymax : bounding box
+    band : band number
+    rules : optional ValueRules applied to pixels as they are read
+    factor : approximate mode, windows are read at 1/factor of full resolution (nearest neighbor, from overviews when
+             the raster has them).  Basins with fewer than min_pixels full resolution pixels are read at full resolution.
+    min_pixels, area : area of the basin in units of the raster crs (e.g. polygon area in square degrees), its pixel
+                       count is compared to min_pixels.  Without area the pixels of the bounding box are counted, which
+                       overestimates basins that fill little of their bounding box.
+
+    Output
+    ---------
+    RasterWindow, None if bounding box extends past the raster and no rules are set (zonal stats then reads from the file)
+    '''
+    from rasterio.windows import Window
+    from rasterstats.io import bounds_window
+    src = open_dataset(file_path)
+    row_slice, col_slice = bounds_window((xmin, ymin, xmax, ymax), src.transform)
+    beyond_extent = row_slice[0] < 0 or col_slice[0] < 0 or row_slice[1] > src.height or col_slice[1] > src.width
+    if row_slice[1] <= row_slice[0] or col_slice[1] <= col_slice[0]:
+        return None
+    if not beyond_extent:
+        #pad by a pixel so rounding of the window transform can not move rasterstats' window off the array
+        row_start, row_stop = max(0, row_slice[0] - 1), min(src.height, row_slice[1] + 1)
+        col_start, col_stop = max(0, col_slice[0] - 1), min(src.width, col_slice[1] + 1)
+        window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        affine = src.window_transform(window)
+        pixel_factor = 1.0
+        pixels = window.width * window.height if area is None else area / abs(src.transform.a * src.transform.e)
+        if factor > 1 and pixels >= min_pixels:
+            from affine import Affine
+            from rasterio.enums import Resampling
+            out_shape = (max(1, math.ceil(window.height / factor)), max(1, math.ceil(window.width / factor)))
+            array = src.read(band, window=window, out_shape=out_shape, resampling=Resampling.nearest)
+            scale_x, scale_y = window.width / out_shape[1], window.height / out_shape[0]
+            affine = affine * Affine.scale(scale_x, scale_y)
+            pixel_factor = scale_x * scale_y
+        else:
+            array = src.read(band, window=window)
+        if rules is None:
+            return RasterWindow(array, affine, src.nodata, pixel_factor=pixel_factor)
+        values, nodata = rules.apply(array, src.nodata)
+        return RasterWindow(values, affine, nodata, remapped=True, pixel_factor=pixel_factor)
+    #rasterstats fills pixels outside the raster with nodata, leave windows extending past the edge to rasterstats
+    if rules is None:
+        return None
+    #with rules the part of the window inside the raster is read and pixels outside are marked as nodata
+    (row_start, row_stop), (col_start, col_stop) = row_slice, col_slice
+    window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    array = np.zeros((row_stop - row_start, col_stop - col_start), dtype=src.dtypes[band - 1])
+    outside = np.ones(array.shape, dtype=bool)
+    in_rows = slice(max(0, row_start), min(src.height, row_stop))
+    in_cols = slice(max(0, col_start), min(src.width, col_stop))
+    if in_rows.stop > in_rows.start and in_cols.stop > in_cols.start:
+        inside = Window(in_cols.start, in_rows.start, in_cols.stop - in_cols.start, in_rows.stop - in_rows.start)
+        rows = slice(in_rows.start - row_start, in_rows.stop - row_start)
+        cols = slice(in_cols.start - col_start, in_cols.stop - col_start)
+        array[rows, cols] = src.read(band, window=inside)
+        outside[rows, cols] = False
+    values, nodata = rules.apply(array, src.nodata, outside)
+    return RasterWindow(values, src.window_transform(window), nodata, remapped=True)
+
+
+def _timed_read(read_func, item):
+    start = time.perf_counter()
+    result = read_func(item)
+    return result, time.perf_counter() - start
+
+
+def _close_after(barrier):
+    try:
+        barrier.wait(timeout=60)
+    except threading.BrokenBarrierError:
+        pass
+    close_datasets()
+
+
+class WindowPrefetcher:
+    def __init__(self, items, read_func, depth=None, threads=None):
+        '''
+        Description
+        ---------
+        Iterates over (item, window) in the order of items while windows of upcoming items are read on background
+        threads.  At most depth windows are read ahead of the item being processed.
+
+        Parameters
+        ---------
+        items : list of read requests (e.g. (basin, file) pairs)
+        read_func : function reading the window for an item, returns RasterWindow or None (run on reader threads)
+        depth : windows read ahead, defaults to GFF_PREFETCH_DEPTH or 4, 0 reads each window when it is needed
+        threads : reader threads, defaults to GFF_IO_THREADS or 2
+
+        Example
+        ---------
+        for (basin, file), window in raster_io.WindowPrefetcher(requests, read):
+            with instr.Timer('compute'):
+                ...
+        '''
+        self.items = list(items)
+        self.read_func = read_func
+        self.depth, self.threads = prefetch_settings(depth, threads)
+
+    def _record(self, window, read_seconds):
+        metrics = instr.active_metrics()
+        metrics.add_time('io_read', read_seconds)
+        if window is not None:
+            metrics.count('windows_read')
+            metrics.count('window_bytes', window.nbytes)
+
+    def __iter__(self):
+        if self.depth == 0:
+            for item in self.items:
+                start = time.perf_counter()
+                window, read_seconds = _timed_read(self.read_func, item)
+                instr.active_metrics().add_time('io_wait', time.perf_counter() - start)
+                self._record(window, read_seconds)
+                yield item, window
+            close_datasets()
+            return
+        pool = ThreadPoolExecutor(max_workers=self.threads)
+        pending = deque()
+        items = iter(self.items)
+        try:
+            for item in items:
+                pending.append((item, pool.submit(_timed_read, self.read_func, item)))
+                if len(pending) >= self.depth:
+                    break
+            while pending:
+                item, future = pending.popleft()
+                start = time.perf_counter()
+                window, read_seconds = future.result()
+                instr.active_metrics().add_time('io_wait', time.perf_counter() - start)
+                self._record(window, read_seconds)
+                #keep queue full before handing window to computation
+                next_item = next(items, _done)
+                if next_item is not _done:
+                    pending.append((next_item, pool.submit(_timed_read, self.read_func, next_item)))
+                yield item, window
+        finally:
+            for item, future in pending:
+                future.cancel()
+            #each reader thread closes its own datasets, the barrier makes sure every thread runs one close task
+            barrier = threading.Barrier(self.threads)
+            for future in [pool.submit(_close_after, barrier) for i in range(self.threads)]:
+                future.result()
+            pool.shutdown(wait=True)
+
+
+############################################################################################
+############################################################################################
@@ -0,0 +1,263 @@
+#Import packages
+import os
+import re
+import numpy as np
+import pandas as pd
+from utils import basin_store
+from utils import basin_query
+
+
+############################################################################################
+############################################################################################
+'''
+    Author
+    ---------
+    Daniel Wieferich: dwieferich@usgs.gov
+
+    Description
+    ---------
+    exports attribution results joined to basin geometry as GIS layers (GeoPackage or FlatGeobuf, both with a spatial
+    index and without the 2 GB and 10 character field name limits of shapefiles).  Geometry is streamed from the basin
+    store (see utils/basin_store.py) one partition at a time and written in chunks of chunk_size basins, so only
+    attribute tables, one partition of WKB and one chunk of decoded geometry are held in memory.
+
+    Optional pfaf level layers (02 to 11) are dissolved from level 12 geometry within each partition, finest level first
+    so each coarser level is a union of the few polygons of the level below it.  Dissolves keep decoded geometry of one
+    partition (of all partitions sharing a pfaf prefix for levels coarser than the partition level) in memory.
+
+    Layers:
+        GeoPackage  -> one file, layer 'hb12' plus a layer per pfaf level (e.g. 'pfaf_06')
+        FlatGeobuf  -> one layer per file, pfaf levels are written next to outfile (e.g. output/hb12_pfaf_06.fgb)
+
+    Attribute tables are csv files, level 12 tables have an id column (HYBAS_ID, hybas_id or id, see
+    basin_query.read_table), pfaf level tables have a pfaf_{level} column (e.g. pfaf_summarize.summarize output).
+'''
+
+DRIVERS = {'.gpkg': 'GPKG', '.fgb': 'FlatGeobuf'}
+BASIN_COLUMNS = ['HYBAS_ID', 'PFAF_ID', 'SUB_AREA', 'UP_AREA']
+
+
+def read_tables(tables):
+    '''
+    Description
+    ---------
+    reads attribution csv files, level 12 tables are joined by HYBAS_ID and pfaf level tables by pfaf id
+
+    Parameters
+    ---------
+    tables: list of csv files
+
+    Output
+    ---------
+    basin_table: dataframe indexed by HYBAS_ID (None if no level 12 tables)
+    pfaf_tables: dictionary of pfaf level (str, e.g. '06') to dataframe indexed by pfaf id
+    '''
+    basin_table = None
+    pfaf_tables = {}
+    for csv_file in tables or []:
+        columns = pd.read_csv(csv_file, nrows=0).columns
+        if any(col in columns for col in basin_query.ID_COLUMNS):
+            extra = basin_query.read_table(csv_file)
+            level = None
+        else:
+            pfaf_cols = [col for col in columns if re.fullmatch(r'pfaf_(0[2-9]|1[01])', col)]
+            if not pfaf_cols:
+                raise ValueError(f'{csv_file} has no id or pfaf_02 to pfaf_11 column')
+            level = pfaf_cols[0][-2:]
+            extra = pd.read_csv(csv_file)
+            extra = extra.drop(columns=[col for col in extra.columns if col.startswith('Unnamed')])
+            extra = extra.set_index(extra.pop(pfaf_cols[0]).astype(np.int64)).select_dtypes(include='number')
+        table = basin_table if level is None else pfaf_tables.get(level)
+        if table is not None:
+            duplicates = [col for col in extra.columns if col in table.columns]
+            if duplicates:
+                print(f'Warning, columns {duplicates} of {csv_file} are already loaded and are skipped')
+            extra = table.join(extra.drop(columns=duplicates), how='outer')
+        if level is None:
+            basin_table = extra
+        else:
+            pfaf_tables[level] = extra
+    return basin_table, pfaf_tables
+
+
+def layer_paths(outfile, pfaf_levels=None):
+    '''
+    Description
+    ---------
+    returns driver and dictionary of layer name to (file, layer) for outfile (.gpkg or .fgb)
+    '''
+    root, ext = os.path.splitext(outfile)
+    driver = DRIVERS.get(ext.lower())
+    if driver is None:
+        raise ValueError(f'Unknown output format {ext}, use one of {list(DRIVERS)}')
+    layers = {'hb12': (outfile, 'hb12')}
+    for pfaf_level in pfaf_levels or []:
+        name = f'pfaf_{pfaf_level}'
+        layers[name] = (outfile, name) if driver == 'GPKG' else (f'{root}_{name}{ext}', name)
+    return driver, layers
+
+
+def _schema(df):
+    properties = {}
+    for col, dtype in df.dtypes.items():
+        if dtype.kind in 'iub':
+            properties[col] = 'int'
+        elif dtype.kind == 'f':
+            properties[col] = 'float'
+        else:
+            properties[col] = 'str'
+    return {'geometry': 'MultiPolygon', 'properties': properties}
+
+
+def _multipolygons(geoms):
+    #HydroBASINS mix Polygon and MultiPolygon, layers use one geometry type
+    import shapely
+    geoms = np.asarray(geoms, dtype=object)
+    polygons = shapely.get_type_id(geoms) == 3
+    if polygons.any():
+        geoms = geoms.copy()
+        geoms[polygons] = shapely.multipolygons(geoms[polygons], indices=np.arange(int(polygons.sum())))
+    return geoms
+
+
+def _write_chunk(sink, df, geoms):
+    import fiona
+    from shapely.geometry import mapping
+    values = [df[col].astype(object).where(df[col].notna(), None).tolist() for col in df.columns]
+    features = []
+    for i, geom in enumerate(_multipolygons(geoms)):
+        properties = fiona.Properties(**{col: column[i] for col, column in zip(df.columns, values)})
+        features.append(fiona.Feature(geometry=fiona.Geometry.from_dict(mapping(geom)), properties=properties))
+    sink.writerecords(features)
+
+
+def _join(df, key, table):
+    if table is None:
+        return df.reset_index(drop=True)
+    joined = table.reindex(df[key].to_numpy(dtype=np.int64))
+    joined.index = df.index
+    return pd.concat([df, joined], axis=1).reset_index(drop=True)
+
+
+def _partition_groups(store, pfaf_levels):
+    #partitions are dissolved together when the coarsest pfaf level has fewer digits than partition prefixes
+    digits = min([store.partition_level] + [int(level) for level in pfaf_levels or []])
+    groups = {}
+    for partition in store.partitions:
+        groups.setdefault(partition['pfaf_prefix'][:digits], []).append(partition)
+    return list(groups.values())
+
+
+def _dissolve(keys, geoms, parent_keys):
+    #union of geoms sharing a parent key, keys nest so parents are a coarser prefix of keys
+    import shapely
+    order = np.argsort(parent_keys, kind='stable')
+    unique_keys, starts = np.unique(parent_keys[order], return_index=True)
+    groups = np.split(order, starts[1:])
+    return unique_keys, np.array([shapely.union_all(geoms[group]) for group in groups], dtype=object)
+
+
+def export_layers(tables, outfile, pfaf_levels=None, store_dir='data/basin_store', chunk_size=50000,
+                  basin_columns=BASIN_COLUMNS, basins=True, drop_missing=False):
+    '''
+    Description
+    ---------
+    streams basin geometry joined to attribution tables into a GeoPackage or FlatGeobuf with a spatial index
+
+    Parameters
+    ---------
+    tables: list of attribution csv files (see read_tables), e.g. ['output/tif_hb12_att.csv', 'output/tif_pfaf_06.csv']
+    outfile: str, .gpkg or .fgb file (e.g. 'output/hb12.gpkg'), replaced when the export finishes
+    pfaf_levels: optional list of pfaf levels to dissolve and write (e.g. ['04', '06']), choices '02' to '11'
+    store_dir: str, directory of level 12 basin store (see file_management.build_basin_data)
+    chunk_size: int, number of basins decoded and written at once
+    basin_columns: HydroBASINS columns written with attributes of level 12 basins
+    basins: bool, write level 12 basin layer
+    drop_missing: bool, skip basins (or pfaf basins) with no row in attribution tables
+
+    Output
+    ---------
+    layers: dictionary of layer name to (file, layer, number of features written)
+    '''
+    import fiona
+    import geopandas as gpd
+    pfaf_levels = sorted([str(level).zfill(2) for level in pfaf_levels or []], reverse=True)
+    for pfaf_level in pfaf_levels:
+        if not 2 <= int(pfaf_level) <= 11:
+            raise ValueError(f'pfaf level {pfaf_level} is not one of 02 to 11')
+    store = basin_store.BasinStore(store_dir, '12')
+    basin_table, pfaf_tables = read_tables(tables)
+    driver, layers = layer_paths(outfile, pfaf_levels)
+    if not basins:
+        layers.pop('hb12')
+    #layers are written to temporary files and moved in place at the end, partial exports never replace outfile
+    temp_files = {}
+    for path, layer in layers.values():
+        root, ext = os.path.splitext(path)
+        temp_files[path] = f'{root}.tmp{ext}'
+    for temp_file in temp_files.values():
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+    keys = {'hb12': 'HYBAS_ID'}
+    keys.update({f'pfaf_{level}': f'pfaf_{level}' for level in pfaf_levels})
+    level_tables = {'hb12': basin_table}
+    level_tables.update({f'pfaf_{level}': pfaf_tables.get(level) for level in pfaf_levels})
+    for name in level_tables:
+        if name != 'hb12' and level_tables[name] is None:
+            print(f'Warning, no attribution table for {name}, layer has pfaf ids and geometry only')
+
+    #schemas from column types, pfaf layers have the pfaf id and columns of their table
+    first = store._attrs(store.partitions[0]['name'])[basin_columns].head(0)
+    empty = {name: first if name == 'hb12' else pd.DataFrame({keys[name]: pd.Series(dtype=np.int64)}) for name in layers}
+
+    sinks = {}
+    counts = {name: 0 for name in layers}
+    try:
+        for name, (path, layer) in layers.items():
+            sinks[name] = fiona.open(temp_files[path], 'w', driver=driver, layer=layer, crs=store.crs,
+                                     schema=_schema(_join(empty[name], keys[name], level_tables[name])), SPATIAL_INDEX='YES')
+
+        def write(name, df, geoms):
+            df = _join(df, keys[name], level_tables[name])
+            if drop_missing and level_tables[name] is not None:
+                found = np.isin(df[keys[name]].to_numpy(dtype=np.int64), level_tables[name].index.to_numpy())
+                df, geoms = df[found].reset_index(drop=True), geoms[found]
+            for start in range(0, len(df), chunk_size):
+                _write_chunk(sinks[name], df.iloc[start:start + chunk_size], geoms[start:start + chunk_size])
+            counts[name] += len(df)
+
+        for group in _partition_groups(store, pfaf_levels):
+            group_attrs = []
+            group_geoms = []
+            for partition in group:
+                attrs = store._attrs(partition['name'])[basin_columns]
+                wkb = store._wkb(partition['name'])
+                #decode one chunk at a time, decoded geometry of the group is only kept when dissolving
+                for start in range(0, len(attrs), chunk_size):
+                    geoms = gpd.GeoSeries.from_wkb(wkb[start:start + chunk_size]).to_numpy()
+                    if basins:
+                        write('hb12', attrs.iloc[start:start + chunk_size], geoms)
+                    if pfaf_levels:
+                        group_geoms.append(geoms)
+                if pfaf_levels:
+                    group_attrs.append(attrs['PFAF_ID'].to_numpy(dtype=np.int64))
+                del wkb
+            if not pfaf_levels or not group_attrs:
+                continue
+            current_keys = np.concatenate(group_attrs)
+            geoms = np.concatenate(group_geoms)
+            for pfaf_level in pfaf_levels:
+                parent_keys = current_keys // 10 ** (len(str(int(current_keys.max()))) - int(pfaf_level))
+                current_keys, geoms = _dissolve(current_keys, geoms, parent_keys)
+                write(f'pfaf_{pfaf_level}', pd.DataFrame({f'pfaf_{pfaf_level}': current_keys}), geoms)
+    finally:
+        for sink in sinks.values():
+            sink.close()
+    for path, temp_file in temp_files.items():
+        os.replace(temp_file, path)
+    return {name: (path, layer, counts[name]) for name, (path, layer) in layers.items()}
+
+
+############################################################################################
+############################################################################################